@@ -0,0 +1,98 @@
+#### Benchmark: loading the tracks, artists and features tables
+#### Compares the old row-by-row cur.execute loop (indexes in place, default
+#### PRAGMAs) with music_bulk_load.bulk_insert (one executemany per table in
+#### one transaction, load PRAGMAs, indexes built afterwards).
+####
+#### python3 benchmarks/bench_bulk_load.py [--sizes 10000 100000 1000000]
+
+import argparse
+import os
+import random
+import string
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from music_schema import create_tables, create_indexes, insert_tracks, insert_artists, insert_features
+from music_bulk_load import apply_load_pragmas, bulk_insert
+
+TRACKS_PER_ARTIST = 10
+ID_CHARACTERS = string.ascii_letters + string.digits
+
+
+def spotify_ids(count, seed):
+    '''Random 22-character base62 IDs, like Spotify's (so index inserts
+    land in random order, as they do with real data).'''
+    rng = random.Random(seed)
+    return ["".join(rng.choices(ID_CHARACTERS, k=22)) for _ in range(count)]
+
+
+def make_rows(size, seed=507):
+    '''Builds the tracks, artists and features rows up front, so the
+    timings only measure loading.'''
+    rng = random.Random(seed)
+    track_ids = spotify_ids(size, seed)
+    artist_ids = spotify_ids(max(1, size // TRACKS_PER_ARTIST), seed + 1)
+    tracks = []
+    features = []
+    for i, track_id in enumerate(track_ids):
+        artist = rng.randrange(len(artist_ids))
+        tracks.append((f"Track {i}", f"Artist {artist}", f"Album {i // 12}", None, "https://open.spotify.com/track/" + track_id, artist_ids[artist], track_id, rng.randint(0, 100), 0))
+        features.append((track_id, rng.random(), rng.random(), rng.uniform(60, 200), 0))
+    artists = [(artist_id, f"Artist {i}", "indie", "https://i.scdn.co/image/x", 0) for i, artist_id in enumerate(artist_ids)]
+    return tracks, artists, features
+
+
+def load_row_by_row(connection, rows):
+    ''' the way requests_database.py used to load: indexes exist, one
+    execute per row, a commit at the end of each table '''
+    tracks, artists, features = rows
+    create_tables(connection)
+    cur = connection.cursor()
+    for insert_sql, table_rows in [(insert_tracks, tracks), (insert_artists, artists), (insert_features, features)]:
+        for row in table_rows:
+            cur.execute(insert_sql, row)
+        connection.commit()
+
+
+def load_bulk(connection, rows):
+    tracks, artists, features = rows
+    apply_load_pragmas(connection)
+    create_tables(connection, full_rebuild=True)
+    bulk_insert(connection, insert_tracks, tracks)
+    bulk_insert(connection, insert_artists, artists, sort_key=lambda row: row[0])
+    bulk_insert(connection, insert_features, features, sort_key=lambda row: row[0])
+    create_indexes(connection)
+
+
+def time_load(load, rows):
+    with tempfile.TemporaryDirectory() as directory:
+        connection = sqlite3.connect(os.path.join(directory, "bench.sqlite"))
+        start = time.perf_counter()
+        load(connection, rows)
+        seconds = time.perf_counter() - start
+        count = connection.execute("SELECT COUNT(*) FROM tracks").fetchone()[0]
+        connection.close()
+    assert count == len(rows[0])
+    return seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark loading music.sqlite")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000, 1000000])
+    args = parser.parse_args()
+
+    print(f"{'tracks':>8} {'row by row (s)':>15} {'bulk (s)':>10} {'bulk rows/s':>12} {'speedup':>8}")
+    for size in args.sizes:
+        rows = make_rows(size)
+        row_seconds = time_load(load_row_by_row, rows)
+        bulk_seconds = time_load(load_bulk, rows)
+        total_rows = sum(len(table_rows) for table_rows in rows)
+        print(f"{size:>8} {row_seconds:>15.2f} {bulk_seconds:>10.2f} {total_rows / bulk_seconds:>12,.0f} {row_seconds / bulk_seconds:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+#### Benchmark: de-duplicating tracks by Spotify track ID
+#### Compares the old nested-loop remove_duplicate_tracks with
+#### music_utils.remove_duplicates at 1k, 10k and 100k tracks.
+####
+#### python3 benchmarks/bench_dedup.py [--sizes 1000 10000 100000] [--legacy-max 10000]
+
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from music_utils import remove_duplicates
+
+DUPLICATE_RATE = 0.2
+
+
+class FakeTrack:
+    def __init__(self, spotify_track_id):
+        self.spotify_track_id = spotify_track_id
+
+
+def legacy_remove_duplicate_tracks(list):
+    ''' the nested while-loop version that used to be in requests_database.py '''
+    i = 0
+    while i < len(list):
+        j = i + 1
+        while j < len(list):
+            if list[i].spotify_track_id == list[j].spotify_track_id:
+                del list[j]
+            else:
+                j += 1
+        i += 1
+
+
+def make_tracks(size, seed=507):
+    '''Builds size tracks where about DUPLICATE_RATE of them repeat an
+    earlier track ID.'''
+    rng = random.Random(seed)
+    unique_count = max(1, int(size * (1 - DUPLICATE_RATE)))
+    ids = [f"track{i:08d}" for i in range(unique_count)]
+    ids += [rng.choice(ids) for _ in range(size - unique_count)]
+    rng.shuffle(ids)
+    return [FakeTrack(track_id) for track_id in ids]
+
+
+def time_dedup(function, tracks):
+    tracks = list(tracks)
+    start = time.perf_counter()
+    function(tracks)
+    return time.perf_counter() - start, len(tracks)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark track de-duplication")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--legacy-max", type=int, default=10000,
+        help="largest size to run the nested-loop version at; bigger sizes are extrapolated (n^2)")
+    args = parser.parse_args()
+
+    print(f"{'tracks':>8} {'unique':>8} {'nested loop (s)':>18} {'hash-based (s)':>16} {'speedup':>10}")
+    legacy_reference = None
+    for size in args.sizes:
+        tracks = make_tracks(size)
+        new_seconds, unique_count = time_dedup(lambda items: remove_duplicates(items, key=lambda track: track.spotify_track_id), tracks)
+        if size <= args.legacy_max:
+            legacy_seconds, legacy_count = time_dedup(legacy_remove_duplicate_tracks, tracks)
+            assert legacy_count == unique_count
+            legacy_reference = (size, legacy_seconds)
+            legacy_text = f"{legacy_seconds:.4f}"
+        elif legacy_reference is not None:
+            reference_size, reference_seconds = legacy_reference
+            legacy_seconds = reference_seconds * (size / reference_size) ** 2
+            legacy_text = f"~{legacy_seconds:.1f} (est.)"
+        else:
+            legacy_seconds = None
+            legacy_text = "skipped"
+        speedup = f"{legacy_seconds / new_seconds:,.0f}x" if legacy_seconds else "-"
+        print(f"{size:>8} {unique_count:>8} {legacy_text:>18} {new_seconds:>16.4f} {speedup:>10}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+#### Benchmark: memory held by the track models
+#### Builds the same catalog with plain __dict__ classes (the old models) and
+#### with the slotted, interned classes in music_models.py, and compares
+#### feature profiles with music_features.FeatureColumns.
+####
+#### python3 benchmarks/bench_models.py [--sizes 10000 100000 1000000]
+
+import argparse
+import gc
+import os
+import random
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from music_models import Track, TrackFeatureProfile
+from music_features import FeatureColumns
+
+TRACKS_PER_ARTIST = 20
+TRACKS_PER_ALBUM = 8
+
+
+class LegacyTrack:
+    ''' the __dict__ version that used to be in requests_database.py '''
+    def __init__(self, genre="Unknown", track_name="Unknown track", spotify_track_id="None", track_popularity=0, artist_name="Unknown Artist", album_name="Unknown Album", spotify_url="Unknown", preview="Not available", spotify_artist_id="Unknown", popularity=0):
+        self.genre = genre
+        self.track_name = track_name
+        self.spotify_track_id = spotify_track_id
+        self.track_popularity = track_popularity
+        self.artist_name = artist_name
+        self.album_name = album_name
+        self.spotify_url = spotify_url
+        self.preview = preview
+        self.spotify_artist_id = spotify_artist_id
+        self.popularity = popularity
+
+
+class LegacyTrackFeatureProfile:
+    def __init__(self, spotify_track_id="Unknown", acousticness=0.0, danceability=0.0, tempo=0.0):
+        self.spotify_track_id = spotify_track_id
+        self.acousticness = acousticness
+        self.danceability = danceability
+        self.tempo = tempo
+
+
+def make_track_fields(size, seed=507):
+    '''Yields keyword arguments for size tracks. Every string is built
+    fresh, the way json.loads hands them out, so repeated artist and album
+    names are equal but separate objects.'''
+    rng = random.Random(seed)
+    for i in range(size):
+        artist = i // TRACKS_PER_ARTIST
+        album = i // TRACKS_PER_ALBUM
+        track_id = f"{i:022d}"
+        yield dict(
+            track_name=f"Track number {i}",
+            spotify_track_id=track_id,
+            popularity=rng.randint(0, 100),
+            artist_name=f"Artist name {artist}",
+            album_name=f"Album title number {album}",
+            spotify_url=f"https://open.spotify.com/track/{track_id}",
+            preview=None,
+            spotify_artist_id=f"artist{artist:016d}",
+        )
+
+
+def make_feature_fields(size, seed=507):
+    rng = random.Random(seed)
+    for i in range(size):
+        yield (f"{i:022d}", rng.random(), rng.random(), rng.uniform(60, 200))
+
+
+def measure(build):
+    '''Returns the bytes still allocated after build() and the result.'''
+    gc.collect()
+    tracemalloc.start()
+    result = build()
+    allocated, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return allocated, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark model memory")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000, 1000000])
+    args = parser.parse_args()
+
+    print(f"{'tracks':>8} {'dict tracks':>12} {'slotted':>10} {'saving':>7} {'dict features':>14} {'slotted':>10} {'columns':>10}   (bytes per track)")
+    for size in args.sizes:
+        legacy_tracks, _ = measure(lambda: [LegacyTrack(**fields) for fields in make_track_fields(size)])
+        tracks, _ = measure(lambda: [Track(**fields) for fields in make_track_fields(size)])
+        legacy_features, _ = measure(lambda: [LegacyTrackFeatureProfile(*fields) for fields in make_feature_fields(size)])
+        features, _ = measure(lambda: [TrackFeatureProfile(*fields) for fields in make_feature_fields(size)])
+        # the ID strings are the same in every representation; count the numbers only
+        columns = FeatureColumns.from_rows((track_id, 50, acousticness, danceability, tempo) for track_id, acousticness, danceability, tempo in make_feature_fields(size))
+        print(f"{size:>8} {legacy_tracks / size:>12.0f} {tracks / size:>10.0f} {1 - tracks / legacy_tracks:>7.0%} "
+              f"{legacy_features / size:>14.0f} {features / size:>10.0f} {columns.nbytes() / size:>10.0f}")
+
+
+if __name__ == "__main__":
+    main()
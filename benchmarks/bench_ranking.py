@@ -0,0 +1,87 @@
+#### Benchmark: ranking a genre by weighted audio features
+#### Times RankingEngine.top against a Python sorted() over per-track tuples
+#### and a full NumPy argsort, on synthetic catalogs of up to 1M tracks.
+####
+#### python3 benchmarks/bench_ranking.py [--sizes 10000 100000 1000000] [--genres 8] [--limit 11]
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from music_features import FeatureColumns
+from music_ranking import RankingEngine, RANKING_MODES
+
+REPEATS = 5
+
+
+def make_engine(size, genre_count, seed=507):
+    rng = np.random.default_rng(seed)
+    columns = FeatureColumns(
+        [f"{i:022d}" for i in range(size)],
+        rng.integers(0, 101, size),
+        rng.random(size),
+        rng.random(size),
+        rng.uniform(60, 200, size),
+    )
+    genres = [f"genre{code}" for code in rng.integers(0, genre_count, size)]
+    return RankingEngine(columns, genres), genres
+
+
+def python_top(rows, genre, weights, limit):
+    ''' rank with a Python key function over per-track tuples '''
+    def score(row):
+        return sum(weight * row[1][name] for name, weight in weights.items())
+    return [row[0] for row in sorted((row for row in rows if row[2] == genre), key=score, reverse=True)[:limit]]
+
+
+def argsort_top(engine, genre, weights, limit):
+    ''' the vectorized score, but a full sort instead of argpartition '''
+    positions = engine.genre_positions[genre]
+    scores = engine.score(weights, positions)
+    best = np.argsort(-scores, kind="stable")[:limit]
+    return [engine.columns.spotify_track_ids[i] for i in positions[best]]
+
+
+def best_time(function):
+    times = []
+    for _ in range(REPEATS):
+        start = time.perf_counter()
+        result = function()
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark weighted ranking")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000, 1000000])
+    parser.add_argument("--genres", type=int, default=8)
+    parser.add_argument("--limit", type=int, default=11)
+    args = parser.parse_args()
+    weights = RANKING_MODES["danceable but obscure"]
+
+    print(f"{'tracks':>8} {'build (s)':>10} {'python sort (ms)':>17} {'argsort (ms)':>13} {'argpartition (ms)':>18} {'speedup':>8}")
+    for size in args.sizes:
+        start = time.perf_counter()
+        engine, genres = make_engine(size, args.genres)
+        build_seconds = time.perf_counter() - start
+        scaled = [{name: float(engine.scaled[name][i]) for name in weights} for i in range(size)]
+        rows = list(zip(engine.columns.spotify_track_ids, scaled, genres))
+        genre = "genre0"
+
+        python_seconds, python_ids = best_time(lambda: python_top(rows, genre, weights, args.limit))
+        argsort_seconds, argsort_ids = best_time(lambda: argsort_top(engine, genre, weights, args.limit))
+        top_seconds, top_ids = best_time(lambda: engine.top(genre, weights, args.limit))
+        # float32 vs float64 sums can swap exact ties, so compare the scores
+        assert np.allclose(sorted(engine.score(weights, np.array([engine.columns.position(i) for i in top_ids]))),
+                           sorted(engine.score(weights, np.array([engine.columns.position(i) for i in python_ids]))), atol=1e-5)
+        print(f"{size:>8} {build_seconds:>10.2f} {python_seconds * 1000:>17.1f} {argsort_seconds * 1000:>13.2f} "
+              f"{top_seconds * 1000:>18.2f} {python_seconds / top_seconds:>7.0f}x")
+
+
+if __name__ == "__main__":
+    main()
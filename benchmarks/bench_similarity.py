@@ -0,0 +1,74 @@
+#### Benchmark: "more like this" nearest-neighbour lookups
+#### Times music_similarity.SimilarityIndex (a KD-tree) against a brute-force
+#### NumPy distance scan, and checks both return the same neighbours.
+####
+#### python3 benchmarks/bench_similarity.py [--sizes 10000 100000 1000000] [--k 10] [--queries 200]
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from music_features import FeatureColumns
+from music_similarity import SimilarityIndex
+
+
+def make_columns(size, seed=507):
+    rng = np.random.default_rng(seed)
+    return FeatureColumns(
+        [f"{i:022d}" for i in range(size)],
+        rng.integers(0, 101, size),
+        rng.beta(2, 5, size),
+        rng.beta(5, 3, size),
+        rng.normal(120, 25, size).clip(40, 220),
+    )
+
+
+def brute_force(index, position, k):
+    distances = ((index.vectors - index.vectors[position]) ** 2).sum(axis=1)
+    distances[position] = np.inf
+    best = np.argpartition(distances, k)[:k]
+    return best[np.argsort(distances[best])]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark similar-track lookups")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000, 1000000])
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--queries", type=int, default=200)
+    args = parser.parse_args()
+
+    print(f"{'tracks':>8} {'build (s)':>10} {'brute force (ms)':>17} {'kd-tree (ms)':>13} {'speedup':>8}")
+    for size in args.sizes:
+        columns = make_columns(size)
+        start = time.perf_counter()
+        index = SimilarityIndex(columns)
+        columns.position(columns.spotify_track_ids[0]) # builds the ID -> position map
+        build_seconds = time.perf_counter() - start
+        rng = np.random.default_rng(size)
+        positions = rng.integers(0, size, args.queries)
+        track_ids = [columns.spotify_track_ids[position] for position in positions]
+
+        start = time.perf_counter()
+        expected = [brute_force(index, position, args.k) for position in positions]
+        brute_seconds = (time.perf_counter() - start) / args.queries
+
+        start = time.perf_counter()
+        found = [index.similar(track_id, args.k) for track_id in track_ids]
+        tree_seconds = (time.perf_counter() - start) / args.queries
+
+        for position, neighbours, expected_positions in zip(positions, found, expected):
+            got = np.array([columns.position(track_id) for track_id, _ in neighbours])
+            # neighbours at exactly the same distance may come back in either order
+            want = ((index.vectors[expected_positions] - index.vectors[position]) ** 2).sum(axis=1)
+            have = ((index.vectors[got] - index.vectors[position]) ** 2).sum(axis=1)
+            assert np.allclose(np.sort(want), np.sort(have), atol=1e-6)
+        print(f"{size:>8} {build_seconds:>10.2f} {brute_seconds * 1000:>17.2f} {tree_seconds * 1000:>13.3f} {brute_seconds / tree_seconds:>7.0f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,318 @@
+#### End-to-end benchmarks: ingestion, queries and page rendering
+#### For each catalog size, makes Spotify responses with music_synthetic and
+#### loads them into a temporary music.sqlite through the pipeline's own
+#### functions (create_track_objects, dedup, the bulk inserts). It then times the
+#### /results queries for every sort mode, and the /results and /play-music
+#### pages through Flask's test client. Every measurement is written as one
+#### JSON record, so runs from different releases can be compared; pass an
+#### older file as --baseline to print the change next to each result.
+####
+#### python3 benchmarks/bench_suite.py [--sizes 1000 100000 1000000] [--repeat 5]
+####     [--output bench_suite.json] [--baseline old_bench_suite.json]
+
+import argparse
+import json
+import os
+import platform
+import random
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, REPO_ROOT)
+
+import numpy as np
+
+import music_db
+import requests_database
+import music_flask_app
+from music_flask_app import app, get_tracks_by_genre, get_top_tracks_by_genre, get_leaderboard, get_ranking_engine, RESPONSE_CACHE, LOADED_INDEXES
+from music_bulk_load import apply_load_pragmas, bulk_insert
+from music_leaderboards import refresh_leaderboards
+from music_ranking import RANKING_MODES
+from music_schema import create_tables, create_indexes, bump_database_version, upsert_tadb_artists, insert_music_videos, SORT_ORDERS
+from music_synthetic import SyntheticCatalog
+
+SEARCH_PAGE_SIZE = requests_database.SPOTIFY_SEARCH_PAGE_SIZE
+FEATURES_BATCH_SIZE = requests_database.SPOTIFY_FEATURES_BATCH_SIZE
+# one search result in DUPLICATE_EVERY repeats an earlier track, the way
+# overlapping genre queries return the same track more than once
+DUPLICATE_EVERY = 20
+
+# the genre bucket the query and page benchmarks ask for
+QUERY_GENRE = "indie"
+# "random" stands for every sort that isn't in SORT_ORDERS or RANKING_MODES
+SORT_MODES = list(SORT_ORDERS) + list(RANKING_MODES) + ["random"]
+
+
+############## SYNTHETIC API RESPONSES ##############
+
+def make_search_pages(tracks, rng):
+    '''Splits a batch of SyntheticCatalog tracks into search results as
+    the /v1/search endpoint returns them, SEARCH_PAGE_SIZE tracks a page,
+    with the odd repeat.'''
+    items = []
+    for i, track in enumerate(tracks):
+        items.append(track)
+        if i % DUPLICATE_EVERY == DUPLICATE_EVERY - 1:
+            items.append(items[rng.randrange(len(items))])
+        if len(items) >= SEARCH_PAGE_SIZE:
+            yield {"tracks": {"items": items}}
+            items = []
+    if items:
+        yield {"tracks": {"items": items}}
+
+
+############## MEASURING ##############
+
+def measure(function, repeat):
+    '''Runs function repeat times; returns (list of seconds, last result).'''
+    seconds = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        seconds.append(time.perf_counter() - start)
+    return seconds, result
+
+
+def make_record(size, group, name, seconds, items=None):
+    '''One result, as written to the JSON file.'''
+    record = {
+        "size": size,
+        "group": group,
+        "name": name,
+        "runs": len(seconds),
+        "min_seconds": min(seconds),
+        "median_seconds": statistics.median(seconds),
+    }
+    if items is not None:
+        record["items"] = items
+    return record
+
+
+############## STAGES ##############
+
+def run_ingestion(size, database_path, seed):
+    '''Turns a SyntheticCatalog's API responses into objects and loads
+    them into a new music.sqlite at database_path, timing each step once.
+
+    Returns
+    -------
+    tuple
+        (list of records, SpotifyTrackIds with a music video, SpotifyTrackIds
+        without one)
+    '''
+    rng = random.Random(seed)
+    catalog = SyntheticCatalog(size, seed=seed)
+    records = []
+
+    # the object builders run page by page and batch by batch, as they do
+    # on API responses; only their calls are timed, not making the responses
+    tracks = []
+    features = []
+    videos = []
+    track_seconds = 0.0
+    feature_seconds = 0.0
+    for track_results, feature_results, batch_videos in catalog.track_batches():
+        for page in make_search_pages(track_results, rng):
+            start = time.perf_counter()
+            tracks += requests_database.create_track_objects(page)
+            track_seconds += time.perf_counter() - start
+        for i in range(0, len(feature_results), FEATURES_BATCH_SIZE):
+            start = time.perf_counter()
+            features += requests_database.create_track_features_objects(feature_results[i:i + FEATURES_BATCH_SIZE])
+            feature_seconds += time.perf_counter() - start
+        videos += batch_videos
+    records.append(make_record(size, "ingest", "create_track_objects", [track_seconds], len(tracks)))
+    records.append(make_record(size, "ingest", "create_track_features_objects", [feature_seconds], len(features)))
+
+    seconds, _ = measure(lambda: requests_database.remove_duplicate_tracks(tracks), 1)
+    records.append(make_record(size, "ingest", "remove_duplicate_tracks", seconds, len(tracks)))
+    assert len(tracks) == size
+
+    def artist_objects():
+        artists = requests_database.create_artist_objects(catalog.artists)
+        requests_database.remove_duplicate_artists(artists)
+        for artist in artists:
+            requests_database.map_genres(artist)
+        return artists
+    seconds, artists = measure(artist_objects, 1)
+    records.append(make_record(size, "ingest", "create_artist_objects", seconds, len(artists)))
+
+    # the pipeline writes through requests_database.get_connection()
+    requests_database.DATABASE_NAME = database_path
+    requests_database._connection = None
+    connection = requests_database.get_connection()
+    apply_load_pragmas(connection)
+    create_tables(connection, full_rebuild=True)
+    for name, save, objects in [
+        ("bulk_insert:tracks", lambda: requests_database.save_tracks([tracks], full_rebuild=True), tracks),
+        ("bulk_insert:artists", lambda: requests_database.save_artists(artists, full_rebuild=True), artists),
+        ("bulk_insert:features", lambda: requests_database.save_features(features, full_rebuild=True), features),
+    ]:
+        seconds, _ = measure(save, 1)
+        records.append(make_record(size, "ingest", name, seconds, len(objects)))
+    seconds, _ = measure(lambda: create_indexes(connection), 1)
+    records.append(make_record(size, "ingest", "create_indexes", seconds))
+    seconds, _ = measure(lambda: refresh_leaderboards(connection), 1)
+    records.append(make_record(size, "ingest", "refresh_leaderboards", seconds))
+
+    # every artist has been looked up on TheAudioDB, as music_videos.py
+    # would have, so /play-music never starts a background lookup
+    fetched_at = int(time.time())
+    bulk_insert(connection, upsert_tadb_artists, (
+        [artist["id"], catalog.tadb_artist_id(artist_index), fetched_at]
+        for artist_index, artist in enumerate(catalog.artists)))
+    bulk_insert(connection, insert_music_videos, (
+        [track_id, catalog.tadb_artist_id(artist_index), title, url, fetched_at]
+        for artist_index, track_id, title, url in videos))
+    bump_database_version(connection)
+    connection.close()
+    requests_database._connection = None
+    video_track_ids = [video[1] for video in videos]
+    with_video = set(video_track_ids)
+    other_track_ids = [track.spotify_track_id for track in tracks[:10 * len(video_track_ids) + 10] if track.spotify_track_id not in with_video]
+    return records, video_track_ids, other_track_ids
+
+
+def run_queries(size, repeat):
+    '''Times the functions behind /results against the loaded catalog.'''
+    records = []
+    with app.app_context():
+        seconds, rows = measure(lambda: get_tracks_by_genre(QUERY_GENRE), repeat)
+        records.append(make_record(size, "query", "get_tracks_by_genre", seconds, len(rows)))
+
+        # the first ranked sort builds the RankingEngine; time that on its own
+        def load_engine():
+            LOADED_INDEXES.clear()
+            return get_ranking_engine()
+        seconds, engine = measure(load_engine, repeat)
+        records.append(make_record(size, "query", "load_ranking_engine", seconds, len(engine.columns)))
+
+        for sort in SORT_MODES:
+            seconds, rows = measure(lambda: get_top_tracks_by_genre(QUERY_GENRE, sort), repeat)
+            records.append(make_record(size, "query", f"get_top_tracks_by_genre:{sort}", seconds, len(rows)))
+        for sort in SORT_ORDERS:
+            seconds, rows = measure(lambda: get_leaderboard(QUERY_GENRE, sort), repeat)
+            records.append(make_record(size, "query", f"get_leaderboard:{sort}", seconds, len(rows)))
+    return records
+
+
+def run_pages(size, video_track_ids, other_track_ids, repeat, seed):
+    '''Times /results and /play-music through Flask's test client, with
+    an empty page cache ("cold") and with the page already cached
+    ("warm").'''
+    records = []
+    client = app.test_client()
+
+    def get(url, clear_cache):
+        if clear_cache:
+            RESPONSE_CACHE.clear()
+        response = client.get(url)
+        assert response.status_code == 200, (url, response.status_code)
+        return response
+
+    for sort in SORT_MODES:
+        url = "/results?" + music_flask_app.urlencode({"genre": QUERY_GENRE, "sort": sort})
+        seconds, _ = measure(lambda: get(url, True), repeat)
+        records.append(make_record(size, "web", f"/results:{sort}:cold", seconds))
+        if sort != "random": # random pages are never cached
+            seconds, _ = measure(lambda: get(url, False), repeat)
+            records.append(make_record(size, "web", f"/results:{sort}:warm", seconds))
+
+    # a different track on every cold run, with and without a music video
+    rng = random.Random(seed)
+    for kind, candidates in [("video", video_track_ids), ("no video", other_track_ids)]:
+        if len(candidates) == 0:
+            continue
+        urls = iter([f"/play-music?track={rng.choice(candidates)}" for _ in range(repeat)])
+        seconds, _ = measure(lambda: get(next(urls), True), repeat)
+        records.append(make_record(size, "web", f"/play-music:{kind}:cold", seconds))
+        url = f"/play-music?track={candidates[0]}"
+        get(url, True)
+        seconds, _ = measure(lambda: get(url, False), repeat)
+        records.append(make_record(size, "web", f"/play-music:{kind}:warm", seconds))
+    return records
+
+
+def run_size(size, repeat, seed):
+    with tempfile.TemporaryDirectory() as directory:
+        database_path = os.path.join(directory, "music.sqlite")
+        records, video_track_ids, other_track_ids = run_ingestion(size, database_path, seed)
+        # point the app at the new catalog, with nothing cached from the last one
+        music_db.close_db()
+        music_db.DATABASE_NAME = database_path
+        LOADED_INDEXES.clear()
+        RESPONSE_CACHE.clear()
+        records += run_queries(size, repeat)
+        records += run_pages(size, video_track_ids, other_track_ids, repeat, seed)
+        music_db.close_db()
+        LOADED_INDEXES.clear()
+    return records
+
+
+############## REPORTING ##############
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPO_ROOT, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def environment():
+    return {
+        "commit": git_commit(),
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "processor": platform.processor() or platform.machine(),
+    }
+
+
+def load_baseline(path):
+    '''(size, group, name) -> median seconds from an earlier run.'''
+    with open(path, 'r') as baseline_file:
+        baseline = json.load(baseline_file)
+    return {(record["size"], record["group"], record["name"]): record["median_seconds"] for record in baseline["results"]}
+
+
+def print_record(record, baseline):
+    change = ""
+    old = baseline.get((record["size"], record["group"], record["name"]))
+    if old:
+        change = f"{(record['median_seconds'] - old) / old:>+8.0%}"
+    print(f"{record['size']:>8} {record['group']:>7} {record['name']:<45} {record['median_seconds'] * 1000:>12.2f} {record['min_seconds'] * 1000:>10.2f} {change}", flush=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark ingestion, queries and page rendering end to end")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 100000, 1000000])
+    parser.add_argument("--repeat", type=int, default=5, help="runs of each query and page benchmark")
+    parser.add_argument("--seed", type=int, default=507)
+    parser.add_argument("--output", default="bench_suite.json", help="where to write the JSON results")
+    parser.add_argument("--baseline", help="an earlier --output file to compare against")
+    args = parser.parse_args()
+    baseline = load_baseline(args.baseline) if args.baseline else {}
+
+    results = []
+    print(f"{'tracks':>8} {'group':>7} {'benchmark':<45} {'median (ms)':>12} {'min (ms)':>10} {'change' if baseline else ''}")
+    for size in args.sizes:
+        for record in run_size(size, args.repeat, args.seed):
+            print_record(record, baseline)
+            results.append(record)
+
+    with open(args.output, 'w') as output_file:
+        json.dump({"environment": environment(), "sizes": args.sizes, "repeat": args.repeat, "results": results}, output_file, indent=2)
+    print(f"Wrote {len(results)} results to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+#### Bulk loading for music.sqlite
+#### Rows go in through a single executemany per table inside one
+#### transaction, with PRAGMAs tuned for loading (tracks, which stream in
+#### from the network, go in one chunk per transaction instead). Build
+#### indexes after the load (music_schema.create_indexes), not before.
+
+LOAD_PRAGMAS = [
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA cache_size=-262144", # 256 MB of page cache (negative = KiB)
+    "PRAGMA temp_store=MEMORY",
+]
+
+
+def apply_load_pragmas(connection):
+    '''Applies LOAD_PRAGMAS to a connection. journal_mode=WAL is stored in
+    the database file; the others only last as long as the connection.
+
+    Parameters
+    ----------
+    connection: sqlite3.Connection
+
+    Returns
+    -------
+    None
+    '''
+    for pragma in LOAD_PRAGMAS:
+        connection.execute(pragma)
+
+
+def bulk_insert(connection, insert_sql, rows, sort_key=None):
+    '''Inserts every row with one executemany call inside one transaction.
+    rows may be a generator; it is consumed lazily, so it never has to be
+    held in memory as a whole (unless sort_key is given).
+
+    Parameters
+    ----------
+    connection: sqlite3.Connection
+    insert_sql: string
+        An INSERT (or upsert) statement with ? placeholders
+    rows: iterable
+        sequences of values, one per row
+    sort_key: callable
+        If given, rows are sorted by it before inserting. Sorting by the
+        table's primary key fills its index pages in order instead of
+        splitting them at random.
+
+    Returns
+    -------
+    int
+        the number of rows inserted or updated
+    '''
+    if sort_key is not None:
+        rows = sorted(rows, key=sort_key)
+    with connection:
+        cursor = connection.executemany(insert_sql, rows)
+    return cursor.rowcount
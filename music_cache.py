@@ -0,0 +1,295 @@
+#### Shared API cache for requests_database.py and music_flask_app.py
+#### Cached API responses live in a SQLite table keyed by construct_unique_key(),
+#### so a lookup or a save only touches the one entry it needs. A bounded
+#### in-process LRU layer sits in front of the table.
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from music_metrics import phase, API_CACHE_LOOKUPS
+
+DEFAULT_CACHE_DB_NAME = "music_cache.sqlite"
+# MUSIC_CACHE_DB lets a run start from its own (e.g. empty) cache; only the
+# default cache imports music_cache.json
+CACHE_DB_NAME = os.environ.get("MUSIC_CACHE_DB", DEFAULT_CACHE_DB_NAME)
+CACHE_FILE_NAME = "music_cache.json"
+
+MEMORY_CACHE_MAX_ENTRIES = 2000
+MEMORY_CACHE_MAX_BYTES = 32 * 1024 * 1024
+
+# seconds an entry may stay in memory, by URL prefix (longest prefix wins)
+MEMORY_CACHE_TTLS = {
+    "https://api.spotify.com/v1/search": 60 * 60,
+    "https://api.spotify.com/v1/artists": 24 * 60 * 60,
+    "https://api.spotify.com/v1/audio-features": 7 * 24 * 60 * 60,
+    "https://www.theaudiodb.com/api/v1/json/1/search.php": 24 * 60 * 60,
+    "https://theaudiodb.com/api/v1/json/1/mvid.php": 24 * 60 * 60,
+}
+MEMORY_CACHE_DEFAULT_TTL = 60 * 60
+
+create_cache = '''
+    CREATE TABLE IF NOT EXISTS "cache" (
+        "CacheKey"      TEXT PRIMARY KEY NOT NULL,
+        "Response"      TEXT NOT NULL
+    );
+'''
+
+select_cache = '''
+    SELECT Response FROM cache
+    WHERE CacheKey = ?
+'''
+
+insert_cache = '''
+    INSERT OR REPLACE INTO cache
+    VALUES (?, ?)
+'''
+
+_local = threading.local()
+
+
+class MemoryCache:
+    ''' A thread-safe LRU cache of decoded API responses, bounded by
+    number of entries and by total size (in bytes of JSON text).
+
+    Instance attributes
+    -------------------
+    max_entries: int
+
+    max_bytes: int
+
+    ttls: dict
+        URL prefix -> seconds an entry stays fresh
+
+    default_ttl: int
+
+    hits, misses, evictions, expirations: int
+        counters for sizing the cache
+
+    '''
+    def __init__(self, max_entries=MEMORY_CACHE_MAX_ENTRIES, max_bytes=MEMORY_CACHE_MAX_BYTES, ttls=MEMORY_CACHE_TTLS, default_ttl=MEMORY_CACHE_DEFAULT_TTL):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttls = ttls
+        self.default_ttl = default_ttl
+        self.entries = OrderedDict() # key -> (value, expires_at, size)
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.lock = threading.Lock()
+
+    def ttl_for(self, unique_key):
+        best_prefix = ""
+        ttl = self.default_ttl
+        for prefix in self.ttls:
+            if unique_key.startswith(prefix) and len(prefix) > len(best_prefix):
+                best_prefix = prefix
+                ttl = self.ttls[prefix]
+        return ttl
+
+    def get(self, unique_key):
+        with self.lock:
+            entry = self.entries.get(unique_key)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, expires_at, size = entry
+            if expires_at < time.monotonic():
+                del self.entries[unique_key]
+                self.total_bytes -= size
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self.entries.move_to_end(unique_key)
+            self.hits += 1
+            return value
+
+    def put(self, unique_key, value, size):
+        if size > self.max_bytes:
+            return
+        expires_at = time.monotonic() + self.ttl_for(unique_key)
+        with self.lock:
+            old_entry = self.entries.pop(unique_key, None)
+            if old_entry is not None:
+                self.total_bytes -= old_entry[2]
+            self.entries[unique_key] = (value, expires_at, size)
+            self.total_bytes += size
+            while len(self.entries) > self.max_entries or self.total_bytes > self.max_bytes:
+                _, (_, _, evicted_size) = self.entries.popitem(last=False)
+                self.total_bytes -= evicted_size
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.total_bytes = 0
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "bytes": self.total_bytes,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+            }
+
+
+MEMORY_CACHE = MemoryCache()
+
+
+def get_cache_connection():
+    '''Returns this thread's connection to the cache database, opening it
+    (and creating the cache table) the first time it is needed. If the
+    default cache's table is empty and the old music_cache.json exists,
+    it is imported once.
+
+    Parameters
+    ----------
+    None
+
+    Returns
+    -------
+    sqlite3.Connection
+    '''
+    connection = getattr(_local, "connection", None)
+    if connection is None:
+        connection = sqlite3.connect(CACHE_DB_NAME, timeout=30)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute(create_cache)
+        connection.commit()
+        _local.connection = connection
+        if CACHE_DB_NAME == DEFAULT_CACHE_DB_NAME and connection.execute("SELECT 1 FROM cache LIMIT 1").fetchone() is None:
+            import_json_cache()
+    return connection
+
+
+def construct_unique_key(baseurl, params):
+    ''' constructs a key that is guaranteed to uniquely and
+    repeatably identify an API request by its baseurl and params
+
+    Parameters
+    ----------
+    baseurl: string
+        The URL for the API endpoint
+    params: dict
+        A dictionary of param:value pairs
+
+    Returns
+    -------
+    string
+        the unique key as a string
+    '''
+    param_strings = []  #empty list to store parameter strings (unique keys)
+    connector = "_"
+    for key in params.keys(): #for key in key value pair
+        param_strings.append(f"{key}_{params[key]}") #adds key, value pair of each paramater as key_value
+    param_strings.sort() #sorts list so keys are in order
+    unique_key = baseurl + connector + connector.join(param_strings)
+    return unique_key
+
+
+def cache_lookup(unique_key):
+    '''Looks up a single cached API response, first in the in-process
+    MEMORY_CACHE and then in the cache table.
+
+    Parameters
+    ----------
+    unique_key: string
+        A key built by construct_unique_key (or a full request URL)
+
+    Returns
+    -------
+    dict
+        the cached response, or None if the key is not in the cache
+    '''
+    cached = MEMORY_CACHE.get(unique_key)
+    if cached is not None:
+        API_CACHE_LOOKUPS.inc(("memory",))
+        return cached
+    with phase("api_cache", "cache_lookup"):
+        connection = get_cache_connection()
+        row = connection.execute(select_cache, (unique_key,)).fetchone()
+        if row is None:
+            API_CACHE_LOOKUPS.inc(("miss",))
+            return None
+        response = json.loads(row[0])
+    API_CACHE_LOOKUPS.inc(("sqlite",))
+    MEMORY_CACHE.put(unique_key, response, len(row[0]))
+    return response
+
+
+def cache_save(unique_key, response):
+    '''Saves a single API response to the cache.
+
+    Parameters
+    ----------
+    unique_key: string
+        A key built by construct_unique_key (or a full request URL)
+    response: dict
+        The json data returned by the API
+
+    Returns
+    -------
+    None
+    '''
+    with phase("api_cache", "cache_save"):
+        response_text = json.dumps(response)
+        connection = get_cache_connection()
+        connection.execute(insert_cache, (unique_key, response_text))
+        connection.commit()
+    MEMORY_CACHE.put(unique_key, response, len(response_text))
+
+
+def cache_stats():
+    '''Returns the hit, miss and eviction counters of the in-process
+    memory cache.
+
+    Parameters
+    ----------
+    None
+
+    Returns
+    -------
+    dict
+    '''
+    return MEMORY_CACHE.stats()
+
+
+def import_json_cache(file_name=CACHE_FILE_NAME):
+    '''Copies every entry of an old whole-file JSON cache into the
+    cache table. Existing entries with the same key are overwritten.
+
+    Parameters
+    ----------
+    file_name: string
+        Path to the JSON cache file
+
+    Returns
+    -------
+    int
+        the number of entries imported
+    '''
+    if not os.path.exists(file_name):
+        return 0
+    with open(file_name, 'r') as cache_file:
+        old_cache = json.load(cache_file)
+    connection = get_cache_connection()
+    with connection:
+        connection.executemany(insert_cache, [(key, json.dumps(value)) for key, value in old_cache.items()])
+    return len(old_cache)
+
+
+if __name__ == "__main__":
+    count = import_json_cache()
+    print(f"Imported {count} entries from {CACHE_FILE_NAME} into {CACHE_DB_NAME}")
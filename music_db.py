@@ -0,0 +1,217 @@
+#### Read-only data access for music_flask_app.py
+#### Read-only connections to music.sqlite are kept open in a bounded pool
+#### and reused across requests instead of connecting on every request.
+#### A request checks one out the first time it needs it (get_db) and hands
+#### it back when its app context ends (release_db), so a server that runs
+#### each request on a new thread still reuses the same few connections.
+
+import os
+import queue
+import sqlite3
+import threading
+
+from flask import g, has_app_context
+
+# MUSIC_DB points the app at another database, e.g. one made by music_synthetic.py
+DATABASE_NAME = os.environ.get("MUSIC_DB", "music.sqlite")
+
+# immutable=1 skips all locking and change detection; only safe when nothing
+# writes music.sqlite while the app runs (e.g. a read-only deployment)
+DATABASE_IMMUTABLE = os.environ.get("MUSIC_DB_IMMUTABLE") == "1"
+
+STATEMENT_CACHE_SIZE = 256
+
+# most connections open at once; a request that finds them all in use
+# waits up to POOL_TIMEOUT seconds for one to come back
+POOL_SIZE = int(os.environ.get("MUSIC_DB_POOL_SIZE", 8))
+POOL_TIMEOUT = 30
+
+READ_PRAGMAS = [
+    "PRAGMA query_only=1",
+    "PRAGMA cache_size=-65536", # 64 MB of page cache per connection
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA temp_store=MEMORY",
+]
+
+# (sql, example parameters) compiled with EXPLAIN on every new connection,
+# so a query that doesn't fit the schema is reported when the connection
+# opens; see register_query
+REGISTERED_QUERIES = []
+
+
+def register_query(sql, example_params=()):
+    '''Adds a query to REGISTERED_QUERIES. The example parameters only
+    need to be valid for the query; it is compiled, never run.
+
+    Parameters
+    ----------
+    sql: string
+    example_params: tuple
+
+    Returns
+    -------
+    string
+        the sql, so a query constant can be registered where it is defined
+    '''
+    REGISTERED_QUERIES.append((sql, example_params))
+    return sql
+
+
+def open_connection():
+    '''Opens a read-only connection to DATABASE_NAME and checks that the
+    registered queries compile. EXPLAIN only prepares a query: running
+    them (e.g. a sorted query for a genre with no tracks, which walks a
+    whole index) would cost seconds on a big catalog. Each statement
+    enters the connection's statement cache on its first real use, and
+    the pool keeps the connection for later requests.
+
+    Parameters
+    ----------
+    None
+
+    Returns
+    -------
+    sqlite3.Connection
+    '''
+    uri = f"file:{os.path.abspath(DATABASE_NAME)}?mode=ro"
+    if DATABASE_IMMUTABLE:
+        uri += "&immutable=1"
+    connection = sqlite3.connect(uri, uri=True, cached_statements=STATEMENT_CACHE_SIZE, check_same_thread=False)
+    for pragma in READ_PRAGMAS:
+        connection.execute(pragma)
+    for sql, example_params in REGISTERED_QUERIES:
+        try:
+            connection.execute("EXPLAIN " + sql, example_params).fetchall()
+        except sqlite3.Error as error:
+            print(f"Could not prepare query: {error}")
+    return connection
+
+
+class ConnectionPool:
+    ''' At most `size` read-only connections, opened as they are needed.
+    Idle connections wait in a LIFO queue, so the most recently used one
+    (with the warmest page cache) is handed out first.
+
+    Instance attributes
+    -------------------
+    size: int
+
+    idle: queue.LifoQueue
+        connections not checked out
+
+    opened: int
+        connections open, idle or checked out
+
+    generation: int
+        goes up in close_all; connections from an older generation are
+        closed when they come back
+
+    '''
+    def __init__(self, size=POOL_SIZE):
+        self.size = size
+        self.idle = queue.LifoQueue()
+        self.opened = 0
+        self.generation = 0
+        self.lock = threading.Lock()
+
+    def checkout(self):
+        '''Returns (connection, generation): an idle connection, a new one
+        if fewer than size are open, or else the next one handed back.'''
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self.lock:
+            can_open = self.opened < self.size
+            if can_open:
+                self.opened += 1
+            generation = self.generation
+        if can_open:
+            try:
+                return open_connection(), generation
+            except Exception:
+                with self.lock:
+                    self.opened -= 1
+                raise
+        try:
+            return self.idle.get(timeout=POOL_TIMEOUT)
+        except queue.Empty:
+            raise RuntimeError(f"No database connection came free within {POOL_TIMEOUT} seconds") from None
+
+    def checkin(self, connection, generation):
+        '''Hands a connection back, rolling back any transaction left
+        open so the next request sees fresh data.'''
+        if generation != self.generation:
+            connection.close()
+            with self.lock:
+                self.opened -= 1
+            return
+        if connection.in_transaction:
+            connection.rollback()
+        self.idle.put((connection, generation))
+
+    def close_all(self):
+        '''Closes the idle connections; the ones checked out are closed
+        when they are handed back.'''
+        with self.lock:
+            self.generation += 1
+        while True:
+            try:
+                connection, _ = self.idle.get_nowait()
+            except queue.Empty:
+                break
+            connection.close()
+            with self.lock:
+                self.opened -= 1
+
+
+POOL = ConnectionPool()
+
+
+def get_db():
+    '''Returns the request's read-only connection, checking one out of
+    POOL the first time it is asked for. It stays on g until the app
+    context ends.
+
+    Parameters
+    ----------
+    None
+
+    Returns
+    -------
+    sqlite3.Connection
+    '''
+    if not has_app_context():
+        raise RuntimeError("get_db needs a Flask app context (with app.app_context(): ...)")
+    if "music_db" not in g:
+        g.music_db, g.music_db_generation = POOL.checkout()
+    return g.music_db
+
+
+def release_db(exception=None):
+    '''Hands the request's connection back to POOL at the end of the app
+    context. The connection stays open for the next request.'''
+    connection = g.pop("music_db", None)
+    generation = g.pop("music_db_generation", None)
+    if connection is not None:
+        POOL.checkin(connection, generation)
+
+
+def close_db():
+    '''Closes the pooled connections (e.g. after music.sqlite has been
+    replaced on disk, or DATABASE_NAME changed).'''
+    POOL.close_all()
+
+
+def init_app(app):
+    '''Registers release_db to run when each app context ends.
+
+    Parameters
+    ----------
+    app: flask.Flask
+
+    Returns
+    -------
+    None
+    '''
+    app.teardown_appcontext(release_db)
@@ -1,181 +1,360 @@
-from flask import Flask, render_template, request
-import sqlite3
-import requests
-import json
+from flask import Flask, render_template as flask_render_template, request, jsonify, make_response, abort
+import hashlib
 import random
-
-CACHE_DICT = {}
-CACHE_FILE_NAME = "music_cache.json"
-
-class MusicVideo:
-    ''' A Music Video
-
-    Instance attributes
-    -------------------
-    mvid_url (str): URL to YouTube video from The AudioDatabase API
-    
-    track_name (str): Name of track from The AudioDatabase API
-    
-    tadb_artist_id (str): Id of artist the The AudioDatabase API
-
-    '''
-    def __init__(self, mvid_url="None", track_name="None", tadb_artist_id="None"):
-        self.mvid_url = mvid_url
-        self.track_name = track_name
-        self.tadb_artist_id = tadb_artist_id
-
-    def info(self):
-        '''
-        Returns string literal of object instance.
-
-        Parameters
-        ----------
-        none
-
-        Returns
-        ----------
-        Object instance formatted as <track_name>, <tadb_artist_id> – <mvid_url>
-        '''
-        return f"{self.track_name}, {self.tadb_artist_id} – {self.mvid_url}"
-
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from urllib.parse import urlencode
+from music_cache import cache_stats, MemoryCache, MEMORY_CACHE
+from music_utils import remove_duplicates
+import music_db
+from music_db import get_db, register_query, init_app
+from music_videos import refresh_artist_videos, VIDEO_MAX_AGE
+from music_ranking import RankingEngine, RANKING_MODES
+from music_similarity import SimilarityIndex
+from music_schema import TRACK_COLUMNS, TRACKS_FIRST_JOINS, SORT_ORDERS
+from music_metrics import phase, timed, start_request, finish_request, render_metrics
+
+# the number of rows shown on the results page
+RESULTS_LIMIT = 11
+
+# rendered pages, keyed by route + parameters + database version
+RESPONSE_CACHE = MemoryCache(max_entries=1000, max_bytes=16 * 1024 * 1024, ttls={}, default_ttl=24 * 60 * 60)
+# how long browsers and proxies may reuse a page without asking again
+RESPONSE_MAX_AGE = 300
+
+# TheAudioDB lookups for artists music_videos.py hasn't reached yet run on
+# this pool; a request waits at most VIDEO_LOOKUP_DEADLINE seconds for one
+VIDEO_LOOKUP_WORKERS = 2
+VIDEO_LOOKUP_DEADLINE = 0.5
+# seconds before a lookup that couldn't reach TheAudioDB is tried again
+VIDEO_LOOKUP_RETRY_AFTER = 5 * 60
+
+# in-memory indexes built from music.sqlite: name -> (database version,
+# index), see load_for_database_version
+LOADED_INDEXES = {}
+LOADED_INDEXES_LOCK = threading.Lock()
+
+# the number of tracks /similar shows, and the most it may be asked for
+SIMILAR_TRACKS_LIMIT = 10
+SIMILAR_TRACKS_MAX = 50
+
+TRACKS_BY_GENRE_QUERY = TRACK_COLUMNS + '''
+    FROM artist_genres
+    JOIN artists
+    ON artist_genres.SpotifyArtistId=artists.SpotifyArtistId
+    JOIN tracks
+    ON tracks.SpotifyArtistId=artist_genres.SpotifyArtistId
+    JOIN features
+    ON tracks.SpotifyTrackId = features.SpotifyTrackId
+    WHERE artist_genres.Kind = 'bucket' AND artist_genres.Genre = ?
+'''
+register_query(TRACKS_BY_GENRE_QUERY, ("",))
+
+SORTED_TRACKS_QUERIES = {}
+for sort, (joins, order_by) in SORT_ORDERS.items():
+    SORTED_TRACKS_QUERIES[sort] = register_query(TRACK_COLUMNS + joins + f'''
+    ORDER BY {order_by}
+    LIMIT ?
+''', ("", RESULTS_LIMIT))
+
+TRACK_IDS_BY_GENRE_QUERY = register_query('''
+    SELECT tracks.TrackId FROM artist_genres
+    JOIN tracks
+    ON tracks.SpotifyArtistId=artist_genres.SpotifyArtistId
+    WHERE artist_genres.Kind = 'bucket' AND artist_genres.Genre = ?
+''', ("",))
+
+# two subqueries, so each is answered from one end of the rowid b-tree
+# (a single SELECT MIN(), MAX() scans the table)
+TRACK_ID_RANGE_QUERY = register_query('''
+    SELECT (SELECT MIN(TrackId) FROM tracks), (SELECT MAX(TrackId) FROM tracks)
+''', ())
+
+# random samples probe this many random TrackIds per track wanted, for at
+# most RANDOM_SAMPLE_ROUNDS rounds, before reading the genre's TrackIds
+RANDOM_SAMPLE_PROBES = 8
+RANDOM_SAMPLE_ROUNDS = 4
+
+# looks the given TrackIds up by rowid and keeps those in the genre
+def sampled_tracks_query(sample_size):
+    return TRACK_COLUMNS + TRACKS_FIRST_JOINS + f"    WHERE tracks.TrackId IN ({', '.join('?' * sample_size)})"
+
+register_query(sampled_tracks_query(RESULTS_LIMIT * RANDOM_SAMPLE_PROBES), ("",) + (0,) * (RESULTS_LIMIT * RANDOM_SAMPLE_PROBES))
+
+def ranked_tracks_query(track_count):
+    return TRACKS_BY_GENRE_QUERY + f" AND tracks.SpotifyTrackId IN ({', '.join('?' * track_count)})"
+
+register_query(ranked_tracks_query(RESULTS_LIMIT), ("",) * (RESULTS_LIMIT + 1))
+
+def tracks_by_id_query(track_count):
+    return TRACK_COLUMNS + f'''
+    FROM tracks
+    JOIN artists
+    ON tracks.SpotifyArtistId = artists.SpotifyArtistId
+    JOIN features
+    ON tracks.SpotifyTrackId = features.SpotifyTrackId
+    WHERE tracks.SpotifyTrackId IN ({', '.join('?' * track_count)})
+'''
+
+register_query(tracks_by_id_query(SIMILAR_TRACKS_LIMIT), ("",) * SIMILAR_TRACKS_LIMIT)
+
+LEADERBOARD_QUERY = register_query('''
+    SELECT TrackName, ArtistName, ArtistGenre, ImageUrl, AlbumName, Popularity, Tempo, Danceability, SpotifyTrackId FROM leaderboards
+    WHERE Genre = ? AND SortMode = ?
+    ORDER BY Rank
+    LIMIT ?
+''', ("", "", RESULTS_LIMIT))
+
+# a single probe of the unique tracks_spotify_track_id index, plus the
+# music video music_videos.py matched to the track, if any, and when the
+# artist's videos were last looked up (NULL: never)
+TRACK_BY_ID_QUERY = register_query('''
+    SELECT tracks.TrackName, tracks.ArtistName, tracks.SpotifyURL, music_videos.MusicVideoUrl, tracks.SpotifyArtistId, tadb_artists.FetchedAt FROM tracks
+    LEFT JOIN music_videos
+    ON music_videos.SpotifyTrackId = tracks.SpotifyTrackId
+    LEFT JOIN tadb_artists
+    ON tadb_artists.SpotifyArtistId = tracks.SpotifyArtistId
+    WHERE tracks.SpotifyTrackId = ?
+''', ("",))
+
+@timed("sqlite")
 def get_tracks_by_genre(genre):
     '''
     Constructs and executes SQL to retrieve all
-    tracks in a user-identified set of genres
+    tracks in a user-identified genre, looking the
+    genre up in the artist_genres index
 
     Parameters
     ----------
-    genre (list)
-        a list of genres selected by user
+    genre (str)
+        a genre bucket selected by user (e.g. "indie")
 
     Returns
     ----------
     list
         a list of songs in selected genres
     '''
-    connection = sqlite3.connect('music.sqlite')
-    cursor = connection.cursor()
-    query = '''
-        SELECT TrackName, tracks.ArtistName, artists.Genre, artists.ImageUrl, tracks.AlbumName, tracks.Popularity, features.Tempo, features.Danceability FROM tracks
-        JOIN artists
-        ON tracks.SpotifyArtistId=artists.SpotifyArtistId
-        JOIN features
-        ON tracks.SpotifyTrackId = features.SpotifyTrackId
-        WHERE artists.Genre LIKE ?
-    '''
+    cursor = get_db().cursor()
+    query = TRACKS_BY_GENRE_QUERY
     result = cursor.execute(query, (genre,)).fetchall()
-    connection.close()
     return result
 
-def get_spotify_player_url(track_name):
+@timed("sqlite")
+def get_track(spotify_track_id):
     '''
-    Constructs and executes SQL to retrieve Spotify URL
-    from tracks table in music.sqlite.
+    Looks a track and its music video up by the
+    track's Spotify ID (one probe of the unique
+    tracks_spotify_track_id index and one of the
+    music_videos primary key).
 
     Parameters
     ----------
-    track_name (str)
-        The name of a track
+    spotify_track_id (str)
+        the track's SpotifyTrackId
 
     Returns
     ----------
-    list
-        a list of tuples containing spotify player url
-    '''
-    connection = sqlite3.connect('music.sqlite')
-    cursor = connection.cursor()
-    query = '''
-    SELECT SpotifyURL FROM tracks
-    WHERE TrackName = ?
+    tuple
+        (TrackName, ArtistName, SpotifyURL, MusicVideoUrl,
+        SpotifyArtistId, FetchedAt), or None if there is
+        no such track; MusicVideoUrl is None if the track
+        has no music video, and FetchedAt is None if the
+        artist's videos were never looked up
     '''
-    result = cursor.execute(query, (track_name,)).fetchall()
-    connection.close()
+    cursor = get_db().cursor()
+    query = TRACK_BY_ID_QUERY
+    result = cursor.execute(query, (spotify_track_id,)).fetchone()
     return result
 
-def sort_by_danceability(tracks):
+@timed("sqlite")
+def get_top_tracks_by_genre(genre, sort, limit=RESULTS_LIMIT):
     '''
-    Sorts tracks by Spotify danceability assessment.
+    Constructs and executes SQL to retrieve the top
+    tracks in a genre for a sort mode. SQLite walks the
+    Popularity, Danceability or Tempo index and stops
+    once it has `limit` tracks in the genre, instead of
+    reading and sorting the whole genre. Sort modes in
+    RANKING_MODES are ranked by the RankingEngine;
+    unknown sort modes get a random sample.
 
     Parameters
     ----------
-    tracks (list)
-        a list of tracks (tuples) to be sorted
+    genre (str)
+        a genre bucket selected by user (e.g. "indie")
+    sort (str)
+        a key of SORT_ORDERS or RANKING_MODES, or anything
+        else for random
+    limit (int)
+        the number of tracks to return
 
     Returns
     ----------
     list
-        returns the sorted list
+        a list of songs (tuples) in the requested order
     '''
-    tracks.sort(key = lambda x: x[-1]) 
-    return tracks.reverse()
+    if sort in RANKING_MODES:
+        return get_ranked_tracks_by_genre(genre, RANKING_MODES[sort], limit)
+    if sort not in SORT_ORDERS:
+        return get_random_tracks_by_genre(genre, limit)
+    cursor = get_db().cursor()
+    query = SORTED_TRACKS_QUERIES[sort]
+    result = cursor.execute(query, (genre, limit)).fetchall()
+    return result
 
-def sort_by_slowest(tracks):
+def load_for_database_version(name, load):
     '''
-    Sorts tracks by Spotify speed, with slowest first.
+    Returns an in-memory index built from music.sqlite,
+    building it with load(connection) the first time and
+    again once requests_database.py has loaded new data.
 
     Parameters
     ----------
-    tracks (list)
-        a list of tracks (tuples) to be sorted
+    name (str)
+        identifies the index in LOADED_INDEXES
+    load (function)
+        builds the index from a sqlite3.Connection
 
     Returns
     ----------
-    list
-        returns the sorted list
+    the index
     '''
-    tracks.sort(key = lambda x: x[-2]) 
-    return tracks
-
-def sort_by_popularity(tracks):
+    version = get_database_version()
+    with LOADED_INDEXES_LOCK:
+        loaded = LOADED_INDEXES.get(name)
+        if loaded is None or loaded[0] != version:
+            with phase("index", name):
+                loaded = (version, load(get_db()))
+            LOADED_INDEXES[name] = loaded
+        return loaded[1]
+
+def get_ranking_engine():
+    return load_for_database_version("ranking", RankingEngine.load)
+
+def get_similarity_index():
+    return load_for_database_version("similarity", SimilarityIndex.load)
+
+def get_ranked_tracks_by_genre(genre, weights, limit=RESULTS_LIMIT):
     '''
-    Sorts tracks by Spotify popularity; most popular first
+    Ranks a genre by weighted audio features with the
+    RankingEngine, then reads the rows to show for the
+    winning tracks.
 
     Parameters
     ----------
-    tracks (list)
-        a list of tracks (tuples) to be sorted
+    genre (str)
+        a genre bucket selected by user (e.g. "indie")
+    weights (dict)
+        column name -> weight (see RANKING_MODES)
+    limit (int)
+        the number of tracks to return
 
     Returns
     ----------
     list
-        returns the sorted list
+        a list of songs (tuples), best first
+    '''
+    track_ids = get_ranking_engine().top(genre, weights, limit)
+    if len(track_ids) == 0:
+        return []
+    cursor = get_db().cursor()
+    rows = cursor.execute(ranked_tracks_query(len(track_ids)), [genre] + track_ids).fetchall()
+    rank = {track_id: i for i, track_id in enumerate(track_ids)}
+    return sorted(rows, key=lambda row: rank[row[-1]])
+
+@timed("sqlite")
+def get_similar_tracks(spotify_track_id, limit=SIMILAR_TRACKS_LIMIT):
     '''
-    tracks.sort(key = lambda x: x[-3]) 
-    return tracks.reverse()
+    Finds the tracks whose acousticness, danceability
+    and tempo are closest to a track's, using the
+    SimilarityIndex, then reads the rows to show.
+
+    Parameters
+    ----------
+    spotify_track_id (str)
+        the track's SpotifyTrackId
+    limit (int)
+        the number of tracks to return
 
-def sort_by_obscurity(tracks):
+    Returns
+    ----------
+    list
+        a list of songs (tuples), most similar first
+    '''
+    track_ids = [track_id for track_id, _ in get_similarity_index().similar(spotify_track_id, limit)]
+    if len(track_ids) == 0:
+        return []
+    cursor = get_db().cursor()
+    rows = cursor.execute(tracks_by_id_query(len(track_ids)), track_ids).fetchall()
+    rank = {track_id: i for i, track_id in enumerate(track_ids)}
+    return sorted(rows, key=lambda row: rank[row[-1]])
+
+@timed("sqlite")
+def get_leaderboard(genre, sort, limit=RESULTS_LIMIT):
     '''
-    Sorts tracks by Spotify popularity; least popular first
+    Reads the precomputed top tracks for a genre and
+    sort mode from the leaderboards table (a single
+    range read on its primary key).
 
     Parameters
     ----------
-    tracks (list)
-        a list of tracks (tuples) to be sorted
+    genre (str)
+        a genre bucket selected by user (e.g. "indie")
+    sort (str)
+        a key of SORT_ORDERS
+    limit (int)
+        the number of tracks to return
 
     Returns
     ----------
     list
-        returns the sorted list
+        a list of songs (tuples) in rank order; empty if
+        the leaderboard hasn't been built
     '''
-    tracks.sort(key = lambda x: x[-3]) 
-    return tracks
+    cursor = get_db().cursor()
+    result = cursor.execute(LEADERBOARD_QUERY, (genre, sort, limit)).fetchall()
+    return result
 
-def sort_random(tracks):
+def get_random_tracks_by_genre(genre, limit=RESULTS_LIMIT):
     '''
-    Sorts tracks randomly, using random module.
+    Picks a random sample of tracks in a genre. Random
+    TrackIds between the smallest and largest are looked
+    up by rowid, and those in the genre (with features)
+    are kept, so the cost doesn't grow with the genre.
+    Only if a few rounds of that come up short (a rare
+    genre, or a catalog full of gaps) are the genre's
+    TrackIds read and sampled instead.
 
     Parameters
     ----------
-    tracks (list)
-        a list of tracks (tuples) to be sorted
+    genre (str)
+        a genre bucket selected by user (e.g. "indie")
+    limit (int)
+        the number of tracks to return
 
     Returns
     ----------
     list
-        returns the sorted (shuffled) list
+        a list of songs (tuples) in random order
     '''
-    random.shuffle(tracks)
-    return tracks
+    cursor = get_db().cursor()
+    lowest, highest = cursor.execute(TRACK_ID_RANGE_QUERY).fetchone()
+    if lowest is None:
+        return []
+    found = {} # SpotifyTrackId -> row
+    id_range = range(lowest, highest + 1)
+    for _ in range(RANDOM_SAMPLE_ROUNDS):
+        probes = random.sample(id_range, min(limit * RANDOM_SAMPLE_PROBES, len(id_range)))
+        for row in cursor.execute(sampled_tracks_query(len(probes)), [genre] + probes):
+            found[row[-1]] = row
+        if len(found) >= limit:
+            return random.sample(list(found.values()), limit)
+    # tracks without features drop out of the join, so sample more ids than needed
+    track_ids = [row[0] for row in cursor.execute(TRACK_IDS_BY_GENRE_QUERY, (genre,))]
+    sample = random.sample(track_ids, min(limit * RANDOM_SAMPLE_PROBES, len(track_ids)))
+    for row in cursor.execute(sampled_tracks_query(len(sample)), [genre] + sample):
+        found[row[-1]] = row
+    return random.sample(list(found.values()), min(limit, len(found)))
 
 def filter_artists(track_list):
     '''
@@ -210,227 +389,278 @@ def remove_duplicate_artists(artists_list):
     list
         returns the sorted (shuffled) list
     '''
-    i = 0
-    while i < len(artists_list):
-      j = i + 1
-      while j < len(artists_list):
-         if artists_list[i] == artists_list[j]:
-            del artists_list[j]
-         else:
-            j += 1
-      i += 1
-
-def open_cache():
-    '''Opens the cache file if it exists and loads the JSON into
-    the CACHE_DICT dictionary. If the cache file doesn't exist, creates
-    a new cache dictionary
-    
-    Parameters
-    ----------
-    None
-    
-    Returns
-    -------
-    The loaded cache: dict
-    '''
-    try:
-        cache_file = open(CACHE_FILE_NAME, 'r')
-        cache_file_contents = cache_file.read()
-        cache = json.loads(cache_file_contents)
-        cache_file.close()
-    except:
-        cache = {}
-    return cache
+    remove_duplicates(artists_list)
 
-def save_cache(cache):
-    ''' Saves the current state of the cache to disk
+class VideoLookups:
+    ''' Runs TheAudioDB lookups for single artists in the background,
+    one at a time per artist.
 
-    Parameters
-    ----------
-    cache_dict: dict
-        The dictionary to save
+    Instance attributes
+    -------------------
+    executor: ThreadPoolExecutor
 
-    Returns
-    -------
-    None
-    '''
-    contents_to_write = json.dumps(cache)
-    cache_file = open(CACHE_FILE_NAME, 'w')
-    cache_file.write(contents_to_write)
-    cache_file.close()
-
-def construct_unique_key(baseurl, params):
-    ''' constructs a key that is guaranteed to uniquely and 
-    repeatably identify an API request by its baseurl and params
-    
-    Parameters
-    ----------
-    baseurl: string
-        The URL for the API endpoint
-    params: dict
-        A dictionary of param:value pairs
-    
-    Returns
-    -------
-    string
-        the unique key as a string
-    '''
-    param_strings = []  #empty list to store parameter strings (unique keys)
-    connector = "_"
-    for key in params.keys(): #for key in key value pair
-        param_strings.append(f"{key}_{params[key]}") #adds key, value pair of each paramater as key_value
-    param_strings.sort() #sorts list so keys are in order
-    unique_key = baseurl + connector + connector.join(param_strings)
-    return unique_key
-
-def make_artist_request(artist):
-    ''' gets a list of artists from The Audio Database API.
-    Uses cache if requests exists in cache.
+    in_flight: dict
+        SpotifyArtistId -> Future of the running lookup
 
-    Parameters
-    ----------
-    artist (str)
-        The name of an artist (leave spaces in)
+    failed_at: dict
+        SpotifyArtistId -> time.monotonic() of its last failed lookup,
+        for failures less than VIDEO_LOOKUP_RETRY_AFTER seconds old
 
-    Returns
-    -------
-    dict:
-        json formatted results from request
-    '''
-    CACHE_DICT = open_cache()
-    baseurl = "https://www.theaudiodb.com/api/v1/json/1/search.php"
-    params = {"s": artist}
-    unique_key = construct_unique_key(baseurl, params)
-    if (unique_key in CACHE_DICT.keys()):
-        return CACHE_DICT[unique_key]
-    else:
-        response = requests.get(baseurl, params=params)
-        CACHE_DICT[unique_key] = response.json()
-        save_cache(CACHE_DICT)
-        return CACHE_DICT[unique_key]
-
-def make_music_video_request(artist_id):
-    ''' gets music videos by a particular artist
+    '''
+    def __init__(self, max_workers=VIDEO_LOOKUP_WORKERS):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.in_flight = {}
+        self.failed_at = {}
+        self.lock = threading.Lock()
 
-    Parameters
-    ----------
-    artist (str)
-        TADB artist ID
+    def schedule(self, spotify_artist_id, artist_name, use_cache=True):
+        '''Starts a lookup unless one is running or the last one failed
+        less than VIDEO_LOOKUP_RETRY_AFTER seconds ago.
 
-    Returns
-    -------
-    dict:
-        json formatted results from request
-    '''
-    CACHE_DICT = open_cache()
-    baseurl = "https://theaudiodb.com/api/v1/json/1/mvid.php"
-    params = {"i": artist_id}
-    unique_key = construct_unique_key(baseurl, params)
-    if (unique_key in CACHE_DICT.keys()):
-        return CACHE_DICT[unique_key]
-    else: 
-        response = requests.get(baseurl, params=params)
-        CACHE_DICT[unique_key] = response.json()
-        save_cache(CACHE_DICT)
-        return CACHE_DICT[unique_key]
-
-def get_artist_tadb_id(artist):
-    ''' gets artist ID by using make_artists_request and 
-        parsing results.
+        Parameters
+        ----------
+        spotify_artist_id: string
+        artist_name: string
+        use_cache: bool
+            False to refresh a stale lookup
 
-    Parameters
-    ----------
-    artist (str)
-        The name of an artist (leave spaces in)
+        Returns
+        -------
+        Future
+            the lookup, or None if none was started
+        '''
+        if music_db.DATABASE_IMMUTABLE: # nothing may write music.sqlite
+            return None
+        with self.lock:
+            if spotify_artist_id in self.in_flight:
+                return self.in_flight[spotify_artist_id]
+            failed_at = self.failed_at.get(spotify_artist_id)
+            if failed_at is not None:
+                if time.monotonic() - failed_at < VIDEO_LOOKUP_RETRY_AFTER:
+                    return None
+                del self.failed_at[spotify_artist_id]
+            future = self.executor.submit(self.lookup, spotify_artist_id, artist_name, use_cache)
+            self.in_flight[spotify_artist_id] = future
+            return future
+
+    def lookup(self, spotify_artist_id, artist_name, use_cache):
+        try:
+            matched = refresh_artist_videos(music_db.DATABASE_NAME, spotify_artist_id, artist_name, use_cache)
+        except Exception as error:
+            print(f"Music video lookup for {artist_name} failed: {error}")
+            matched = None
+        with self.lock:
+            del self.in_flight[spotify_artist_id]
+            now = time.monotonic()
+            # drop failures old enough to retry, so failed_at stays bounded
+            for expired in [artist_id for artist_id, failed_at in self.failed_at.items() if now - failed_at >= VIDEO_LOOKUP_RETRY_AFTER]:
+                del self.failed_at[expired]
+            if matched is None:
+                self.failed_at[spotify_artist_id] = now
+            else:
+                self.failed_at.pop(spotify_artist_id, None)
+        return matched
+
+
+VIDEO_LOOKUPS = VideoLookups()
 
-    Returns
-    -------
-    list:
-        list of artists ids
-    '''
-    artist_id_list = []
-    results = make_artist_request(artist)
-    if results['artists'] != None:
-        artist_id = results['artists'][0]["idArtist"]
-        artist_id_list.append(artist_id)
-    else:
-        artist_id = "Unknown"
-    return artist_id_list
-
-def get_music_videos(artist_id):
-    ''' gets artist ID by using make_music_video request
-    and parsing results.
 
-    Parameters
-    ----------
-    artist (str)
-        artist id
+app = Flask(__name__)
+init_app(app)
 
-    Returns
-    -------
-    list:
-        list of MusicVideo objects
-    '''
-    mvid_objects_list = []
-    results = make_music_video_request(artist_id)
-    if results['mvids'] != None:
-        for i in range(len(results['mvids'])):
-            track_name = results['mvids'][i]['strTrack']
-            mvid_url = results['mvids'][i]['strMusicVid']
-            artist_id = artist_id
-            mvid_object = MusicVideo(mvid_url=mvid_url, track_name=track_name, tadb_artist_id=artist_id)
-            mvid_objects_list.append(mvid_object)
-    return mvid_objects_list
+@app.before_request
+def start_timing():
+    start_request()
+
+@app.after_request
+def finish_timing(response):
+    '''
+    Records the request in the latency histograms and
+    reports where its time went in a Server-Timing
+    header (e.g. "sqlite;dur=1.20, render;dur=0.85").
+    Phases can nest: building an index for a ranked
+    sort counts as both "index" and "sqlite".
+    '''
+    route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+    timings = finish_request(route, request.method, response.status_code)
+    if timings:
+        response.headers["Server-Timing"] = ", ".join(f"{name};dur={seconds * 1000:.2f}" for name, seconds in timings.items())
+    return response
 
+def render_template(template_name, **context):
+    '''
+    flask.render_template, timed as the "render" phase.
+    '''
+    with phase("render", template_name):
+        return flask_render_template(template_name, **context)
 
-app = Flask(__name__)
 @app.route('/')
 def index():
     return render_template("inputs.html")
 
-@app.route('/results', methods=['GET', 'POST'])
-def handle_the_form():
-    genre = '%' + request.form['genre'] + '%' 
-    sort = request.form['sort']
-    tracks = get_tracks_by_genre(genre)
-    if sort == "popularity":
-        sort_by_popularity(tracks)
-    elif sort == "obscurity":
-        sort_by_obscurity(tracks)
-    elif sort == "danceability":
-        sort_by_danceability(tracks)
-    elif sort == "speed (slow)": 
-        sort_by_slowest(tracks)
-    else:
-        sort_random(tracks)
+@timed("sqlite")
+def get_database_version():
+    '''
+    Reads the version stamp requests_database.py bumps
+    (PRAGMA user_version) every time it loads new data.
+
+    Returns
+    ----------
+    int
+    '''
+    return get_db().execute("PRAGMA user_version").fetchone()[0]
+
+def cached_response(cache_key, render_page):
+    '''
+    Serves a rendered page from RESPONSE_CACHE, rendering
+    it on a miss. Pages are cached under the key plus the
+    database version, so a data load retires them all. The
+    response carries an ETag and Cache-Control, and a GET
+    with a matching If-None-Match gets a 304.
+
+    Parameters
+    ----------
+    cache_key (str)
+        identifies the page, e.g. "/results?genre=pop&sort=popularity"
+    render_page (function)
+        returns (the page's HTML, whether it may be cached);
+        pages that may not are sent with no-store
+
+    Returns
+    ----------
+    flask.Response
+    '''
+    versioned_key = f"{cache_key}@{get_database_version()}"
+    entry = RESPONSE_CACHE.get(versioned_key)
+    if entry is None:
+        body, cacheable = render_page()
+        if not cacheable:
+            response = make_response(body)
+            response.headers["Cache-Control"] = "no-store"
+            return response
+        entry = (body, hashlib.sha1(body.encode("utf-8")).hexdigest())
+        RESPONSE_CACHE.put(versioned_key, entry, len(body))
+    body, etag = entry
+    response = make_response(body)
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = f"public, max-age={RESPONSE_MAX_AGE}"
+    return response.make_conditional(request)
+
+def render_results(genre, sort):
+    tracks = []
+    if sort in SORT_ORDERS:
+        tracks = get_leaderboard(genre, sort)
+    if len(tracks) == 0:
+        tracks = get_top_tracks_by_genre(genre, sort)
     return render_template('response.html', 
-        genre=genre.strip("%"),
+        genre=genre,
         sort = sort,
-        tracks=tracks[0:11],
+        tracks=tracks,
     )
 
-@app.route('/play-music', methods=['GET', 'POST'])
-def play_music():
-    selection = request.form['selection']
-    track_artist_list = selection.split("+")
-    track = track_artist_list[0]
-    artist = track_artist_list[1]
-    spotify_url = get_spotify_player_url(track)
-    spotify_url = spotify_url[0][0]
-    youtube_url = 'None'
-    artist_results = get_artist_tadb_id(artist)
-    if len(artist_results) > 0:
-        music_videos = get_music_videos(artist_results[0])
-        for music_video in music_videos:
-            if music_video.track_name in track:
-                youtube_url = music_video.mvid_url
-                break
-    return render_template("play-music.html",
+def render_play_music(spotify_track_id, track_row):
+    '''
+    Renders the player page from the stored track and
+    music video. If the artist's videos were never
+    looked up, a background lookup gets up to
+    VIDEO_LOOKUP_DEADLINE seconds before the page is
+    sent without the video; until a lookup has been
+    saved the page isn't cached, so a later request
+    picks the video up. If they were looked up
+    more than VIDEO_MAX_AGE ago, the stored video is
+    shown while a background lookup refreshes it.
+
+    Parameters
+    ----------
+    spotify_track_id (str)
+        the track's SpotifyTrackId
+    track_row (tuple)
+        the track as get_track returned it
+
+    Returns
+    ----------
+    tuple
+        (the page's HTML, whether it may be cached)
+    '''
+    track, artist, spotify_url, music_video_url, spotify_artist_id, fetched_at = track_row
+    video_pending = False
+    # the page is cached under fetched_at, so one that ran the first
+    # lookup itself isn't; the next request caches it under the new one
+    looked_up = fetched_at is not None or music_db.DATABASE_IMMUTABLE
+    if fetched_at is None:
+        lookup = VIDEO_LOOKUPS.schedule(spotify_artist_id, artist)
+        if lookup is not None:
+            try:
+                if lookup.result(timeout=VIDEO_LOOKUP_DEADLINE) is not None:
+                    music_video_url = get_track(spotify_track_id)[3]
+            except FutureTimeoutError:
+                video_pending = True
+    elif fetched_at < time.time() - VIDEO_MAX_AGE:
+        VIDEO_LOOKUPS.schedule(spotify_artist_id, artist, use_cache=False)
+    youtube_url = music_video_url or 'None'
+    page = render_template("play-music.html",
         spotify_url=spotify_url,
         youtube_url=youtube_url,
+        video_pending=video_pending,
+        spotify_track_id=spotify_track_id,
         track=track,
         artist=artist,
         )
+    return page, looked_up
+
+@app.route('/results', methods=['GET', 'POST'])
+def handle_the_form():
+    genre = request.values['genre']
+    sort = request.values['sort']
+    if sort not in SORT_ORDERS and sort not in RANKING_MODES: # random: different every time
+        response = make_response(render_results(genre, sort))
+        response.headers["Cache-Control"] = "no-store"
+        return response
+    cache_key = "/results?" + urlencode({"genre": genre, "sort": sort})
+    return cached_response(cache_key, lambda: (render_results(genre, sort), True))
+
+@app.route('/play-music', methods=['GET', 'POST'])
+def play_music():
+    spotify_track_id = request.values['track']
+    track_row = get_track(spotify_track_id)
+    if track_row is None:
+        abort(404)
+    # a lookup that saves the artist's videos changes their FetchedAt,
+    # which retires the cached pages of that artist's tracks alone
+    cache_key = "/play-music?" + urlencode({"track": spotify_track_id, "videos": track_row[5]})
+    return cached_response(cache_key, lambda: render_play_music(spotify_track_id, track_row))
+
+def render_similar(spotify_track_id, limit):
+    track_row = get_track(spotify_track_id)
+    if track_row is None:
+        abort(404)
+    return render_template('similar.html',
+        track=track_row[0],
+        artist=track_row[1],
+        tracks=get_similar_tracks(spotify_track_id, limit),
+    )
+
+@app.route('/similar')
+def similar_tracks():
+    spotify_track_id = request.values['track']
+    limit = min(max(request.values.get('k', SIMILAR_TRACKS_LIMIT, type=int), 1), SIMILAR_TRACKS_MAX)
+    cache_key = "/similar?" + urlencode({"track": spotify_track_id, "k": limit})
+    return cached_response(cache_key, lambda: (render_similar(spotify_track_id, limit), True))
+
+@app.route('/cache-stats')
+def show_cache_stats():
+    return jsonify({"api_cache": cache_stats(), "response_cache": RESPONSE_CACHE.stats()})
+
+@app.route('/metrics')
+def show_metrics():
+    '''
+    The request and phase latency histograms, API cache
+    lookups, outbound API calls and in-memory cache
+    figures, in the Prometheus text format.
+    '''
+    response = make_response(render_metrics({"api_cache": MEMORY_CACHE, "response_cache": RESPONSE_CACHE}))
+    response.headers["Content-Type"] = "text/plain; version=0.0.4; charset=utf-8"
+    return response
 
 if __name__ == "__main__":
     app.run(debug=True) 
\ No newline at end of file
@@ -0,0 +1,397 @@
+#### Outbound HTTP for the music app
+#### Every API call goes through http_get(), which sends it on a pooled
+#### keep-alive session for its host, waits on a per-host token bucket and
+#### retries 429 responses after their Retry-After delay.
+#### SpotifyClient fetches and refreshes the Spotify access token lazily.
+#### run_concurrently() and stream_concurrently() run independent calls on a
+#### bounded thread pool.
+#### For offline runs, MUSIC_API_STAND_IN sends every call to a local stand-in
+#### server and MUSIC_API_REPLAY answers them in process from a recording
+#### (see music_replay.py).
+
+import os
+import threading
+import time
+import queue
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+from music_metrics import phase, OUTBOUND_REQUESTS
+
+# size of the worker pool used by run_concurrently
+MAX_WORKERS = int(os.environ.get("MUSIC_MAX_WORKERS", 8))
+
+# keep-alive connections kept open per host
+POOL_SIZE = MAX_WORKERS
+
+# host -> (requests per second, burst size)
+RATE_LIMITS = {
+    "api.spotify.com": (10.0, 10),
+    "accounts.spotify.com": (1.0, 2),
+    "theaudiodb.com": (2.0, 2),
+    "www.theaudiodb.com": (2.0, 2),
+}
+DEFAULT_RATE_LIMIT = (5.0, 5)
+
+REQUEST_TIMEOUT = 10 # seconds
+MAX_RETRIES = 5
+DEFAULT_RETRY_AFTER = 1 # seconds, used when a 429 has no Retry-After header
+
+# base URL of a local stand-in for the APIs, e.g. http://127.0.0.1:8765; a
+# call to https://api.spotify.com/v1/x then goes to
+# http://127.0.0.1:8765/api.spotify.com/v1/x
+API_STAND_IN_URL = os.environ.get("MUSIC_API_STAND_IN")
+# a recorded API cache (music_cache.sqlite or music_cache.json) to answer
+# calls from in process, without any sockets
+API_REPLAY_RECORDING = os.environ.get("MUSIC_API_REPLAY")
+
+SPOTIFY_TOKEN_URL = "https://accounts.spotify.com/api/token"
+TOKEN_REFRESH_MARGIN = 60 # seconds before expiry at which the token is renewed
+
+
+class TransportError(Exception):
+    '''Raised by send_request when a call gets no response at all
+    (connection error, timeout, ...), so callers can catch it without
+    importing requests.'''
+
+
+class TokenBucket:
+    ''' A thread-safe token bucket rate limiter
+
+    Instance attributes
+    -------------------
+    rate: float
+        tokens added per second
+
+    capacity: int
+        the most tokens the bucket can hold (the allowed burst)
+
+    tokens: float
+
+    '''
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        '''Blocks until a token is available, then takes it.'''
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        '''Empties the bucket so no request is let through for the next
+        `seconds` seconds (used when the host answers 429). Overlapping
+        pauses don't add up: several workers rate limited at once keep
+        the host paused until the latest deadline, not the sum.'''
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            self.tokens = min(self.tokens, -seconds * self.rate)
+
+
+_rate_limiters = {}
+_rate_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(host):
+    '''Returns the shared TokenBucket for a host, creating it from
+    RATE_LIMITS the first time.
+
+    Parameters
+    ----------
+    host: string
+
+    Returns
+    -------
+    TokenBucket
+    '''
+    with _rate_limiters_lock:
+        if host not in _rate_limiters:
+            rate, capacity = RATE_LIMITS.get(host, DEFAULT_RATE_LIMIT)
+            _rate_limiters[host] = TokenBucket(rate, capacity)
+        return _rate_limiters[host]
+
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def get_session(host):
+    '''Returns the shared keep-alive session for a host, creating it (with
+    a connection pool of POOL_SIZE) the first time.
+
+    Parameters
+    ----------
+    host: string
+
+    Returns
+    -------
+    requests.Session
+    '''
+    # requests is imported on first use, so importing this module stays cheap
+    import requests
+    from requests.adapters import HTTPAdapter
+    with _sessions_lock:
+        if host not in _sessions:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _sessions[host] = session
+        return _sessions[host]
+
+
+_replay_store = None
+_replay_store_lock = threading.Lock()
+
+
+def route_url(url):
+    '''Returns the URL a call to an API URL is actually sent to: the URL
+    itself, or its path on the stand-in named by API_STAND_IN_URL.'''
+    if not API_STAND_IN_URL:
+        return url
+    parsed = urlparse(url)
+    routed = f"{API_STAND_IN_URL.rstrip('/')}/{parsed.netloc}{parsed.path}"
+    return routed + ("?" + parsed.query if parsed.query else "")
+
+
+def send_request(method, url, params=None, headers=None, data=None):
+    '''Sends one request on the host's pooled session, or answers it from
+    the API_REPLAY_RECORDING if one is configured.
+
+    Parameters
+    ----------
+    method: string
+    url: string
+        the real API URL (cache keys and rate limits use it)
+    params: dict
+    headers: dict
+    data: dict
+
+    Returns
+    -------
+    requests.Response
+
+    Raises
+    ------
+    TransportError
+        if no response came back
+    '''
+    global _replay_store
+    host = urlparse(url).hostname
+    status = "error" # unless a response comes back
+    try:
+        with phase("http", host):
+            if API_REPLAY_RECORDING:
+                from music_replay import ReplayStore, make_response
+                with _replay_store_lock:
+                    if _replay_store is None:
+                        _replay_store = ReplayStore(API_REPLAY_RECORDING)
+                replay_status, payload = _replay_store.respond(method, url, params)
+                response = make_response(url, replay_status, payload)
+            else:
+                session = get_session(host)
+                import requests
+                try:
+                    response = session.request(method, route_url(url), params=params, headers=headers, data=data, timeout=REQUEST_TIMEOUT)
+                except requests.RequestException as error:
+                    raise TransportError(f"{method} {url}: {error}") from error
+        status = str(response.status_code)
+        return response
+    finally:
+        OUTBOUND_REQUESTS.inc((host, method, status))
+
+
+def retry_after_seconds(response, attempt):
+    '''Reads the Retry-After header of a 429 response, falling back to
+    exponential backoff if it is missing or not a number of seconds.'''
+    try:
+        return max(float(response.headers["Retry-After"]), 0)
+    except (KeyError, ValueError):
+        return DEFAULT_RETRY_AFTER * (2 ** attempt)
+
+
+def http_get(url, params=None, headers=None):
+    '''Sends a rate-limited GET request, retrying when the API answers
+    429 Too Many Requests.
+
+    Parameters
+    ----------
+    url: string
+    params: dict
+    headers: dict
+
+    Returns
+    -------
+    requests.Response
+    '''
+    host = urlparse(url).hostname
+    limiter = get_rate_limiter(host)
+    for attempt in range(MAX_RETRIES + 1):
+        limiter.acquire()
+        response = send_request("GET", url, params=params, headers=headers)
+        if response.status_code != 429 or attempt == MAX_RETRIES:
+            return response
+        wait = retry_after_seconds(response, attempt)
+        print(f"Rate limited by {host}, retrying in {wait}s")
+        limiter.pause(wait)
+    return response
+
+
+class SpotifyClient:
+    ''' Sends authorized requests to the Spotify Web API. The client
+    credentials token is requested the first time it is needed and renewed
+    shortly before it expires, or when Spotify answers 401.
+
+    Instance attributes
+    -------------------
+    client_id: string
+
+    client_secret: string
+
+    access_token: string
+        None until the first request
+
+    expires_at: float
+        time.monotonic() value after which the token is no longer valid
+
+    '''
+    def __init__(self, client_id, client_secret):
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.access_token = None
+        self.expires_at = 0.0
+        self.lock = threading.Lock()
+
+    def refresh_token(self):
+        data = {'client_id' : self.client_id,
+                'client_secret' : self.client_secret,
+                'grant_type' : 'client_credentials'
+                }
+        get_rate_limiter(urlparse(SPOTIFY_TOKEN_URL).hostname).acquire()
+        auth_response = send_request("POST", SPOTIFY_TOKEN_URL, data=data)
+        auth_response.raise_for_status()
+        auth_response_data = auth_response.json()
+        self.access_token = auth_response_data['access_token']
+        self.expires_at = time.monotonic() + auth_response_data.get('expires_in', 3600)
+
+    def get_headers(self, force_refresh=False):
+        with self.lock:
+            if force_refresh or self.access_token is None or time.monotonic() > self.expires_at - TOKEN_REFRESH_MARGIN:
+                self.refresh_token()
+            return {'Authorization': 'Bearer {token}'.format(token=self.access_token)}
+
+    def get(self, url, params=None):
+        '''Sends an authorized GET through http_get, renewing the token and
+        retrying once if it was rejected.
+
+        Parameters
+        ----------
+        url: string
+        params: dict
+
+        Returns
+        -------
+        requests.Response
+        '''
+        response = http_get(url, params, headers=self.get_headers())
+        if response.status_code == 401:
+            response = http_get(url, params, headers=self.get_headers(force_refresh=True))
+        return response
+
+
+def run_concurrently(function, items, max_workers=MAX_WORKERS):
+    '''Calls function(item) for every item on a bounded thread pool.
+
+    Parameters
+    ----------
+    function: callable
+    items: list
+    max_workers: int
+        The most calls allowed in flight at once
+
+    Returns
+    -------
+    list
+        the results, in the same order as items
+    '''
+    items = list(items)
+    if len(items) <= 1 or max_workers <= 1:
+        return [function(item) for item in items]
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(items))) as executor:
+        return list(executor.map(function, items))
+
+
+def stream_concurrently(function, items, max_workers=MAX_WORKERS, max_buffered=None):
+    '''Calls function(item) for every item on a bounded thread pool, where
+    each call returns an iterable (usually a generator), and yields what
+    those iterables produce as soon as it is ready. At most max_buffered
+    values wait to be consumed, so memory stays flat however much the
+    iterables produce.
+
+    Parameters
+    ----------
+    function: callable
+    items: list
+    max_workers: int
+        The most iterables consumed at once
+    max_buffered: int
+        The most values held before producers wait (default 2 * max_workers)
+
+    Returns
+    -------
+    generator
+        values in the order they were produced
+    '''
+    items = list(items)
+    if max_buffered is None:
+        max_buffered = 2 * max_workers
+    buffer = queue.Queue(maxsize=max_buffered)
+    finished = object()
+    stop = threading.Event()
+
+    def produce(item):
+        try:
+            if stop.is_set():
+                return
+            for value in function(item):
+                if stop.is_set():
+                    return
+                buffer.put((value, None))
+        except BaseException as error:
+            buffer.put((None, error))
+        finally:
+            buffer.put((finished, None))
+
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(items)))) as executor:
+        for item in items:
+            executor.submit(produce, item)
+        remaining = len(items)
+        try:
+            while remaining > 0:
+                value, error = buffer.get()
+                if error is not None:
+                    raise error
+                if value is finished:
+                    remaining -= 1
+                else:
+                    yield value
+        finally:
+            # let blocked producers finish if the consumer stops early
+            stop.set()
+            while remaining > 0:
+                value, _ = buffer.get()
+                if value is finished:
+                    remaining -= 1
@@ -0,0 +1,86 @@
+#### Precomputed /results leaderboards
+#### The top LEADERBOARD_SIZE tracks of every (genre bucket, sort mode) are
+#### kept in the leaderboards table, so /results is one range read on its
+#### primary key instead of a join over tracks, artists and features.
+
+from music_schema import TRACK_COLUMNS, SORT_ORDERS, insert_leaderboards
+
+LEADERBOARD_SIZE = 50
+
+select_genres = '''
+    SELECT DISTINCT Genre FROM artist_genres
+    WHERE Kind = 'bucket'
+'''
+
+select_leaderboard = '''
+    SELECT Rank, TrackName, ArtistName, ArtistGenre, ImageUrl, AlbumName, Popularity, Tempo, Danceability, SpotifyTrackId FROM leaderboards
+    WHERE Genre = ? AND SortMode = ?
+    ORDER BY Rank
+'''
+
+delete_leaderboard = '''
+    DELETE FROM leaderboards
+    WHERE Genre = ? AND SortMode = ?
+'''
+
+delete_other_genres = '''
+    DELETE FROM leaderboards
+    WHERE Genre NOT IN (SELECT Genre FROM artist_genres WHERE Kind = 'bucket')
+'''
+
+
+def compute_leaderboard(connection, genre, sort):
+    '''Runs the indexed ORDER BY ... LIMIT query for one leaderboard.
+
+    Parameters
+    ----------
+    connection: sqlite3.Connection
+    genre: string
+        a genre bucket
+    sort: string
+        a key of SORT_ORDERS
+
+    Returns
+    -------
+    list
+        (Rank, TrackName, ..., Danceability, SpotifyTrackId) tuples
+    '''
+    joins, order_by = SORT_ORDERS[sort]
+    query = TRACK_COLUMNS + joins + f'''
+        ORDER BY {order_by}
+        LIMIT ?
+    '''
+    rows = connection.execute(query, (genre, LEADERBOARD_SIZE)).fetchall()
+    return [(rank,) + row for rank, row in enumerate(rows, start=1)]
+
+
+def refresh_leaderboards(connection):
+    '''Recomputes every leaderboard and rewrites the ones that changed, all
+    in one transaction, so readers see either the old or the new
+    leaderboards and never a half-built table. Each recompute reads at
+    most LEADERBOARD_SIZE rows through the sort indexes, so a refresh costs
+    the same however big the catalog is.
+
+    Parameters
+    ----------
+    connection: sqlite3.Connection
+
+    Returns
+    -------
+    int
+        the number of (genre, sort mode) leaderboards rewritten
+    '''
+    rewritten = 0
+    with connection:
+        genres = [row[0] for row in connection.execute(select_genres)]
+        for genre in genres:
+            for sort in SORT_ORDERS:
+                new_rows = compute_leaderboard(connection, genre, sort)
+                old_rows = connection.execute(select_leaderboard, (genre, sort)).fetchall()
+                if new_rows == old_rows:
+                    continue
+                connection.execute(delete_leaderboard, (genre, sort))
+                connection.executemany(insert_leaderboards, [(genre, sort) + row for row in new_rows])
+                rewritten += 1
+        connection.execute(delete_other_genres)
+    return rewritten
@@ -0,0 +1,254 @@
+#### Request timing and Prometheus metrics
+#### phase() and timed() record how long each phase of serving a request
+#### takes (SQLite queries, API cache lookups, outbound HTTP calls, template
+#### rendering) in latency histograms, and counters track API cache hits and
+#### outbound calls. render_metrics() writes everything out in the
+#### Prometheus text format for the app's /metrics endpoint. Between
+#### start_request() and finish_request() the time of each phase is also
+#### added up per request, for the Server-Timing header.
+
+import functools
+import threading
+import time
+from contextlib import contextmanager
+
+# upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_local = threading.local()
+
+
+def format_labels(label_names, labels):
+    '''Returns labels as {name="value",...}, escaped as Prometheus expects.'''
+    if not label_names:
+        return ""
+    pairs = []
+    for name, value in zip(label_names, labels):
+        value = str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+class Counter:
+    ''' A Prometheus counter with labels.
+
+    Instance attributes
+    -------------------
+    name: string
+
+    help_text: string
+
+    label_names: tuple
+
+    values: dict
+        label values (tuple) -> count
+
+    '''
+    def __init__(self, name, help_text, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, labels=(), amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def get(self, labels=()):
+        return self.values.get(labels, 0)
+
+    def lines(self):
+        yield f"# HELP {self.name} {self.help_text}"
+        yield f"# TYPE {self.name} counter"
+        with self.lock:
+            values = sorted(self.values.items())
+        for labels, value in values:
+            yield f"{self.name}{format_labels(self.label_names, labels)} {value}"
+
+
+class Histogram:
+    ''' A Prometheus histogram with labels: per label set, the number of
+    observations at or below each bucket's upper bound, their sum and
+    their count.
+
+    Instance attributes
+    -------------------
+    name: string
+
+    help_text: string
+
+    label_names: tuple
+
+    buckets: tuple
+        upper bounds, ascending
+
+    series: dict
+        label values (tuple) -> [bucket counts, sum, count]
+
+    '''
+    def __init__(self, name, help_text, label_names=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, labels, value):
+        with self.lock:
+            series = self.series.get(labels)
+            if series is None:
+                series = [[0] * len(self.buckets), 0.0, 0]
+                self.series[labels] = series
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+                    break
+            series[1] += value
+            series[2] += 1
+
+    def lines(self):
+        yield f"# HELP {self.name} {self.help_text}"
+        yield f"# TYPE {self.name} histogram"
+        with self.lock:
+            series = sorted((labels, (list(counts), total, count)) for labels, (counts, total, count) in self.series.items())
+        names = self.label_names + ("le",)
+        for labels, (counts, total, count) in series:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                yield f"{self.name}_bucket{format_labels(names, labels + (repr(bound),))} {cumulative}"
+            yield f"{self.name}_bucket{format_labels(names, labels + ('+Inf',))} {count}"
+            yield f"{self.name}_sum{format_labels(self.label_names, labels)} {total}"
+            yield f"{self.name}_count{format_labels(self.label_names, labels)} {count}"
+
+
+REQUEST_DURATION = Histogram("music_request_duration_seconds",
+    "Time to answer a request", ("route", "method", "status"))
+PHASE_DURATION = Histogram("music_phase_duration_seconds",
+    "Time spent in one phase of serving a request (sqlite, index, api_cache, http, render)", ("phase", "operation"))
+API_CACHE_LOOKUPS = Counter("music_api_cache_lookups_total",
+    "API cache lookups by where the answer came from (memory, sqlite or miss)", ("result",))
+OUTBOUND_REQUESTS = Counter("music_outbound_requests_total",
+    "Calls to Spotify and TheAudioDB by host, method and HTTP status (error: no response)", ("host", "method", "status"))
+
+METRICS = [REQUEST_DURATION, PHASE_DURATION, API_CACHE_LOOKUPS, OUTBOUND_REQUESTS]
+
+
+@contextmanager
+def phase(name, operation):
+    '''Times the body of a with statement as one phase.
+
+    Parameters
+    ----------
+    name: string
+        the kind of work, e.g. "sqlite" or "render"
+    operation: string
+        what exactly, e.g. "get_tracks_by_genre" or a template name
+
+    Returns
+    -------
+    context manager
+    '''
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        PHASE_DURATION.observe((name, operation), seconds)
+        totals = getattr(_local, "phase_totals", None)
+        if totals is not None:
+            totals[name] = totals.get(name, 0.0) + seconds
+
+
+def timed(name, operation=None):
+    '''Decorator that times every call of a function as a phase (the
+    operation defaults to the function's name).'''
+    def decorate(function):
+        label = operation or function.__name__
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with phase(name, label):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def start_request():
+    '''Starts adding up this thread's phase times for a new request.'''
+    _local.phase_totals = {}
+    _local.request_start = time.perf_counter()
+
+
+def finish_request(route, method, status):
+    '''Records the request's duration and stops adding up phase times.
+
+    Parameters
+    ----------
+    route: string
+        the matched URL rule (e.g. "/results"), not the full URL, so
+        the number of series stays bounded
+    method: string
+    status: int
+
+    Returns
+    -------
+    dict
+        phase name -> seconds spent in it during the request, plus
+        "total"; empty if start_request wasn't called
+    '''
+    start = getattr(_local, "request_start", None)
+    totals = getattr(_local, "phase_totals", None) or {}
+    _local.phase_totals = None
+    _local.request_start = None
+    if start is None:
+        return {}
+    totals["total"] = time.perf_counter() - start
+    REQUEST_DURATION.observe((route, method, str(status)), totals["total"])
+    return totals
+
+
+def cache_lines(caches):
+    '''Hit, miss and size figures of MemoryCache objects, by cache name.'''
+    figures = [
+        ("music_cache_hits_total", "counter", "Lookups answered by an in-memory cache", "hits"),
+        ("music_cache_misses_total", "counter", "Lookups an in-memory cache could not answer", "misses"),
+        ("music_cache_evictions_total", "counter", "Entries evicted to stay within an in-memory cache's limits", "evictions"),
+        ("music_cache_hit_ratio", "gauge", "hits / (hits + misses) of an in-memory cache", "hit_ratio"),
+        ("music_cache_entries", "gauge", "Entries held by an in-memory cache", "entries"),
+        ("music_cache_bytes", "gauge", "Bytes held by an in-memory cache", "bytes"),
+    ]
+    stats = {name: cache.stats() for name, cache in caches.items()}
+    for metric, kind, help_text, key in figures:
+        yield f"# HELP {metric} {help_text}"
+        yield f"# TYPE {metric} {kind}"
+        for name, cache_stats in stats.items():
+            yield f"{metric}{format_labels(('cache',), (name,))} {cache_stats[key]}"
+
+
+def render_metrics(caches=None):
+    '''Writes every metric in the Prometheus text exposition format.
+
+    Parameters
+    ----------
+    caches: dict
+        name -> MemoryCache, whose stats are included
+
+    Returns
+    -------
+    string
+    '''
+    lines = []
+    for metric in METRICS:
+        lines += metric.lines()
+    hits = API_CACHE_LOOKUPS.get(("memory",)) + API_CACHE_LOOKUPS.get(("sqlite",))
+    lookups = hits + API_CACHE_LOOKUPS.get(("miss",))
+    lines += [
+        "# HELP music_api_cache_hit_ratio Share of API cache lookups answered from memory or music_cache.sqlite",
+        "# TYPE music_api_cache_hit_ratio gauge",
+        f"music_api_cache_hit_ratio {hits / lookups if lookups else 0.0}",
+    ]
+    if caches:
+        lines += cache_lines(caches)
+    return "\n".join(lines) + "\n"
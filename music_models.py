@@ -0,0 +1,100 @@
+#### Domain models built by requests_database.py
+#### The classes use __slots__, so an instance holds its attributes without a
+#### per-object __dict__. Strings that repeat across many objects (artist,
+#### album and genre names, artist IDs) are interned, so a big catalog keeps
+#### one copy of each instead of one per track.
+
+from music_utils import intern_string
+
+
+class Track:
+    ''' A music track
+
+    Instance attributes
+    -------------------
+    genre: list
+
+    track_name: string
+
+    spotify_track_id: string
+
+    track_popularity: integer
+
+    artist_name: string
+
+    album_name: string
+
+    spotify_url: string
+
+    spotify_preview: string
+
+    # danceability: int
+
+    # tempo: int
+
+    # acousticness: int
+
+    # music_video: string
+
+    '''
+    __slots__ = ("genre", "track_name", "spotify_track_id", "track_popularity", "artist_name",
+        "album_name", "spotify_url", "preview", "spotify_artist_id", "popularity")
+
+    def __init__(self, genre="Unknown", track_name="Unknown track", spotify_track_id="None", track_popularity=0, artist_name="Unknown Artist", album_name="Unknown Album", spotify_url="Unknown", preview="Not available", spotify_artist_id="Unknown", popularity=0):
+        self.genre = intern_string(genre)
+        self.track_name = track_name
+        self.spotify_track_id = spotify_track_id
+        self.track_popularity = track_popularity
+        self.artist_name = intern_string(artist_name)
+        self.album_name = intern_string(album_name)
+        self.spotify_url = spotify_url
+        self.preview = preview
+        self.spotify_artist_id = intern_string(spotify_artist_id)
+        self.popularity = popularity
+
+    def info(self):
+        return f"{self.track_name} ({self.album_name}) by {self.artist_name} – {self.popularity}"
+
+class Artist:
+    ''' A spotify artist
+
+    Instance attributes
+    -------------------
+    genre: list
+
+    artist_name: string
+
+    spotify_artist_id: string
+
+    artist_name: string
+
+    image_url: string
+
+    spotify_genres: list
+        every genre Spotify lists for the artist (genre is later
+        replaced by a single bucket in map_genres)
+
+    '''
+    __slots__ = ("genre", "artist_name", "spotify_artist_id", "image_url", "spotify_genres")
+
+    def __init__(self, genre="Unknown", artist_name="Unknown Artist", spotify_artist_id="Unknown", image_url="Unknown", spotify_genres=None):
+        self.genre = intern_string(genre)
+        self.artist_name = intern_string(artist_name)
+        self.spotify_artist_id = intern_string(spotify_artist_id)
+        self.image_url = image_url
+        self.spotify_genres = [intern_string(spotify_genre) for spotify_genre in spotify_genres] if spotify_genres is not None else []
+
+    def info(self):
+        return f"{self.artist_name} ({self.spotify_artist_id})"
+
+class TrackFeatureProfile:
+    __slots__ = ("spotify_track_id", "acousticness", "danceability", "tempo")
+
+    def __init__(self, spotify_track_id="Unknown", acousticness=0.0, danceability=0.0, tempo=0.0):
+        self.spotify_track_id = spotify_track_id
+        self.acousticness = acousticness
+        self.danceability = danceability
+        self.tempo = tempo
+
+    def info(self):
+        return f"SpotifyID{self.spotify_track_id}, Acousticness: {self.acousticness}, Dancesability: {self.danceability}, tempo: {self.tempo}"
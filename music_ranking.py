@@ -0,0 +1,141 @@
+#### Vectorized multi-criteria ranking for /results
+#### RankingEngine loads the numeric track and feature columns of every
+#### genre bucket into NumPy arrays once, scales each column to 0-1 and
+#### ranks a genre by a weighted sum of the scaled columns in one pass,
+#### picking the top N with argpartition instead of sorting the genre.
+
+import numpy as np
+
+from music_features import FeatureColumns, NUMERIC_COLUMNS
+
+# sort mode -> column weights; a negative weight prefers low values
+RANKING_MODES = {
+    "danceable but obscure": {"danceability": 1.0, "popularity": -1.0},
+    "slow and acoustic": {"tempo": -1.0, "acousticness": 1.0},
+    "fast and electric": {"tempo": 1.0, "acousticness": -1.0},
+    "popular and danceable": {"popularity": 1.0, "danceability": 1.0},
+}
+
+select_ranking_rows = '''
+    SELECT tracks.SpotifyTrackId, tracks.Popularity, features.Acousticness, features.Danceability, features.Tempo, artist_genres.Genre FROM artist_genres
+    JOIN tracks
+    ON tracks.SpotifyArtistId = artist_genres.SpotifyArtistId
+    JOIN features
+    ON features.SpotifyTrackId = tracks.SpotifyTrackId
+    WHERE artist_genres.Kind = 'bucket'
+'''
+
+
+def scale_column(values):
+    '''Scales an array linearly to 0-1 (all zeros if it is constant).'''
+    values = values.astype(np.float32)
+    low = values.min() if len(values) else 0.0
+    spread = (values.max() - low) if len(values) else 0.0
+    if spread == 0:
+        return np.zeros_like(values)
+    return (values - low) / spread
+
+
+class RankingEngine:
+    ''' Ranks the tracks of a genre bucket by weighted audio features.
+
+    Instance attributes
+    -------------------
+    columns: FeatureColumns
+        one entry per (track, genre bucket) pair
+
+    scaled: dict
+        column name -> the column scaled to 0-1 over the whole catalog
+
+    genre_positions: dict
+        genre bucket -> array of the entries in that genre
+
+    '''
+    def __init__(self, columns, genres):
+        self.columns = columns
+        self.scaled = {name: scale_column(columns.column(name)) for name in NUMERIC_COLUMNS}
+        genre_names, genre_codes = np.unique(np.asarray(genres, dtype=object), return_inverse=True)
+        order = np.argsort(genre_codes, kind="stable")
+        bounds = np.searchsorted(genre_codes[order], np.arange(len(genre_names) + 1))
+        self.genre_positions = {
+            genre: order[bounds[code]:bounds[code + 1]]
+            for code, genre in enumerate(genre_names)
+        }
+
+    @classmethod
+    def from_rows(cls, rows):
+        '''Builds an engine from (SpotifyTrackId, Popularity, Acousticness,
+        Danceability, Tempo, Genre) rows.
+
+        Parameters
+        ----------
+        rows: list
+
+        Returns
+        -------
+        RankingEngine
+        '''
+        rows = list(rows)
+        columns = FeatureColumns.from_rows(row[:5] for row in rows)
+        return cls(columns, [row[5] for row in rows])
+
+    @classmethod
+    def load(cls, connection):
+        '''Reads every track with audio features and a genre bucket from
+        music.sqlite.
+
+        Parameters
+        ----------
+        connection: sqlite3.Connection
+
+        Returns
+        -------
+        RankingEngine
+        '''
+        return cls.from_rows(connection.execute(select_ranking_rows))
+
+    def score(self, weights, positions=None):
+        '''Computes the weighted score of every entry (or of the entries at
+        positions).
+
+        Parameters
+        ----------
+        weights: dict
+            column name -> weight, e.g. RANKING_MODES["slow and acoustic"]
+        positions: numpy.ndarray
+
+        Returns
+        -------
+        numpy.ndarray
+        '''
+        size = len(self.columns) if positions is None else len(positions)
+        scores = np.zeros(size, dtype=np.float32)
+        for name, weight in weights.items():
+            column = self.scaled[name]
+            scores += weight * (column if positions is None else column[positions])
+        return scores
+
+    def top(self, genre, weights, limit):
+        '''Returns the highest scoring tracks of a genre.
+
+        Parameters
+        ----------
+        genre: string
+            a genre bucket
+        weights: dict
+        limit: int
+
+        Returns
+        -------
+        list
+            SpotifyTrackIds, best first
+        '''
+        positions = self.genre_positions.get(genre)
+        if positions is None or len(positions) == 0 or limit <= 0:
+            return []
+        scores = self.score(weights, positions)
+        limit = min(limit, len(positions))
+        best = np.argpartition(-scores, limit - 1)[:limit]
+        best = best[np.argsort(-scores[best], kind="stable")]
+        track_ids = self.columns.spotify_track_ids
+        return [track_ids[i] for i in positions[best]]
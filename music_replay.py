@@ -0,0 +1,246 @@
+#### Offline replay of the Spotify and TheAudioDB APIs
+#### ReplayStore answers API requests from recorded responses: the API cache
+#### (music_cache.sqlite) or an old music_cache.json. music_http uses it in
+#### process when MUSIC_API_REPLAY names a recording, and this module's
+#### command runs it as a local stand-in server (with optional latency and
+#### rate limits) that MUSIC_API_STAND_IN points the app at.
+####
+#### python3 music_replay.py [--recording music_cache.sqlite] [--port 8765]
+####     [--latency 0.05] [--rate-limit 10]
+#### MUSIC_API_STAND_IN=http://127.0.0.1:8765 python3 -m requests_database sync
+
+import argparse
+import json
+import os
+import sqlite3
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qsl
+
+from music_cache import construct_unique_key
+
+DEFAULT_RECORDING = "music_cache.sqlite"
+
+# multi-ID endpoints: URL -> the key holding the list of objects (the
+# recording holds one entry per object, under URL/ID)
+BATCH_ENDPOINTS = {
+    "https://api.spotify.com/v1/artists": "artists",
+    "https://api.spotify.com/v1/audio-features": "audio_features",
+}
+
+# what TheAudioDB answers (with a 200) for something it doesn't know
+NOT_FOUND_RESPONSES = {
+    "https://www.theaudiodb.com/api/v1/json/1/search.php": {"artists": None},
+    "https://theaudiodb.com/api/v1/json/1/mvid.php": {"mvids": None},
+}
+
+SPOTIFY_TOKEN_URL = "https://accounts.spotify.com/api/token"
+REPLAY_TOKEN = {"access_token": "replay", "token_type": "Bearer", "expires_in": 3600}
+
+
+class ReplayStore:
+    ''' Recorded API responses, keyed the way music_cache keys them.
+
+    Instance attributes
+    -------------------
+    path: string
+        a cache database (.sqlite) or a JSON cache file (.json)
+
+    hits, misses: int
+
+    '''
+    def __init__(self, path=DEFAULT_RECORDING):
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self._local = threading.local()
+        self.entries = None
+        if path.endswith(".json"):
+            with open(path, 'r') as recording:
+                self.entries = json.load(recording)
+        elif not os.path.exists(path):
+            raise FileNotFoundError(path)
+
+    def lookup(self, key):
+        '''Returns the recorded response for a cache key, or None.'''
+        if self.entries is not None:
+            response = self.entries.get(key)
+        else:
+            connection = getattr(self._local, "connection", None)
+            if connection is None:
+                connection = sqlite3.connect(f"file:{os.path.abspath(self.path)}?mode=ro", uri=True)
+                self._local.connection = connection
+            row = connection.execute("SELECT Response FROM cache WHERE CacheKey = ?", (key,)).fetchone()
+            response = None if row is None else json.loads(row[0])
+        if isinstance(response, dict) and "error" in response:
+            response = None # an error body cached by an older version isn't a recording
+        with self.lock:
+            if response is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return response
+
+    def respond(self, method, url, params=None):
+        '''Answers one request from the recording.
+
+        Parameters
+        ----------
+        method: string
+            "GET" or "POST"
+        url: string
+            the real API URL, without a query string
+        params: dict
+            the query parameters
+
+        Returns
+        -------
+        tuple
+            (HTTP status, JSON payload)
+        '''
+        params = dict(params or {})
+        if method == "POST":
+            if url == SPOTIFY_TOKEN_URL:
+                return 200, REPLAY_TOKEN
+            return 405, {"error": {"status": 405, "message": "only the token endpoint takes POST"}}
+        if url in BATCH_ENDPOINTS and "ids" in params:
+            objects = [self.lookup(url + "/" + spotify_id) for spotify_id in params["ids"].split(",")]
+            return 200, {BATCH_ENDPOINTS[url]: objects}
+        key = construct_unique_key(url, params) if params else url
+        response = self.lookup(key)
+        if response is not None:
+            return 200, response
+        if url in NOT_FOUND_RESPONSES:
+            return 200, NOT_FOUND_RESPONSES[url]
+        return 404, {"error": {"status": 404, "message": f"not in the recording: {key}"}}
+
+
+def make_response(url, status, payload, headers=None):
+    '''Wraps a replayed answer in a requests.Response, so callers of
+    music_http can't tell it from a real one.'''
+    import requests
+    response = requests.models.Response()
+    response.url = url
+    response.status_code = status
+    response._content = json.dumps(payload).encode("utf-8")
+    response.headers["Content-Type"] = "application/json"
+    response.headers.update(headers or {})
+    response.encoding = "utf-8"
+    return response
+
+
+class FixedWindowLimiter:
+    ''' Lets at most `rate` requests per host through each second; the
+    stand-in answers the rest with 429 and a Retry-After header. '''
+    def __init__(self, rate):
+        self.rate = rate
+        self.windows = {} # host -> (second, count)
+        self.lock = threading.Lock()
+
+    def allow(self, host):
+        now = time.time()
+        second = int(now)
+        with self.lock:
+            window, count = self.windows.get(host, (second, 0))
+            if window != second:
+                window, count = second, 0
+            if count >= self.rate:
+                return False, max(second + 1 - now, 0.01)
+            self.windows[host] = (window, count + 1)
+            return True, 0
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    ''' Serves http://stand-in/<api host>/<path>?<query> as if it were
+    https://<api host>/<path>?<query>. The server carries the store, the
+    limiter and the added latency. '''
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.replay("GET")
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        self.rfile.read(length)
+        self.replay("POST")
+
+    def replay(self, method):
+        parsed = urlparse(self.path)
+        host, _, path = parsed.path.lstrip("/").partition("/")
+        url = f"https://{host}/{path}"
+        params = dict(parse_qsl(parsed.query, keep_blank_values=True))
+        if self.server.latency > 0:
+            time.sleep(self.server.latency)
+        headers = {}
+        if self.server.limiter is not None:
+            allowed, retry_after = self.server.limiter.allow(host)
+            if not allowed:
+                status, payload = 429, {"error": {"status": 429, "message": "rate limited by the stand-in"}}
+                headers["Retry-After"] = f"{retry_after:.2f}"
+        if "Retry-After" not in headers:
+            status, payload = self.server.store.respond(method, url, params)
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+def serve(store, port=8765, latency=0.0, rate_limit=None, verbose=False):
+    '''Starts the stand-in server on a background thread.
+
+    Parameters
+    ----------
+    store: ReplayStore
+    port: int
+        0 picks a free port
+    latency: float
+        seconds added to every response
+    rate_limit: int
+        requests per second allowed per API host (None: no limit)
+    verbose: bool
+        log every request
+
+    Returns
+    -------
+    ThreadingHTTPServer
+        call shutdown() to stop it; server_address holds the port
+    '''
+    server = ThreadingHTTPServer(("127.0.0.1", port), StandInHandler)
+    server.daemon_threads = True
+    server.store = store
+    server.latency = latency
+    server.limiter = FixedWindowLimiter(rate_limit) if rate_limit else None
+    server.verbose = verbose
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve recorded Spotify and TheAudioDB responses locally")
+    parser.add_argument("--recording", default=DEFAULT_RECORDING, help="music_cache.sqlite or music_cache.json")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every response")
+    parser.add_argument("--rate-limit", type=int, help="requests per second per API host before answering 429")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+    server = serve(ReplayStore(args.recording), args.port, args.latency, args.rate_limit, args.verbose)
+    print(f"Replaying {args.recording} on http://127.0.0.1:{server.server_address[1]} (Ctrl-C to stop)")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,336 @@
+#### Schema of music.sqlite
+#### Table, index and insert statements shared by requests_database.py and
+#### the benchmarks, and the sorted track queries behind /results.
+
+drop_tracks = '''
+    DROP TABLE IF EXISTS "tracks";
+'''
+
+create_tracks = '''
+    CREATE TABLE IF NOT EXISTS "tracks" (
+        "TrackId"           INTEGER PRIMARY KEY AUTOINCREMENT UNIQUE,
+        "TrackName"         TEXT NOT NULL,
+        "ArtistName"        TEXT NOT NULL,
+        "AlbumName"         TEXT,
+        "SpotifyPreview"    TEXT,
+        "SpotifyURL"        TEXT,
+        "SpotifyArtistId"   TEXT,
+        "SpotifyTrackId"    TEXT NOT NULL,
+        "Popularity"        INTEGER,
+        "FetchedAt"         INTEGER,
+        FOREIGN KEY(SpotifyArtistId) REFERENCES artists(SpotifyArtistId)
+    );
+'''
+
+# indexes are created after a bulk load, not before (see create_indexes)
+create_tracks_index = '''
+    CREATE UNIQUE INDEX IF NOT EXISTS "tracks_spotify_track_id" ON "tracks" ("SpotifyTrackId");
+'''
+
+create_tracks_artist_index = '''
+    CREATE INDEX IF NOT EXISTS "tracks_spotify_artist_id" ON "tracks" ("SpotifyArtistId");
+'''
+
+create_artist_genres_artist_index = '''
+    CREATE INDEX IF NOT EXISTS "artist_genres_spotify_artist_id" ON "artist_genres" ("SpotifyArtistId");
+'''
+
+# for the ORDER BY ... LIMIT queries behind the /results sort modes
+create_tracks_popularity_index = '''
+    CREATE INDEX IF NOT EXISTS "tracks_popularity" ON "tracks" ("Popularity");
+'''
+
+create_features_danceability_index = '''
+    CREATE INDEX IF NOT EXISTS "features_danceability" ON "features" ("Danceability");
+'''
+
+create_features_tempo_index = '''
+    CREATE INDEX IF NOT EXISTS "features_tempo" ON "features" ("Tempo");
+'''
+
+TABLE_INDEXES = [create_tracks_index, create_tracks_artist_index, create_artist_genres_artist_index,
+    create_tracks_popularity_index, create_features_danceability_index, create_features_tempo_index]
+
+drop_artists = '''
+    DROP TABLE IF EXISTS "artists";
+'''
+
+create_artists = '''
+    CREATE TABLE IF NOT EXISTS "artists" (
+        "SpotifyArtistId"   TEXT PRIMARY KEY UNIQUE,
+        "ArtistName"        TEXT NOT NULL,
+        "Genre"             TEXT,
+        "ImageUrl"          TEXT,
+        "FetchedAt"         INTEGER
+    );
+'''
+
+# One row per (artist, genre). Kind is 'spotify' for each genre Spotify lists
+# for the artist and 'bucket' for the app genre map_genres picked. The
+# primary key doubles as a covering index for "artists in genre X" lookups.
+drop_artist_genres = '''
+    DROP TABLE IF EXISTS "artist_genres";
+'''
+
+create_artist_genres = '''
+    CREATE TABLE IF NOT EXISTS "artist_genres" (
+        "Kind"              TEXT NOT NULL,
+        "Genre"             TEXT NOT NULL,
+        "SpotifyArtistId"   TEXT NOT NULL,
+        PRIMARY KEY ("Kind", "Genre", "SpotifyArtistId")
+    ) WITHOUT ROWID;
+'''
+
+drop_features = '''
+    DROP TABLE IF EXISTS "features";
+'''
+
+create_features = '''
+    CREATE TABLE IF NOT EXISTS "features" (
+
+        "SpotifyTrackId"    TEXT PRIMARY KEY NOT NULL,
+        "Acousticness"      REAL,
+        "Danceability"      REAL,    
+        "Tempo"             REAL,
+        "FetchedAt"         INTEGER
+        );
+'''
+
+insert_tracks = '''
+    INSERT INTO tracks (TrackName, ArtistName, AlbumName, SpotifyPreview, SpotifyURL, SpotifyArtistId, SpotifyTrackId, Popularity, FetchedAt)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+'''
+
+insert_artists = '''
+    INSERT INTO artists (SpotifyArtistId, ArtistName, Genre, ImageUrl, FetchedAt)
+    VALUES (?, ?, ?, ?, ?)
+'''
+
+insert_artist_genres = '''
+    INSERT OR IGNORE INTO artist_genres (Kind, Genre, SpotifyArtistId)
+    VALUES (?, ?, ?)
+'''
+
+delete_artist_genres = '''
+    DELETE FROM artist_genres
+    WHERE SpotifyArtistId = ?
+'''
+
+# fills artist_genres from artists.Genre for databases made before the table existed
+backfill_artist_genres = '''
+    INSERT OR IGNORE INTO artist_genres (Kind, Genre, SpotifyArtistId)
+    SELECT 'bucket', Genre, SpotifyArtistId FROM artists
+    WHERE Genre IS NOT NULL
+'''
+
+insert_features = '''
+    INSERT INTO features (SpotifyTrackId, Acousticness, Danceability, Tempo, FetchedAt)
+    VALUES (?, ?, ?, ?, ?)
+'''
+
+# the upserts need the unique SpotifyTrackId index (artists and features use their primary keys)
+upsert_tracks = '''
+    INSERT INTO tracks (TrackName, ArtistName, AlbumName, SpotifyPreview, SpotifyURL, SpotifyArtistId, SpotifyTrackId, Popularity, FetchedAt)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(SpotifyTrackId) DO UPDATE SET
+        TrackName=excluded.TrackName, ArtistName=excluded.ArtistName, AlbumName=excluded.AlbumName,
+        SpotifyPreview=excluded.SpotifyPreview, SpotifyURL=excluded.SpotifyURL,
+        SpotifyArtistId=excluded.SpotifyArtistId, Popularity=excluded.Popularity, FetchedAt=excluded.FetchedAt
+'''
+
+upsert_artists = '''
+    INSERT INTO artists (SpotifyArtistId, ArtistName, Genre, ImageUrl, FetchedAt)
+    VALUES (?, ?, ?, ?, ?)
+    ON CONFLICT(SpotifyArtistId) DO UPDATE SET
+        ArtistName=excluded.ArtistName, Genre=excluded.Genre, ImageUrl=excluded.ImageUrl, FetchedAt=excluded.FetchedAt
+'''
+
+upsert_features = '''
+    INSERT INTO features (SpotifyTrackId, Acousticness, Danceability, Tempo, FetchedAt)
+    VALUES (?, ?, ?, ?, ?)
+    ON CONFLICT(SpotifyTrackId) DO UPDATE SET
+        Acousticness=excluded.Acousticness, Danceability=excluded.Danceability, Tempo=excluded.Tempo, FetchedAt=excluded.FetchedAt
+'''
+
+
+# One row per place in the top LEADERBOARD_SIZE of each (genre bucket, sort
+# mode), precomputed by music_leaderboards.refresh_leaderboards. The columns
+# after Rank are the ones TRACK_COLUMNS selects, in the same order.
+drop_leaderboards = '''
+    DROP TABLE IF EXISTS "leaderboards";
+'''
+
+create_leaderboards = '''
+    CREATE TABLE IF NOT EXISTS "leaderboards" (
+        "Genre"             TEXT NOT NULL,
+        "SortMode"          TEXT NOT NULL,
+        "Rank"              INTEGER NOT NULL,
+        "TrackName"         TEXT,
+        "ArtistName"        TEXT,
+        "ArtistGenre"       TEXT,
+        "ImageUrl"          TEXT,
+        "AlbumName"         TEXT,
+        "Popularity"        INTEGER,
+        "Tempo"             REAL,
+        "Danceability"      REAL,
+        "SpotifyTrackId"    TEXT,
+        PRIMARY KEY ("Genre", "SortMode", "Rank")
+    ) WITHOUT ROWID;
+'''
+
+insert_leaderboards = '''
+    INSERT INTO leaderboards (Genre, SortMode, Rank, TrackName, ArtistName, ArtistGenre, ImageUrl, AlbumName, Popularity, Tempo, Danceability, SpotifyTrackId)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+'''
+
+# TheAudioDB enrichment, filled in by music_videos.py. A full rebuild of the
+# Spotify tables leaves these alone: they are keyed by Spotify IDs, which
+# stay the same, and requests_database.py doesn't refill them.
+create_tadb_artists = '''
+    CREATE TABLE IF NOT EXISTS "tadb_artists" (
+        "SpotifyArtistId"   TEXT PRIMARY KEY NOT NULL,
+        "TadbArtistId"      TEXT,
+        "FetchedAt"         INTEGER
+    ) WITHOUT ROWID;
+'''
+
+create_music_videos = '''
+    CREATE TABLE IF NOT EXISTS "music_videos" (
+        "SpotifyTrackId"    TEXT PRIMARY KEY NOT NULL,
+        "TadbArtistId"      TEXT,
+        "VideoTrackName"    TEXT,
+        "MusicVideoUrl"     TEXT NOT NULL,
+        "FetchedAt"         INTEGER
+    ) WITHOUT ROWID;
+'''
+
+upsert_tadb_artists = '''
+    INSERT INTO tadb_artists (SpotifyArtistId, TadbArtistId, FetchedAt)
+    VALUES (?, ?, ?)
+    ON CONFLICT(SpotifyArtistId) DO UPDATE SET
+        TadbArtistId=excluded.TadbArtistId, FetchedAt=excluded.FetchedAt
+'''
+
+delete_artist_music_videos = '''
+    DELETE FROM music_videos
+    WHERE SpotifyTrackId IN (SELECT SpotifyTrackId FROM tracks WHERE SpotifyArtistId = ?)
+'''
+
+insert_music_videos = '''
+    INSERT OR REPLACE INTO music_videos (SpotifyTrackId, TadbArtistId, VideoTrackName, MusicVideoUrl, FetchedAt)
+    VALUES (?, ?, ?, ?, ?)
+'''
+
+# the columns every /results query returns (response.html reads them by position)
+TRACK_COLUMNS = '''
+    SELECT TrackName, tracks.ArtistName, artists.Genre, artists.ImageUrl, tracks.AlbumName, tracks.Popularity, features.Tempo, features.Danceability, tracks.SpotifyTrackId
+'''
+
+# The sorted queries walk the sort column's index and probe artist_genres for
+# each row, stopping after LIMIT matches. CROSS JOIN pins that join order, so
+# SQLite doesn't collect and sort the whole genre instead.
+TRACKS_FIRST_JOINS = '''
+    FROM tracks
+    CROSS JOIN artist_genres
+    ON artist_genres.Kind = 'bucket' AND artist_genres.Genre = ? AND artist_genres.SpotifyArtistId = tracks.SpotifyArtistId
+    JOIN artists
+    ON artists.SpotifyArtistId = tracks.SpotifyArtistId
+    JOIN features
+    ON features.SpotifyTrackId = tracks.SpotifyTrackId
+'''
+
+FEATURES_FIRST_JOINS = '''
+    FROM features
+    CROSS JOIN tracks
+    ON tracks.SpotifyTrackId = features.SpotifyTrackId
+    CROSS JOIN artist_genres
+    ON artist_genres.Kind = 'bucket' AND artist_genres.Genre = ? AND artist_genres.SpotifyArtistId = tracks.SpotifyArtistId
+    JOIN artists
+    ON artists.SpotifyArtistId = tracks.SpotifyArtistId
+'''
+
+# sort value from inputs.html -> (joins, ORDER BY clause); anything else is random
+SORT_ORDERS = {
+    "popularity": (TRACKS_FIRST_JOINS, "tracks.Popularity DESC"),
+    "obscurity": (TRACKS_FIRST_JOINS, "tracks.Popularity ASC"),
+    "danceability": (FEATURES_FIRST_JOINS, "features.Danceability DESC"),
+    "speed (slow)": (FEATURES_FIRST_JOINS, "features.Tempo ASC"),
+}
+
+
+def create_tables(connection, full_rebuild=False):
+    '''Creates the tracks, artists, artist_genres, features, leaderboards,
+    tadb_artists and music_videos tables if they don't exist, and adds the
+    FetchedAt column to tables made before it existed. A newly made
+    artist_genres table is backfilled with the genre buckets already in
+    artists. A full rebuild drops the Spotify tables first and leaves the
+    indexes to be built by create_indexes once the data is loaded;
+    otherwise the indexes are created right away, since the upserts need
+    them.
+
+    Parameters
+    ----------
+    connection: sqlite3.Connection
+    full_rebuild: bool
+
+    Returns
+    -------
+    None
+    '''
+    cur = connection.cursor()
+    if full_rebuild:
+        cur.execute(drop_tracks)
+        cur.execute(drop_artists)
+        cur.execute(drop_artist_genres)
+        cur.execute(drop_features)
+        cur.execute(drop_leaderboards)
+    had_artist_genres = cur.execute("SELECT 1 FROM sqlite_master WHERE name = 'artist_genres'").fetchone() is not None
+    cur.execute(create_tracks)
+    cur.execute(create_artists)
+    cur.execute(create_artist_genres)
+    cur.execute(create_features)
+    cur.execute(create_leaderboards)
+    cur.execute(create_tadb_artists)
+    cur.execute(create_music_videos)
+    if not had_artist_genres:
+        cur.execute(backfill_artist_genres)
+    for table in ["tracks", "artists", "features"]:
+        columns = [row[1] for row in cur.execute(f'PRAGMA table_info("{table}")')]
+        if "FetchedAt" not in columns:
+            cur.execute(f'ALTER TABLE "{table}" ADD COLUMN "FetchedAt" INTEGER')
+    connection.commit()
+    if not full_rebuild:
+        create_indexes(connection)
+
+def create_indexes(connection):
+    '''Creates every index in TABLE_INDEXES that doesn't exist yet.
+
+    Parameters
+    ----------
+    connection: sqlite3.Connection
+
+    Returns
+    -------
+    None
+    '''
+    with connection:
+        for create_index in TABLE_INDEXES:
+            connection.execute(create_index)
+
+def bump_database_version(connection):
+    '''Increments PRAGMA user_version, the stamp the web app puts in its
+    page cache keys, so pages rendered from older data stop being served.
+
+    Parameters
+    ----------
+    connection: sqlite3.Connection
+
+    Returns
+    -------
+    int
+        the new version
+    '''
+    version = connection.execute("PRAGMA user_version").fetchone()[0] + 1
+    connection.execute(f"PRAGMA user_version = {version}")
+    connection.commit()
+    return version
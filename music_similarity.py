@@ -0,0 +1,170 @@
+#### "More like this" recommendations
+#### SimilarityIndex scales each track's audio features to 0-1 and keeps them
+#### in a KD-tree built over NumPy arrays, so the nearest tracks to any
+#### track are found by visiting a handful of leaves instead of measuring
+#### the distance to every track in the catalog.
+
+import heapq
+
+import numpy as np
+
+from music_features import FeatureColumns
+from music_ranking import scale_column
+
+# the feature columns a track's position in the index is built from
+SIMILARITY_COLUMNS = ("acousticness", "danceability", "tempo")
+
+# most points kept in a KD-tree leaf; a leaf is scanned with one NumPy call
+LEAF_SIZE = 32
+
+
+class KDTree:
+    ''' A static KD-tree over an (n, d) array of points. Each inner node
+    splits its points at the median of the dimension they spread over the
+    most; leaves hold at most leaf_size points, stored contiguously.
+
+    Instance attributes
+    -------------------
+    order: numpy.ndarray
+        the original index of each point, in tree order
+
+    points: numpy.ndarray
+        the points in tree order, so a leaf is a slice
+
+    '''
+    def __init__(self, points, leaf_size=LEAF_SIZE):
+        points = np.asarray(points, dtype=np.float32)
+        self.leaf_size = leaf_size
+        self.order = np.arange(len(points))
+        # node i: split dimension (-1 for a leaf), split value, children, and
+        # the slice of points under it
+        self.split_dims = []
+        self.split_values = []
+        self.lefts = []
+        self.rights = []
+        self.starts = []
+        self.ends = []
+        if len(points) > 0:
+            self.build(points, 0, len(points))
+        self.points = points[self.order]
+
+    def build(self, points, start, end):
+        node = len(self.split_dims)
+        self.split_dims.append(-1)
+        self.split_values.append(0.0)
+        self.lefts.append(-1)
+        self.rights.append(-1)
+        self.starts.append(start)
+        self.ends.append(end)
+        if end - start <= self.leaf_size:
+            return node
+        members = self.order[start:end]
+        member_points = points[members]
+        dim = int(np.argmax(member_points.max(axis=0) - member_points.min(axis=0)))
+        middle = (end - start) // 2
+        partition = np.argpartition(member_points[:, dim], middle)
+        self.order[start:end] = members[partition]
+        self.split_dims[node] = dim
+        self.split_values[node] = float(points[self.order[start + middle], dim])
+        self.lefts[node] = self.build(points, start, start + middle)
+        self.rights[node] = self.build(points, start + middle, end)
+        return node
+
+    def query(self, point, k):
+        '''Finds the k points nearest to point (Euclidean distance).
+
+        Parameters
+        ----------
+        point: sequence of d numbers
+        k: int
+
+        Returns
+        -------
+        tuple
+            (array of original indexes, array of distances), nearest first
+        '''
+        if k <= 0 or len(self.points) == 0:
+            return np.array([], dtype=np.int64), np.array([], dtype=np.float32)
+        point = np.asarray(point, dtype=np.float32)
+        best = [] # max-heap of (-squared distance, tree position)
+
+        def search(node):
+            dim = self.split_dims[node]
+            if dim < 0:
+                start = self.starts[node]
+                distances = ((self.points[start:self.ends[node]] - point) ** 2).sum(axis=1)
+                for offset in np.flatnonzero(distances < -best[0][0]) if len(best) == k else range(len(distances)):
+                    entry = (-float(distances[offset]), start + int(offset))
+                    if len(best) < k:
+                        heapq.heappush(best, entry)
+                    elif entry > best[0]:
+                        heapq.heapreplace(best, entry)
+                return
+            difference = float(point[dim]) - self.split_values[node]
+            near, far = (self.lefts[node], self.rights[node]) if difference < 0 else (self.rights[node], self.lefts[node])
+            search(near)
+            if len(best) < k or difference * difference < -best[0][0]:
+                search(far)
+
+        search(0)
+        best.sort(reverse=True)
+        positions = np.array([position for _, position in best], dtype=np.int64)
+        distances = np.sqrt(np.array([-negative for negative, _ in best], dtype=np.float32))
+        return self.order[positions], distances
+
+
+class SimilarityIndex:
+    ''' Finds the tracks whose audio features are closest to a track's.
+
+    Instance attributes
+    -------------------
+    columns: FeatureColumns
+
+    vectors: numpy.ndarray
+        the SIMILARITY_COLUMNS of columns, each scaled to 0-1, one row
+        per track
+
+    tree: KDTree
+        over vectors
+
+    '''
+    def __init__(self, columns):
+        self.columns = columns
+        self.vectors = np.column_stack([scale_column(columns.column(name)) for name in SIMILARITY_COLUMNS]) if len(columns) else np.zeros((0, len(SIMILARITY_COLUMNS)), dtype=np.float32)
+        self.tree = KDTree(self.vectors)
+
+    @classmethod
+    def load(cls, connection):
+        '''Builds the index over every track with audio features in
+        music.sqlite.
+
+        Parameters
+        ----------
+        connection: sqlite3.Connection
+
+        Returns
+        -------
+        SimilarityIndex
+        '''
+        return cls(FeatureColumns.load(connection))
+
+    def similar(self, spotify_track_id, k):
+        '''Returns the k tracks most like a track, not counting itself.
+
+        Parameters
+        ----------
+        spotify_track_id: string
+        k: int
+
+        Returns
+        -------
+        list
+            (SpotifyTrackId, distance) tuples, nearest first; empty if
+            the track isn't in the index
+        '''
+        position = self.columns.position(spotify_track_id)
+        if position is None:
+            return []
+        indexes, distances = self.tree.query(self.vectors[position], k + 1)
+        track_ids = self.columns.spotify_track_ids
+        return [(track_ids[i], float(distance)) for i, distance in zip(indexes, distances) if i != position][:k]
@@ -0,0 +1,376 @@
+#### Synthetic catalogs for load testing
+#### SyntheticCatalog makes up Spotify artists, tracks and audio features at
+#### any scale, shaped like the API's responses. Artists are reused
+#### Zipfian-style: a few artists have hundreds of tracks, most have one
+#### or two. Genres come from per-bucket profiles, and popularity,
+#### acousticness, danceability and tempo are drawn from distributions
+#### that follow them. build() streams the catalog into a new music.sqlite
+#### a batch at a time. It can also write a matching API cache: TheAudioDB
+#### answers for every artist, plus optional Spotify entries. With that
+#### cache, /results and /play-music can be load-tested offline.
+####
+#### python3 music_synthetic.py --tracks 1000000 [--database synthetic.sqlite]
+####     [--cache synthetic_cache.sqlite] [--spotify] [--enriched] [--seed 507]
+#### MUSIC_DB=synthetic.sqlite MUSIC_CACHE_DB=synthetic_cache.sqlite python3 music_flask_app.py
+
+import argparse
+import json
+import os
+import sqlite3
+import time
+
+import numpy as np
+
+from music_cache import construct_unique_key, create_cache, insert_cache
+from music_models import Artist
+from music_bulk_load import apply_load_pragmas, bulk_insert
+from music_leaderboards import refresh_leaderboards
+from music_schema import (create_tables, create_indexes, bump_database_version, insert_tracks, insert_artists,
+    insert_artist_genres, insert_features, upsert_tadb_artists, insert_music_videos)
+from music_videos import TADB_ARTIST_URL, TADB_MUSIC_VIDEO_URL
+import requests_database
+
+DEFAULT_DATABASE = "synthetic.sqlite"
+
+# tracks generated (and inserted) at a time
+BATCH_SIZE = 50000
+
+# artist k (k = 1, 2, ...) is picked for a track with probability
+# proportional to 1 / (k + ZIPF_OFFSET) ** ZIPF_EXPONENT (Zipf-Mandelbrot:
+# the offset keeps the busiest artists from taking a tenth of the catalog);
+# there are TRACKS_PER_ARTIST times fewer artists than tracks to pick from
+ZIPF_EXPONENT = 1.0
+ZIPF_OFFSET = 10
+TRACKS_PER_ARTIST = 8
+TRACKS_PER_ALBUM = 12
+
+# the share of artists TheAudioDB knows, and the share of their tracks
+# with a music video
+TADB_KNOWN_SHARE = 0.6
+VIDEO_SHARE = 0.15
+
+# genre bucket -> share of artists, the Spotify genre lists its artists
+# get (map_genres turns each back into the bucket), Beta(a, b) parameters
+# for acousticness and danceability, and the mean tempo
+GENRE_PROFILES = {
+    "pop": (0.24, [["dance pop", "pop"], ["pop", "post-teen pop"], ["electropop", "pop"]], (1.2, 4.0), (6.0, 3.0), 118.0),
+    "indie": (0.22, [["indie folk", "indie pop"], ["indie rock"], ["indie folk", "stomp and holler"]], (2.0, 2.0), (4.0, 4.0), 116.0),
+    "hip-hop": (0.18, [["hip hop", "rap"], ["southern hip hop", "trap"], ["conscious hip hop"]], (1.0, 6.0), (7.0, 3.0), 102.0),
+    "rock": (0.14, [["modern rock", "garage rock"], ["classic rock", "album rock"], ["hard rock"]], (1.0, 5.0), (4.0, 5.0), 128.0),
+    "alternative": (0.12, [["alternative rock"], ["alternative metal", "nu metal"], ["alternative dance"]], (1.0, 6.0), (4.5, 5.0), 124.0),
+    "emo": (0.10, [["emo", "pop punk"], ["midwest emo"], ["emo", "post-hardcore"]], (1.0, 8.0), (4.0, 6.0), 140.0),
+}
+TEMPO_SPREAD = 22.0
+TEMPO_RANGE = (50.0, 210.0)
+# standard deviation of a track's popularity around its artist's
+POPULARITY_SPREAD = 10.0
+
+ID_CHARACTERS = np.frombuffer(b"ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789", dtype=np.uint8)
+
+NAME_WORDS = ["Velvet", "Paper", "Neon", "Golden", "Silver", "Midnight", "Hollow", "Electric", "Wild", "Quiet",
+    "Broken", "Crystal", "Summer", "Winter", "Lonely", "Northern", "Burning", "Static", "Gentle", "Savage",
+    "Harbor", "Lantern", "Garden", "River", "Engine", "Mirror", "Canyon", "Echo", "Signal", "Comet",
+    "Heart", "Ghost", "Ocean", "Satellite", "Thunder", "Shadow", "Window", "Highway", "Forest", "Parade"]
+TITLE_WORDS = NAME_WORDS + ["Love", "Night", "Dance", "Home", "Fire", "Rain", "Light", "Dream", "Time", "Blue",
+    "Stay", "Run", "Fall", "Wait", "Shine", "Hold", "Breathe", "Gone", "Tonight", "Forever"]
+
+SPOTIFY_SEARCH_URL = "https://api.spotify.com/v1/search"
+SPOTIFY_ARTISTS_URL = "https://api.spotify.com/v1/artists"
+SPOTIFY_FEATURES_URL = "https://api.spotify.com/v1/audio-features"
+
+
+def make_spotify_ids(rng, count):
+    '''Random 22-character base62 IDs, like Spotify's.'''
+    codes = ID_CHARACTERS[rng.integers(0, len(ID_CHARACTERS), size=(count, 22))]
+    return [code.decode("ascii") for code in codes.view("S22").ravel()]
+
+
+def make_title(rng, words=TITLE_WORDS):
+    return " ".join(words[i] for i in rng.integers(0, len(words), size=rng.integers(1, 4)))
+
+
+class SyntheticCatalog:
+    ''' A made-up catalog of Spotify artists, tracks and audio features.
+    The same arguments always make the same catalog.
+
+    Instance attributes
+    -------------------
+    track_count: int
+
+    artists: list
+        Spotify artist objects (as /v1/artists returns them), one per
+        artist with at least one track, the busiest first
+
+    artist_genres: list
+        the genre bucket of each artist
+
+    track_artists: numpy.ndarray
+        the index in artists of each track's artist
+
+    '''
+    def __init__(self, track_count, artist_count=None, seed=507, zipf_exponent=ZIPF_EXPONENT):
+        self.track_count = track_count
+        self.seed = seed
+        rng = np.random.default_rng(seed)
+        artist_count = artist_count or max(1, track_count // TRACKS_PER_ARTIST)
+
+        # Zipfian artist reuse; artists no track picked are dropped
+        weights = 1.0 / (np.arange(1, artist_count + 1) + ZIPF_OFFSET) ** zipf_exponent
+        picks = np.searchsorted(np.cumsum(weights) / weights.sum(), rng.random(track_count), side="right")
+        picks = np.minimum(picks, artist_count - 1)
+        used, self.track_artists = np.unique(picks, return_inverse=True)
+        artist_count = len(used)
+
+        buckets = list(GENRE_PROFILES)
+        shares = np.array([GENRE_PROFILES[bucket][0] for bucket in buckets])
+        bucket_codes = rng.choice(len(buckets), size=artist_count, p=shares / shares.sum())
+        # busier artists are more popular
+        ranks = np.log(used + 1) / np.log(used[-1] + 2)
+        self.artist_popularity = np.clip(75 * (1 - ranks) + rng.normal(0, 8, artist_count), 0, 100)
+        self.acousticness_params = np.array([GENRE_PROFILES[buckets[code]][2] for code in bucket_codes]).reshape(-1, 2)
+        self.danceability_params = np.array([GENRE_PROFILES[buckets[code]][3] for code in bucket_codes]).reshape(-1, 2)
+        self.tempo_means = np.array([GENRE_PROFILES[buckets[code]][4] for code in bucket_codes])
+        self.tadb_known = rng.random(artist_count) < TADB_KNOWN_SHARE
+
+        self.artists = []
+        self.artist_genres = []
+        artist_ids = make_spotify_ids(rng, artist_count)
+        pairs = len(NAME_WORDS) ** 2
+        name_order = rng.permutation(pairs)
+        for i, (artist_id, code) in enumerate(zip(artist_ids, bucket_codes)):
+            first, second = divmod(int(name_order[i % pairs]), len(NAME_WORDS))
+            name = f"{NAME_WORDS[first]} {NAME_WORDS[second]}s" + (f" {i // pairs + 1}" if i >= pairs else "")
+            profile_genres = GENRE_PROFILES[buckets[code]][1]
+            genres = list(profile_genres[rng.integers(0, len(profile_genres))])
+            self.artists.append({
+                "id": artist_id,
+                "name": name,
+                "genres": genres,
+                "popularity": int(self.artist_popularity[i]),
+                "images": [{"url": f"https://i.scdn.co/image/{artist_id}", "height": 640, "width": 640}],
+                "type": "artist",
+            })
+            # the bucket requests_database.map_genres would pick
+            artist = Artist(genre=genres, spotify_genres=genres)
+            requests_database.map_genres(artist)
+            self.artist_genres.append(artist.genre)
+
+    def track_batches(self, batch_size=BATCH_SIZE):
+        '''Generates the tracks batch_size at a time, so a catalog of any
+        size can be streamed.
+
+        Parameters
+        ----------
+        batch_size: int
+
+        Returns
+        -------
+        generator
+            (tracks, audio features, music videos) per batch: Spotify
+            track objects (as /v1/search lists them), audio feature
+            objects (as /v1/audio-features returns them) and
+            (artist index, SpotifyTrackId, video title, video URL) tuples
+            for the tracks with a music video
+        '''
+        rng = np.random.default_rng(self.seed + 1)
+        artist_track_counts = np.zeros(len(self.artists), dtype=np.int64)
+        for start in range(0, self.track_count, batch_size):
+            artist_indexes = self.track_artists[start:start + batch_size]
+            count = len(artist_indexes)
+            track_ids = make_spotify_ids(rng, count)
+            popularity = np.clip(np.rint(self.artist_popularity[artist_indexes] + rng.normal(0, POPULARITY_SPREAD, count)), 0, 100).astype(int)
+            acousticness = rng.beta(self.acousticness_params[artist_indexes, 0], self.acousticness_params[artist_indexes, 1])
+            danceability = rng.beta(self.danceability_params[artist_indexes, 0], self.danceability_params[artist_indexes, 1])
+            tempo = np.clip(rng.normal(self.tempo_means[artist_indexes], TEMPO_SPREAD), *TEMPO_RANGE)
+            has_video = self.tadb_known[artist_indexes] & (rng.random(count) < VIDEO_SHARE)
+
+            tracks = []
+            features = []
+            videos = []
+            for i in range(count):
+                artist_index = int(artist_indexes[i])
+                artist = self.artists[artist_index]
+                track_id = track_ids[i]
+                track_name = make_title(rng)
+                album_number = artist_track_counts[artist_index] // TRACKS_PER_ALBUM
+                artist_track_counts[artist_index] += 1
+                tracks.append({
+                    "id": track_id,
+                    "name": track_name,
+                    "album": {"name": f"{artist['name']} Vol. {album_number + 1}"},
+                    "popularity": int(popularity[i]),
+                    "preview_url": f"https://p.scdn.co/mp3-preview/{track_id}",
+                    "external_urls": {"spotify": f"https://open.spotify.com/track/{track_id}"},
+                    "artists": [{"id": artist["id"], "name": artist["name"]}],
+                    "type": "track",
+                })
+                features.append({
+                    "id": track_id,
+                    "acousticness": round(float(acousticness[i]), 4),
+                    "danceability": round(float(danceability[i]), 3),
+                    "tempo": round(float(tempo[i]), 3),
+                    "type": "audio_features",
+                })
+                if has_video[i]:
+                    videos.append((artist_index, track_id, track_name + " (Official Video)", f"https://www.youtube.com/watch?v={track_id[:11]}"))
+            yield tracks, features, videos
+
+    def tadb_artist_id(self, artist_index):
+        '''The artist's made-up TheAudioDB ID, or None if TADB doesn't
+        know the artist.'''
+        return str(100000 + artist_index) if self.tadb_known[artist_index] else None
+
+
+class SearchPages:
+    ''' Collects the first SPOTIFY_SEARCH_MAX_RESULTS tracks of every
+    query in requests_database.GENRE_QUERIES (tracks are dealt to the
+    queries in turn) and turns them into the search result pages
+    get_genre_tracks would read from the cache. '''
+    def __init__(self):
+        self.queries = [query for queries in requests_database.GENRE_QUERIES.values() for query in queries]
+        self.tracks = {query: [] for query in self.queries}
+        self.next_query = 0
+
+    def add(self, tracks):
+        for track in tracks:
+            query = self.queries[self.next_query]
+            self.next_query = (self.next_query + 1) % len(self.queries)
+            if len(self.tracks[query]) < requests_database.SPOTIFY_SEARCH_MAX_RESULTS:
+                self.tracks[query].append(track)
+
+    def cache_rows(self):
+        page_size = requests_database.SPOTIFY_SEARCH_PAGE_SIZE
+        for query, tracks in self.tracks.items():
+            for offset in range(0, max(len(tracks), 1), page_size):
+                params = {"q": query, "type": "track", "limit": page_size}
+                if offset > 0:
+                    params["offset"] = offset
+                next_url = None
+                if offset + page_size < len(tracks):
+                    next_url = f"{SPOTIFY_SEARCH_URL}?q={query}&type=track&offset={offset + page_size}&limit={page_size}"
+                page = {"tracks": {"items": tracks[offset:offset + page_size], "limit": page_size, "offset": offset, "next": next_url, "total": len(tracks)}}
+                yield construct_unique_key(SPOTIFY_SEARCH_URL, params), json.dumps(page)
+
+
+def tadb_cache_rows(catalog, videos_by_artist):
+    '''TheAudioDB's answers for every artist in the catalog: the artist
+    search, and the music video list of each artist TADB knows.'''
+    for artist_index, artist in enumerate(catalog.artists):
+        tadb_artist_id = catalog.tadb_artist_id(artist_index)
+        if tadb_artist_id is None:
+            yield construct_unique_key(TADB_ARTIST_URL, {"s": artist["name"]}), json.dumps({"artists": None})
+            continue
+        yield construct_unique_key(TADB_ARTIST_URL, {"s": artist["name"]}), json.dumps({"artists": [{"idArtist": tadb_artist_id, "strArtist": artist["name"]}]})
+        mvids = [{"idArtist": tadb_artist_id, "strTrack": title, "strMusicVid": url} for _, title, url in videos_by_artist.get(artist_index, [])]
+        yield construct_unique_key(TADB_MUSIC_VIDEO_URL, {"i": tadb_artist_id}), json.dumps({"mvids": mvids or None})
+
+
+def build(catalog, database_name=DEFAULT_DATABASE, cache_name=None, spotify=False, enriched=False, batch_size=BATCH_SIZE):
+    '''Streams a catalog into a new music.sqlite, and optionally writes the
+    matching API cache.
+
+    Parameters
+    ----------
+    catalog: SyntheticCatalog
+    database_name: string
+        must not exist yet
+    cache_name: string
+        an API cache database to add TheAudioDB entries to (None: none)
+    spotify: bool
+        also add the Spotify entries: every artist and audio feature
+        under its single-ID URL, and search pages for GENRE_QUERIES
+    enriched: bool
+        fill tadb_artists and music_videos as music_videos.py would; if
+        not, /play-music looks each artist up (in the cache) on its first
+        visit
+    batch_size: int
+
+    Returns
+    -------
+    dict
+        the number of rows or entries written, by table
+    '''
+    if os.path.exists(database_name):
+        raise FileExistsError(database_name)
+    counts = {"tracks": 0, "artists": len(catalog.artists), "music_videos": 0, "cache": 0}
+    connection = sqlite3.connect(database_name)
+    apply_load_pragmas(connection)
+    create_tables(connection, full_rebuild=True)
+    cache = None
+    if cache_name is not None:
+        cache = sqlite3.connect(cache_name)
+        cache.execute("PRAGMA journal_mode=WAL")
+        cache.execute(create_cache)
+    fetched_at = int(time.time())
+
+    search_pages = SearchPages()
+    videos_by_artist = {}
+    for tracks, features, videos in catalog.track_batches(batch_size):
+        bulk_insert(connection, insert_tracks, ([
+            track["name"], track["artists"][0]["name"], track["album"]["name"], track["preview_url"],
+            track["external_urls"]["spotify"], track["artists"][0]["id"], track["id"], track["popularity"], fetched_at,
+        ] for track in tracks))
+        bulk_insert(connection, insert_features, ([
+            feature["id"], feature["acousticness"], feature["danceability"], feature["tempo"], fetched_at,
+        ] for feature in features))
+        counts["tracks"] += len(tracks)
+        for artist_index, track_id, title, url in videos:
+            videos_by_artist.setdefault(artist_index, []).append((track_id, title, url))
+        if cache is not None and spotify:
+            search_pages.add(tracks)
+            counts["cache"] += bulk_insert(cache, insert_cache, (
+                (f"{SPOTIFY_FEATURES_URL}/{feature['id']}", json.dumps(feature)) for feature in features))
+
+    bulk_insert(connection, insert_artists, ([
+        artist["id"], artist["name"], genre, artist["images"][0]["url"], fetched_at,
+    ] for artist, genre in zip(catalog.artists, catalog.artist_genres)), sort_key=lambda row: row[0])
+    artist_genre_rows = []
+    for artist, genre in zip(catalog.artists, catalog.artist_genres):
+        artist_genre_rows += [["spotify", spotify_genre, artist["id"]] for spotify_genre in artist["genres"]]
+        artist_genre_rows.append(["bucket", genre, artist["id"]])
+    bulk_insert(connection, insert_artist_genres, artist_genre_rows, sort_key=lambda row: row)
+
+    if enriched:
+        bulk_insert(connection, upsert_tadb_artists, (
+            [artist["id"], catalog.tadb_artist_id(artist_index), fetched_at]
+            for artist_index, artist in enumerate(catalog.artists)))
+        counts["music_videos"] = bulk_insert(connection, insert_music_videos, (
+            [track_id, catalog.tadb_artist_id(artist_index), title, url, fetched_at]
+            for artist_index, videos in videos_by_artist.items()
+            for track_id, title, url in videos))
+    create_indexes(connection)
+    refresh_leaderboards(connection)
+    bump_database_version(connection)
+    connection.close()
+
+    if cache is not None:
+        counts["cache"] += bulk_insert(cache, insert_cache, tadb_cache_rows(catalog, videos_by_artist))
+        if spotify:
+            counts["cache"] += bulk_insert(cache, insert_cache, (
+                (f"{SPOTIFY_ARTISTS_URL}/{artist['id']}", json.dumps(artist)) for artist in catalog.artists))
+            counts["cache"] += bulk_insert(cache, insert_cache, search_pages.cache_rows())
+        cache.close()
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a synthetic music.sqlite (and API cache) for load testing")
+    parser.add_argument("--tracks", type=int, default=100000)
+    parser.add_argument("--artists", type=int, help=f"artists to pick from (default: tracks / {TRACKS_PER_ARTIST})")
+    parser.add_argument("--database", default=DEFAULT_DATABASE, help="the music.sqlite to create")
+    parser.add_argument("--cache", help="an API cache database to write TheAudioDB entries to")
+    parser.add_argument("--spotify", action="store_true", help="also write Spotify entries to the cache")
+    parser.add_argument("--enriched", action="store_true", help="store the music videos, as music_videos.py would")
+    parser.add_argument("--seed", type=int, default=507)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    catalog = SyntheticCatalog(args.tracks, args.artists, args.seed)
+    counts = build(catalog, args.database, args.cache, args.spotify, args.enriched)
+    print(f"Wrote {counts['tracks']} tracks by {counts['artists']} artists to {args.database}"
+        + (f" and {counts['cache']} entries to {args.cache}" if args.cache else "")
+        + f" in {time.perf_counter() - start:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+#### Small helpers shared by requests_database.py and music_flask_app.py
+
+import sys
+
+
+def unique_by(items, key=None):
+    '''Returns the items with duplicates removed, keeping the first
+    occurrence of each and the original order. Runs in O(n) using a dict
+    of the keys already seen.
+
+    Parameters
+    ----------
+    items: iterable
+    key: callable
+        Maps an item to the value that identifies it (default: the item
+        itself, which must then be hashable)
+
+    Returns
+    -------
+    list
+        the de-duplicated items
+    '''
+    seen = {}
+    unique_items = []
+    for item in items:
+        item_key = item if key is None else key(item)
+        if item_key not in seen:
+            seen[item_key] = None
+            unique_items.append(item)
+    return unique_items
+
+
+def remove_duplicates(items, key=None):
+    '''Removes duplicates from a list in place, keeping the first
+    occurrence of each (see unique_by).
+
+    Parameters
+    ----------
+    items: list
+    key: callable
+
+    Returns
+    -------
+    None
+    '''
+    items[:] = unique_by(items, key)
+
+
+def intern_string(value):
+    '''Returns the interned copy of a string, so equal strings held by
+    many objects share one object. Anything that isn't a str (None, a list
+    of genres) is returned unchanged.
+
+    Parameters
+    ----------
+    value: any
+
+    Returns
+    -------
+    any
+    '''
+    if type(value) is str:
+        return sys.intern(value)
+    return value
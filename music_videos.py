@@ -0,0 +1,351 @@
+#### Music video enrichment for music.sqlite
+#### Looks every artist in the artists table up on TheAudioDB, matches their
+#### music videos to their tracks by normalized title and stores the matches
+#### in the music_videos table, so /play-music never calls TheAudioDB.
+#### Run it after requests_database.py: python3 music_videos.py
+
+import re
+import sqlite3
+import time
+import unicodedata
+
+import requests
+
+from music_cache import construct_unique_key, cache_lookup, cache_save
+from music_http import http_get, run_concurrently, TransportError
+from music_utils import intern_string
+from music_schema import (create_tables, bump_database_version, upsert_tadb_artists,
+    delete_artist_music_videos, insert_music_videos)
+
+DATABASE_NAME = "music.sqlite"
+
+TADB_ARTIST_URL = "https://www.theaudiodb.com/api/v1/json/1/search.php"
+TADB_MUSIC_VIDEO_URL = "https://theaudiodb.com/api/v1/json/1/mvid.php"
+
+# seconds after which an artist's videos are fetched again, bypassing the cache
+VIDEO_MAX_AGE = 30 * 24 * 60 * 60
+
+select_artists_to_enrich = '''
+    SELECT artists.SpotifyArtistId, artists.ArtistName, tadb_artists.FetchedAt FROM artists
+    LEFT JOIN tadb_artists
+    ON tadb_artists.SpotifyArtistId = artists.SpotifyArtistId
+'''
+
+select_artist_tracks = '''
+    SELECT SpotifyTrackId, TrackName FROM tracks
+    WHERE SpotifyArtistId = ?
+'''
+
+
+class MusicVideo:
+    ''' A Music Video
+
+    Instance attributes
+    -------------------
+    mvid_url (str): URL to YouTube video from The AudioDatabase API
+
+    track_name (str): Name of track from The AudioDatabase API
+
+    tadb_artist_id (str): Id of artist the The AudioDatabase API
+
+    '''
+    __slots__ = ("mvid_url", "track_name", "tadb_artist_id")
+
+    def __init__(self, mvid_url="None", track_name="None", tadb_artist_id="None"):
+        self.mvid_url = mvid_url
+        self.track_name = track_name
+        self.tadb_artist_id = intern_string(tadb_artist_id)
+
+    def info(self):
+        '''
+        Returns string literal of object instance.
+
+        Parameters
+        ----------
+        none
+
+        Returns
+        ----------
+        Object instance formatted as <track_name>, <tadb_artist_id> – <mvid_url>
+        '''
+        return f"{self.track_name}, {self.tadb_artist_id} – {self.mvid_url}"
+
+
+def make_tadb_request_with_cache(baseurl, params, use_cache=True):
+    ''' gets a response from The Audio Database API.
+    Uses cache if requests exists in cache.
+
+    Parameters
+    ----------
+    baseurl: string
+    params: dict
+    use_cache: bool
+        False to skip the cache lookup and refresh the entry
+
+    Returns
+    -------
+    dict:
+        json formatted results from request
+    '''
+    unique_key = construct_unique_key(baseurl, params)
+    if use_cache:
+        cached = cache_lookup(unique_key)
+        if cached is not None:
+            return cached
+    response = http_get(baseurl, params=params)
+    response.raise_for_status()
+    results = response.json()
+    cache_save(unique_key, results)
+    return results
+
+
+def make_artist_request(artist, use_cache=True):
+    ''' gets a list of artists from The Audio Database API.
+
+    Parameters
+    ----------
+    artist (str)
+        The name of an artist (leave spaces in)
+    use_cache (bool)
+
+    Returns
+    -------
+    dict:
+        json formatted results from request
+    '''
+    return make_tadb_request_with_cache(TADB_ARTIST_URL, {"s": artist}, use_cache)
+
+
+def make_music_video_request(artist_id, use_cache=True):
+    ''' gets music videos by a particular artist
+
+    Parameters
+    ----------
+    artist_id (str)
+        TADB artist ID
+    use_cache (bool)
+
+    Returns
+    -------
+    dict:
+        json formatted results from request
+    '''
+    return make_tadb_request_with_cache(TADB_MUSIC_VIDEO_URL, {"i": artist_id}, use_cache)
+
+
+def get_artist_tadb_id(artist, use_cache=True):
+    ''' gets artist ID by using make_artist_request and
+        parsing results.
+
+    Parameters
+    ----------
+    artist (str)
+        The name of an artist (leave spaces in)
+    use_cache (bool)
+
+    Returns
+    -------
+    str:
+        the TADB artist ID, or None if TADB doesn't know the artist
+    '''
+    results = make_artist_request(artist, use_cache)
+    if results.get('artists'):
+        return results['artists'][0]["idArtist"]
+    return None
+
+
+def get_music_videos(artist_id, use_cache=True):
+    ''' gets an artist's music videos by using
+    make_music_video_request and parsing results.
+
+    Parameters
+    ----------
+    artist_id (str)
+        TADB artist id
+    use_cache (bool)
+
+    Returns
+    -------
+    list:
+        list of MusicVideo objects
+    '''
+    mvid_objects_list = []
+    results = make_music_video_request(artist_id, use_cache)
+    for mvid in results.get('mvids') or []:
+        if mvid.get('strMusicVid') and mvid.get('strTrack'):
+            mvid_objects_list.append(MusicVideo(mvid_url=mvid['strMusicVid'], track_name=mvid['strTrack'], tadb_artist_id=artist_id))
+    return mvid_objects_list
+
+
+def normalize_title(title):
+    ''' Reduces a track title to the form used for matching: accents,
+    case, punctuation, bracketed parts ("(feat. X)", "[Live]") and
+    " - ..." suffixes ("- Remastered 2011") are dropped.
+
+    Parameters
+    ----------
+    title (str)
+
+    Returns
+    -------
+    str
+    '''
+    title = unicodedata.normalize("NFKD", title)
+    title = "".join(char for char in title if not unicodedata.combining(char))
+    title = title.casefold()
+    title = re.sub(r"[\(\[].*?[\)\]]", " ", title)
+    title = title.split(" - ")[0]
+    title = title.replace("&", " and ")
+    title = re.sub(r"[^\w\s]", "", title)
+    return " ".join(title.split())
+
+
+def match_music_videos(tracks, music_videos):
+    ''' Matches tracks to music videos whose normalized titles are equal.
+    When several videos share a title, the first one TADB lists wins.
+
+    Parameters
+    ----------
+    tracks (list)
+        (SpotifyTrackId, TrackName) tuples
+    music_videos (list)
+        MusicVideo objects
+
+    Returns
+    -------
+    list
+        (SpotifyTrackId, MusicVideo) tuples
+    '''
+    videos_by_title = {}
+    for music_video in music_videos:
+        videos_by_title.setdefault(normalize_title(music_video.track_name), music_video)
+    videos_by_title.pop("", None)
+    matches = []
+    for spotify_track_id, track_name in tracks:
+        music_video = videos_by_title.get(normalize_title(track_name))
+        if music_video is not None:
+            matches.append((spotify_track_id, music_video))
+    return matches
+
+
+def fetch_artist_videos(artist):
+    ''' Looks one artist up on TADB. Runs on a worker thread, so it only
+    does network and cache work.
+
+    Parameters
+    ----------
+    artist (tuple)
+        (SpotifyArtistId, ArtistName, use_cache)
+
+    Returns
+    -------
+    tuple
+        (SpotifyArtistId, TADB artist id, list of MusicVideo), or None if
+        TADB couldn't be reached
+    '''
+    spotify_artist_id, artist_name, use_cache = artist
+    try:
+        tadb_artist_id = get_artist_tadb_id(artist_name, use_cache)
+        music_videos = [] if tadb_artist_id is None else get_music_videos(tadb_artist_id, use_cache)
+    except (requests.RequestException, TransportError, ValueError) as error:
+        print(f"Could not fetch music videos for {artist_name}: {error}")
+        return None
+    return spotify_artist_id, tadb_artist_id, music_videos
+
+
+def save_artist_videos(connection, spotify_artist_id, tadb_artist_id, music_videos):
+    ''' Replaces the stored music videos of one artist's tracks.
+
+    Parameters
+    ----------
+    connection: sqlite3.Connection
+    spotify_artist_id: string
+    tadb_artist_id: string
+    music_videos: list
+
+    Returns
+    -------
+    int
+        the number of tracks matched to a video
+    '''
+    fetched_at = int(time.time())
+    tracks = connection.execute(select_artist_tracks, (spotify_artist_id,)).fetchall()
+    matches = match_music_videos(tracks, music_videos)
+    with connection:
+        connection.execute(upsert_tadb_artists, (spotify_artist_id, tadb_artist_id, fetched_at))
+        connection.execute(delete_artist_music_videos, (spotify_artist_id,))
+        connection.executemany(insert_music_videos, [
+            (spotify_track_id, tadb_artist_id, music_video.track_name, music_video.mvid_url, fetched_at)
+            for spotify_track_id, music_video in matches
+        ])
+    return len(matches)
+
+
+def refresh_artist_videos(database_name, spotify_artist_id, artist_name, use_cache=True):
+    ''' Fetches and saves one artist's music videos on its own
+    connection, for callers (like the web app) that only hold a read-only
+    one.
+
+    Parameters
+    ----------
+    database_name: string
+    spotify_artist_id: string
+    artist_name: string
+    use_cache: bool
+
+    Returns
+    -------
+    int
+        the number of tracks matched to a video, or None if TADB couldn't
+        be reached
+    '''
+    result = fetch_artist_videos((spotify_artist_id, artist_name, use_cache))
+    if result is None:
+        return None
+    connection = sqlite3.connect(database_name, timeout=30)
+    try:
+        return save_artist_videos(connection, *result)
+    finally:
+        connection.close()
+
+
+def enrich_music_videos(connection, max_age=VIDEO_MAX_AGE):
+    ''' Resolves the music videos of every artist in the artists table.
+    Every artist is matched again, so tracks added since the last run are
+    picked up; lookups come from the API cache except for artists last
+    fetched more than max_age seconds ago. Artists TADB couldn't be
+    reached for keep their old matches.
+
+    Parameters
+    ----------
+    connection: sqlite3.Connection
+    max_age: int
+        Seconds after which an artist is fetched again (None: never)
+
+    Returns
+    -------
+    tuple
+        (number of artists enriched, number of tracks matched to a video)
+    '''
+    cutoff = -1 if max_age is None else int(time.time()) - max_age
+    artists = [
+        (spotify_artist_id, artist_name, fetched_at is None or fetched_at >= cutoff)
+        for spotify_artist_id, artist_name, fetched_at in connection.execute(select_artists_to_enrich)
+    ]
+    enriched = 0
+    matched = 0
+    for result in run_concurrently(fetch_artist_videos, artists):
+        if result is None:
+            continue
+        enriched += 1
+        matched += save_artist_videos(connection, *result)
+    return enriched, matched
+
+
+if __name__ == "__main__":
+    conn = sqlite3.connect(DATABASE_NAME)
+    create_tables(conn)
+    enriched, matched = enrich_music_videos(conn)
+    print(f"Music videos: {enriched} artists enriched, {matched} tracks matched")
+    print(f"Database version: {bump_database_version(conn)}")
+    conn.close()
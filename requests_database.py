@@ -2,188 +2,143 @@
 #### name: Mariele Ventrice
 #### SI507 FINAL PROJECT
 
-import requests
-import json
-import secrets as secrets
+#### The data pipeline behind music.sqlite. Importing this module has no
+#### side effects; run it through the command line:
+####
+#### python3 -m requests_database sync [--full]   fetch from Spotify and load (the default)
+#### python3 -m requests_database fetch           only fill the API cache
+#### python3 -m requests_database load [--full]   load music.sqlite from the API cache, offline
+
+import argparse
+import os
 import sqlite3
+import sys
+import time
+from music_cache import construct_unique_key, cache_lookup, cache_save
+import music_http
+from music_http import SpotifyClient, TransportError, run_concurrently, stream_concurrently
+from music_utils import remove_duplicates
+from music_models import Track, Artist, TrackFeatureProfile
+from music_schema import create_tables, create_indexes, bump_database_version, insert_tracks, insert_artists, insert_artist_genres, delete_artist_genres, insert_features, upsert_tracks, upsert_artists, upsert_features
+from music_bulk_load import apply_load_pragmas, bulk_insert
+from music_leaderboards import refresh_leaderboards
 
-client_id = secrets.SPOTIFY_API_CLIENT_ID
-client_secret = secrets.SPOTIFY_API_SECRET
-
-conn = sqlite3.connect("music.sqlite")
-cur = conn.cursor()
-
-CACHE_DICT = {}
-CACHE_FILE_NAME = "music_cache.json"
-
-##### Authorization #####
-url ="https://accounts.spotify.com/api/token"
-data = {'client_id' : client_id,
-        'client_secret' : client_secret,
-        'grant_type' : 'client_credentials'                 
-        }
-
-auth_response = requests.post(url, data)
-#Convert response to JSON
-auth_response_data = auth_response.json()
-#Save the access token
-access_token = auth_response_data['access_token']
-##### End Authorization #####
-HEADERS = {
-    'Authorization': 'Bearer {token}'.format(token=access_token)
-}
-
-
-
-############## GETTING DATA FROM APIS & FORMATTING ##############
-
-class Track:
-    ''' A music track
-
-    Instance attributes
-    -------------------
-    genre: list
-
-    track_name: string
+DATABASE_NAME = "music.sqlite"
 
-    spotify_track_id: string
+# set by the load command: cache misses are skipped instead of fetched
+OFFLINE = False
 
-    track_popularity: integer
+# what replay and stand-in runs log in with when no credentials are set
+OFFLINE_CREDENTIALS = ("offline", "offline")
 
-    artist_name: string
+_connection = None
+_spotify_client = None
 
-    album_name: string
 
-    spotify_url: string
+class OfflineError(Exception):
+    '''Raised instead of calling Spotify when OFFLINE is set.'''
 
-    spotify_preview: string
 
-    # danceability: int
-
-    # tempo: int
-
-    # acousticness: int
-
-    # music_video: string
-
-    '''
-    def __init__(self, genre="Unknown", track_name="Unknown track", spotify_track_id="None", track_popularity=0, artist_name="Unknown Artist", album_name="Unknown Album", spotify_url="Unknown", preview="Not available", spotify_artist_id="Unknown", popularity=0):
-        self.genre = genre
-        self.track_name = track_name
-        self.spotify_track_id = spotify_track_id
-        self.track_popularity = track_popularity
-        self.artist_name = artist_name
-        self.album_name = album_name
-        self.spotify_url = spotify_url
-        self.preview = preview
-        self.spotify_artist_id = spotify_artist_id
-        self.popularity = popularity 
-
-    def info(self):
-        return f"{self.track_name} ({self.album_name}) by {self.artist_name} – {self.popularity}" 
-
-class Artist:
-    ''' A spotify artist
+class SpotifyError(Exception):
+    '''Raised when Spotify answers with an error status (after any 429
+    retries), so the error body is never taken for data or cached.
 
     Instance attributes
     -------------------
-    genre: list
-
-    artist_name: string
-
-    spotify_artist_id: string
-
-    artist_name: string
-
-    image_url: string
+    status: int
 
+    message: string
 
     '''
-    def __init__(self, genre="Unknown", artist_name="Unknown Artist", spotify_artist_id="Unknown", image_url="Unknown"):
-        self.genre = genre
-        self.artist_name = artist_name
-        self.spotify_artist_id = spotify_artist_id
-        self.image_url = image_url
-
-    def info(self):
-        return f"{self.artist_name} ({self.spotify_artist_id})"
-
-class TrackFeatureProfile:
-
-    def __init__(self, spotify_track_id="Unknown", acousticness=0.0, danceability=0.0, tempo=0.0): 
-        self.spotify_track_id = spotify_track_id
-        self.acousticness = acousticness
-        self.danceability = danceability
-        self.tempo = tempo
+    def __init__(self, url, status, message):
+        super().__init__(f"{url}: {status} {message}")
+        self.status = status
+        self.message = message
+
+
+def get_connection():
+    '''Returns the pipeline's connection to DATABASE_NAME, opening it the
+    first time it is needed.'''
+    global _connection
+    if _connection is None:
+        _connection = sqlite3.connect(DATABASE_NAME)
+    return _connection
+
+
+def get_spotify_client():
+    '''Returns the SpotifyClient, created the first time it is needed with
+    the credentials in secrets.py (SPOTIFY_API_CLIENT_ID and
+    SPOTIFY_API_SECRET), or in environment variables of the same names.
+    Replay and stand-in runs (MUSIC_API_REPLAY, MUSIC_API_STAND_IN) never
+    reach Spotify, so they fall back to OFFLINE_CREDENTIALS.
+    The access token itself is only requested on the first Spotify call.'''
+    global _spotify_client
+    if _spotify_client is None:
+        import secrets
+        client_id = getattr(secrets, "SPOTIFY_API_CLIENT_ID", None) or os.environ.get("SPOTIFY_API_CLIENT_ID")
+        client_secret = getattr(secrets, "SPOTIFY_API_SECRET", None) or os.environ.get("SPOTIFY_API_SECRET")
+        if (client_id is None or client_secret is None) and (music_http.API_REPLAY_RECORDING or music_http.API_STAND_IN_URL):
+            client_id, client_secret = OFFLINE_CREDENTIALS
+        if client_id is None or client_secret is None:
+            raise RuntimeError("Spotify credentials missing: add SPOTIFY_API_CLIENT_ID and SPOTIFY_API_SECRET to secrets.py or the environment")
+        _spotify_client = SpotifyClient(client_id, client_secret)
+    return _spotify_client
+
+
+def spotify_get(url, params=None):
+    '''Sends an authorized Spotify GET and returns the decoded JSON.
+    Raises OfflineError instead when OFFLINE is set, and SpotifyError
+    when Spotify answers with an error status.'''
+    if OFFLINE:
+        raise OfflineError(url)
+    response = get_spotify_client().get(url, params)
+    if not response.ok:
+        try:
+            message = response.json()["error"]["message"]
+        except (ValueError, KeyError, TypeError):
+            message = response.reason
+        raise SpotifyError(url, response.status_code, message)
+    return response.json()
+
+
+def is_error_response(results):
+    '''True for a Spotify error body ({"error": ...}); caches recorded
+    before errors were raised may still hold some.'''
+    return isinstance(results, dict) and "error" in results
+
+# most IDs the multi-ID endpoints accept per call
+SPOTIFY_ARTISTS_BATCH_SIZE = 50
+SPOTIFY_FEATURES_BATCH_SIZE = 100
+
+SPOTIFY_SEARCH_PAGE_SIZE = 50
+SPOTIFY_SEARCH_MAX_RESULTS = 1000 # search won't page past offset + limit = 1000
+
+# tracks written to the tracks table per transaction
+TRACK_CHUNK_SIZE = 500
+
+# seconds before a stored row is fetched again by an incremental sync
+ARTIST_MAX_AGE = 30 * 24 * 60 * 60
+FEATURES_MAX_AGE = None # audio features don't change
+
+# genre -> Spotify search queries harvested for it. Each query can return at
+# most SPOTIFY_SEARCH_MAX_RESULTS tracks, so bigger catalogs need more (e.g.
+# narrower year ranges) queries per genre.
+GENRE_QUERIES = {
+    "folk": ["genre:folk"],
+    "indie": ["genre:indie"],
+    "punk": ["genre:punk year:2000-2010"],
+    "emo": ["genre:emo year:2000-2010"],
+    "hip-hop": ["genre:hip-hop year:2000-2010"],
+    "indie pop": ["genre:indie pop"],
+    "pop": ["genre:pop"],
+    "alternative": ["genre:'alternative' year:1990-2000"],
+}
 
-    def info(self):
-        return f"SpotifyID{self.spotify_track_id}, Acousticness: {self.acousticness}, Dancesability: {self.danceability}, tempo: {self.tempo}"
 
 
-def open_cache():
-    '''Opens the cache file if it exists and loads the JSON into
-    the CACHE_DICT dictionary. If the cache file doesn't exist, creates
-    a new cache dictionary
-    
-    Parameters
-    ----------
-    None
-    
-    Returns
-    -------
-    The loaded cache: dict
-    '''
-    try:
-        cache_file = open(CACHE_FILE_NAME, 'r')
-        cache_file_contents = cache_file.read()
-        cache = json.loads(cache_file_contents)
-        cache_file.close()
-    except:
-        cache = {}
-    return cache
-
-def save_cache(cache):
-    ''' Saves the current state of the cache to disk
-
-    Parameters
-    ----------
-    cache_dict: dict
-        The dictionary to save
+############## GETTING DATA FROM APIS & FORMATTING ##############
 
-    Returns
-    -------
-    None
-    '''
-    contents_to_write = json.dumps(cache)
-    cache_file = open(CACHE_FILE_NAME, 'w')
-    cache_file.write(contents_to_write)
-    cache_file.close()
-
-def construct_unique_key(baseurl, params):
-    ''' constructs a key that is guaranteed to uniquely and 
-    repeatably identify an API request by its baseurl and params
-    
-    Parameters
-    ----------
-    baseurl: string
-        The URL for the API endpoint
-    params: dict
-        A dictionary of param:value pairs
-    
-    Returns
-    -------
-    string
-        the unique key as a string
-    '''
-    param_strings = []  #empty list to store parameter strings (unique keys)
-    connector = "_"
-    for key in params.keys(): #for key in key value pair
-        param_strings.append(f"{key}_{params[key]}") #adds key, value pair of each paramater as key_value
-    param_strings.sort() #sorts list so keys are in order
-    unique_key = baseurl + connector + connector.join(param_strings)
-    return unique_key
-
-def make_spotify_request_with_cache(baseurl, params):
+def make_spotify_request_with_cache(baseurl, params, use_cache=True):
     '''Check the cache for a saved result for api request. If the result is found,
     return it. Otherwise, send a new request, save it, then return it. 
 
@@ -191,102 +146,210 @@ def make_spotify_request_with_cache(baseurl, params):
     ----------
     baseurl: string
         The URL for the get request
-    cache: dictionary of json data
+    params: dict
+        The query parameters
+    use_cache: bool
+        False to skip the cache lookup and send the request anyway (the
+        fresh result is still saved to the cache)
 
     Returns
     -------
     dict
         the data returned from making the request in the form of 
-        a dictionary
+        a dictionary, or an error dict (never cached) if it couldn't
+        be fetched
     '''
-    headers=HEADERS
-    CACHE_DICT = open_cache()
     unique_key = construct_unique_key(baseurl, params)
-    if (unique_key in CACHE_DICT.keys()):
+    cached = cache_lookup(unique_key) if use_cache else None
+    if cached is not None and not is_error_response(cached):
         print("Using cache")
-        return CACHE_DICT[unique_key]
+        return cached
     else:
+        try:
+            results = spotify_get(baseurl, params)
+        except OfflineError:
+            print(f"Not in the cache: {unique_key}")
+            return {"error": {"status": None, "message": "not in the cache"}}
+        except SpotifyError as error:
+            print(f"Not fetched: {error}")
+            return {"error": {"status": error.status, "message": error.message}}
+        except TransportError as error:
+            print(f"Not fetched: {error}")
+            return {"error": {"status": None, "message": str(error)}}
         print("Fetching")
-        response = requests.get(baseurl, params, headers=headers)
-        CACHE_DICT[unique_key] = response.json()
-        save_cache(CACHE_DICT)
-        return CACHE_DICT[unique_key]
+        cache_save(unique_key, results)
+        return results
 
 def make_spotify_audio_features_request_with_cache(search_url):
-    headers=HEADERS
-    CACHE_DICT = open_cache()
     unique_key = search_url
-    if (unique_key in CACHE_DICT.keys()):
+    cached = cache_lookup(unique_key)
+    if cached is not None and not is_error_response(cached):
         print("Using cache")
-        return CACHE_DICT[unique_key]
+        return cached
     else:
         print("Fetching")
-        response = requests.get(search_url, headers=headers)
-        CACHE_DICT[unique_key] = response.json()
-        save_cache(CACHE_DICT)
-        return CACHE_DICT[unique_key]
+        results = spotify_get(search_url)
+        cache_save(unique_key, results)
+        return results
 
 def make_spotify_artists_request_with_cache(search_url):
-    headers=HEADERS
-    CACHE_DICT = open_cache()
     unique_key = search_url
-    if (unique_key in CACHE_DICT.keys()):
+    cached = cache_lookup(unique_key)
+    if cached is not None and not is_error_response(cached):
         print("Using cache")
-        return CACHE_DICT[unique_key]
+        return cached
     else:
         print("Fetching")
-        response = requests.get(search_url, headers=headers)
-        CACHE_DICT[unique_key] = response.json()
-        save_cache(CACHE_DICT)
-        return CACHE_DICT[unique_key]
+        results = spotify_get(search_url)
+        cache_save(unique_key, results)
+        return results
+
+def make_spotify_batch_request_with_cache(baseurl, ids, results_key, batch_size, use_cache=True):
+    '''Looks up many Spotify objects by ID. IDs are de-duplicated, each ID
+    is checked in the cache under its single-ID URL (baseurl/id), and the
+    missing ones are fetched through the multi-ID endpoint (baseurl?ids=...)
+    batch_size at a time, with the batches running concurrently. Every
+    object returned by a batch is saved under its own single-ID key, so
+    later single-ID lookups hit the cache.
 
-def get_folk_tracks():
-    baseurl="https://api.spotify.com/v1/search"
-    params={"q":"genre:folk", "type":"track", "limit":50}
-    results = make_spotify_request_with_cache(baseurl, params)
-    return results
+    Parameters
+    ----------
+    baseurl: string
+        The URL of the multi-ID endpoint
+    ids: list
+        Spotify IDs, may contain repeats
+    results_key: string
+        The key holding the list of objects in the batch response
+    batch_size: int
+        The maximum number of IDs the endpoint accepts per call
+    use_cache: bool
+        False to skip the cache lookup and re-fetch every ID (the fresh
+        results are still saved to the cache)
 
-def get_hiphop_tracks():
-    baseurl="https://api.spotify.com/v1/search"
-    params={"q":"genre:hip-hop year:2000-2010", "type":"track", "limit":50}
-    results = make_spotify_request_with_cache(baseurl, params)
-    return results
+    Returns
+    -------
+    list
+        one result dict per unique ID, in the order the IDs were first seen
+        (IDs Spotify has no data for, and IDs in batches that failed, are
+        left out; a sync picks the failed ones up next time)
+    '''
+    unique_ids = list(dict.fromkeys(ids))
+    results_by_id = {}
+    missing_ids = []
+    for spotify_id in unique_ids:
+        cached = cache_lookup(baseurl + "/" + spotify_id) if use_cache else None
+        if cached is not None and not is_error_response(cached):
+            results_by_id[spotify_id] = cached
+        else:
+            missing_ids.append(spotify_id)
+    if len(unique_ids) > len(missing_ids):
+        print(f"Using cache for {len(unique_ids) - len(missing_ids)} of {len(unique_ids)}")
+    if OFFLINE and len(missing_ids) > 0:
+        print(f"Not in the cache: {len(missing_ids)} of {len(unique_ids)}")
+        missing_ids = []
+    failed_batches = []
+    def fetch_batch(batch):
+        print(f"Fetching {len(batch)}")
+        try:
+            batch_results = [result for result in spotify_get(baseurl, {"ids": ",".join(batch)})[results_key] if result is not None] # Spotify returns null for IDs it doesn't know
+        except (SpotifyError, TransportError, KeyError) as error:
+            # one bad batch shouldn't abort a sync that has already loaded the tracks
+            print(f"Skipping a batch of {len(batch)}: {error!r}")
+            failed_batches.append(batch)
+            return []
+        for result in batch_results:
+            cache_save(baseurl + "/" + result['id'], result)
+        return batch_results
+    batches = [missing_ids[i:i + batch_size] for i in range(0, len(missing_ids), batch_size)]
+    for batch_results in run_concurrently(fetch_batch, batches):
+        for result in batch_results:
+            results_by_id[result['id']] = result
+    if len(failed_batches) > 0:
+        print(f"Failed: {sum(len(batch) for batch in failed_batches)} of {len(missing_ids)} in {len(failed_batches)} batches")
+    return [results_by_id[spotify_id] for spotify_id in unique_ids if spotify_id in results_by_id]
+
+def get_genre_tracks(query, offset=0, use_cache=True):
+    '''Gets one page of search results for a genre query.
 
-def get_emo_tracks():
-    baseurl="https://api.spotify.com/v1/search"
-    params={"q":"genre:emo year:2000-2010", "type":"track", "limit":50}
-    results = make_spotify_request_with_cache(baseurl, params)
-    return results
+    Parameters
+    ----------
+    query: string
+        A Spotify search query, e.g. "genre:folk"
+    offset: int
+        The index of the first result to return
+    use_cache: bool
+        False to search Spotify again instead of reusing a cached page
 
-def get_indie_tracks():
+    Returns
+    -------
+    dict
+        the search results
+    '''
     baseurl="https://api.spotify.com/v1/search"
-    params={"q":"genre:indie", "type":"track", "limit":50}
-    results = make_spotify_request_with_cache(baseurl, params)
+    params={"q":query, "type":"track", "limit":SPOTIFY_SEARCH_PAGE_SIZE}
+    if offset > 0: # keep the first page's cache key the same as before paging
+        params["offset"] = offset
+    results = make_spotify_request_with_cache(baseurl, params, use_cache)
     return results
 
-def get_punk_tracks():
-    baseurl="https://api.spotify.com/v1/search"
-    params={"q":"genre:punk year:2000-2010", "type":"track", "limit":50}
-    results = make_spotify_request_with_cache(baseurl, params)
-    return results
+def harvest_genre_tracks(genre, max_tracks_per_query=None, use_cache=True):
+    '''Follows the search result pages of every query listed for a genre
+    in GENRE_QUERIES, yielding the tracks one page at a time.
 
-def get_pop_tracks():
-    baseurl="https://api.spotify.com/v1/search"
-    params={"q":"genre:pop", "type":"track", "limit":50}
-    results = make_spotify_request_with_cache(baseurl, params)
-    return results
+    Parameters
+    ----------
+    genre: string
+        A key of GENRE_QUERIES
+    max_tracks_per_query: int
+        Stop paging a query after this many tracks (default: until the
+        results, or Spotify's search offset limit, run out)
+    use_cache: bool
+        False to search Spotify again instead of reusing cached pages, so
+        tracks added since the pages were cached are found
 
-def get_indie_pop_tracks():
-    baseurl="https://api.spotify.com/v1/search"
-    params={"q":"genre:indie pop", "type":"track", "limit":50}
-    results = make_spotify_request_with_cache(baseurl, params)
-    return results
+    Returns
+    -------
+    generator
+        lists of Track objects, one list per page
+    '''
+    for query in GENRE_QUERIES[genre]:
+        offset = 0
+        while True:
+            results = get_genre_tracks(query, offset, use_cache)
+            if 'tracks' not in results: # error response
+                print(f"No results for {query} at offset {offset}: {results.get('error')}")
+                break
+            page = create_track_objects(results)
+            for track in page:
+                track.genre = genre
+            yield page
+            offset += SPOTIFY_SEARCH_PAGE_SIZE
+            if results['tracks']['next'] is None or len(page) == 0:
+                break
+            if max_tracks_per_query is not None and offset >= max_tracks_per_query:
+                break
+            if offset + SPOTIFY_SEARCH_PAGE_SIZE > SPOTIFY_SEARCH_MAX_RESULTS:
+                break
+
+def harvest_all_genre_tracks(genres=None, max_tracks_per_query=None, use_cache=True):
+    '''Harvests several genres concurrently (see harvest_genre_tracks),
+    yielding pages of Track objects as they arrive.
 
-def get_alternative_tracks():
-    baseurl="https://api.spotify.com/v1/search"
-    params={"q":"genre:'alternative' year:1990-2000", "type":"track", "limit":50}
-    results = make_spotify_request_with_cache(baseurl, params)
-    return results
+    Parameters
+    ----------
+    genres: list
+        Keys of GENRE_QUERIES (default: all of them)
+    max_tracks_per_query: int
+    use_cache: bool
+
+    Returns
+    -------
+    generator
+        lists of Track objects, one list per page
+    '''
+    if genres is None:
+        genres = list(GENRE_QUERIES)
+    return stream_concurrently(lambda genre: harvest_genre_tracks(genre, max_tracks_per_query, use_cache), genres)
 
 def get_spotify_artists(spotify_artist_id):
     # spotify_artist_id = artist_object.spotify_artist_id
@@ -302,6 +365,16 @@ def get_track_audio_features(track_id):
     results = make_spotify_audio_features_request_with_cache(search_url)
     return results
 
+def get_spotify_artists_batch(spotify_artist_ids, use_cache=True):
+    baseurl="https://api.spotify.com/v1/artists"
+    results = make_spotify_batch_request_with_cache(baseurl, spotify_artist_ids, "artists", SPOTIFY_ARTISTS_BATCH_SIZE, use_cache)
+    return results
+
+def get_track_audio_features_batch(track_ids, use_cache=True):
+    baseurl="https://api.spotify.com/v1/audio-features"
+    results = make_spotify_batch_request_with_cache(baseurl, track_ids, "audio_features", SPOTIFY_FEATURES_BATCH_SIZE, use_cache)
+    return results
+
 def create_track_objects(spotify_track_results):
     list_track_objects = []
     results_list = spotify_track_results['tracks']['items']
@@ -325,7 +398,7 @@ def create_artist_objects(spotify_artist_results):
         artist_name = spotify_artist_results[i]['name']
         genre = spotify_artist_results[i]['genres']
         image_url = spotify_artist_results[i]['images'][0]['url']
-        artist_object = Artist(artist_name=artist_name, spotify_artist_id=artist_id, genre=genre, image_url=image_url)
+        artist_object = Artist(artist_name=artist_name, spotify_artist_id=artist_id, genre=genre, image_url=image_url, spotify_genres=list(genre))
         list_artist_objects.append(artist_object)
     return list_artist_objects
 
@@ -341,26 +414,50 @@ def create_track_features_objects(track_features_results):
     return list_features_objects
 
 def remove_duplicate_tracks(list):
-   i = 0
-   while i < len(list):
-      j = i + 1
-      while j < len(list):
-         if list[i].spotify_track_id == list[j].spotify_track_id:
-            del list[j]
-         else:
-            j += 1
-      i += 1
+    remove_duplicates(list, key=lambda track: track.spotify_track_id)
 
 def remove_duplicate_artists(list):
-   i = 0
-   while i < len(list):
-      j = i + 1
-      while j < len(list):
-         if list[i].spotify_artist_id == list[j].spotify_artist_id:
-            del list[j]
-         else:
-            j += 1
-      i += 1
+    remove_duplicates(list, key=lambda artist: artist.spotify_artist_id)
+
+def save_tracks(track_pages, full_rebuild=False, chunk_size=TRACK_CHUNK_SIZE):
+    '''Loads pages of Track objects into the tracks table (plain inserts
+    for a full rebuild, upserts otherwise), committing every chunk_size
+    rows. The pages usually arrive from the network, so the write lock is
+    only held while a chunk is written, and a failed harvest keeps the
+    chunks already committed. Tracks whose Spotify ID was already seen in
+    this run are skipped.
+
+    Parameters
+    ----------
+    track_pages: iterable
+        lists of Track objects, e.g. from harvest_all_genre_tracks
+    full_rebuild: bool
+    chunk_size: int
+
+    Returns
+    -------
+    tuple
+        (list of unique track IDs loaded, list of unique artist IDs seen)
+    '''
+    connection = get_connection()
+    insert_sql = insert_tracks if full_rebuild else upsert_tracks
+    fetched_at = int(time.time())
+    seen_track_ids = {}
+    seen_artist_ids = {}
+    chunk = []
+    for page in track_pages:
+        for track in page:
+            if track.spotify_track_id in seen_track_ids:
+                continue
+            seen_track_ids[track.spotify_track_id] = None
+            seen_artist_ids[track.spotify_artist_id] = None
+            chunk.append([track.track_name, track.artist_name, track.album_name, track.preview, track.spotify_url, track.spotify_artist_id, track.spotify_track_id, track.popularity, fetched_at])
+        if len(chunk) >= chunk_size:
+            bulk_insert(connection, insert_sql, chunk)
+            chunk = []
+    if len(chunk) > 0:
+        bulk_insert(connection, insert_sql, chunk)
+    return list(seen_track_ids), list(seen_artist_ids)
 
 # def map_genres(artist_object):
 #     if 'rock' in artist_object.genre or 'emo' in artist_object.genre or 'modern rock' in artist_object.genre or 'pop punk' in artist_object.genre:
@@ -392,156 +489,215 @@ def map_genres(artist_object):
 
 ############## CREATING TABLES & INSERTING DATA ##############
 
-drop_tracks = '''
-    DROP TABLE IF EXISTS "tracks";
-'''
-
-create_tracks = '''
-    CREATE TABLE IF NOT EXISTS "tracks" (
-        "TrackId"           INTEGER PRIMARY KEY AUTOINCREMENT UNIQUE,
-        "TrackName"         TEXT NOT NULL,
-        "ArtistName"        TEXT NOT NULL,
-        "AlbumName"         TEXT,
-        "SpotifyPreview"    TEXT,
-        "SpotifyURL"        TEXT,
-        "SpotifyArtistId"   TEXT,
-        "SpotifyTrackId"    TEXT NOT NULL,
-        "Popularity"        INTEGER,
-        FOREIGN KEY(SpotifyArtistId) REFERENCES artists(SpotifyArtistId)
-    );
-'''
-
-drop_artists = '''
-    DROP TABLE IF EXISTS "artists";
-'''
-
-create_artists = '''
-    CREATE TABLE IF NOT EXISTS "artists" (
-        "SpotifyArtistId"   TEXT PRIMARY KEY UNIQUE,
-        "ArtistName"        TEXT NOT NULL,
-        "Genre"             TEXT,
-        "ImageUrl"          TEXT
-    );
-'''
-
-drop_features = '''
-    DROP TABLE IF EXISTS "features";
-'''
-
-create_features = '''
-    CREATE TABLE IF NOT EXISTS "features" (
-
-        "SpotifyTrackId"    TEXT PRIMARY KEY NOT NULL,
-        "Acousticness"      REAL,
-        "Danceability"      REAL,    
-        "Tempo"             REAL
-        );
-'''
-
-# cur.execute(drop_features)
-# cur.execute(create_features)
-# conn.commit()
-
-# cur.execute(drop_tracks)
-# cur.execute(create_tracks)
-# conn.commit()
-
-cur.execute(drop_artists)
-cur.execute(create_artists)
-conn.commit()
-
-
-folk_results = get_folk_tracks()
-list_folk_track_objects = create_track_objects(folk_results)
-
-emo_results = get_emo_tracks()
-list_emo_track_objects = create_track_objects(emo_results)
-
-indie_results = get_indie_tracks()
-list_indie_track_objects = create_track_objects(indie_results)
-
-punk_results = get_punk_tracks()
-list_punk_track_objects = create_track_objects(punk_results)
-
-hiphop_results = get_hiphop_tracks()
-list_hiphop_track_objects = create_track_objects(hiphop_results)
-
-pop_results = get_pop_tracks()
-list_pop_track_objects = create_track_objects(pop_results)
+def find_ids_to_fetch(table, id_column, ids, max_age):
+    '''Splits IDs into the ones missing from a table (or stored before
+    FetchedAt was recorded) and the ones whose row is older than max_age.
 
-indie_pop_results = get_indie_pop_tracks()
-list_indie_pop_track_objects = create_track_objects(indie_pop_results)
-
-alternative_results = get_alternative_tracks()
-list_alternative_track_objects = create_track_objects(alternative_results)
-
-full_track_list = list_folk_track_objects + list_indie_track_objects + list_punk_track_objects + list_emo_track_objects + list_hiphop_track_objects + list_indie_pop_track_objects + list_pop_track_objects + list_alternative_track_objects
-remove_duplicate_tracks(full_track_list)
-
-# print(full_track_list)
-#Combine the lists here##
-# print(len(full_track_list))
-
-###POPULATE TRACKS TABLE###
-
-insert_tracks = '''
-    INSERT INTO tracks
-    VALUES (NULL, ?, ?, ?, ?, ?, ?, ?, ?)
-'''
-
-# for track in full_track_list:
-#     cur.execute(insert_tracks, [track.track_name, track.artist_name, track.album_name, track.preview, track.spotify_url, track.spotify_artist_id, track.spotify_track_id, track.popularity])
-# conn.commit()
-
-
-## Get Artists ######
-artist_list = []
-for track in full_track_list:
-    spotify_artist_id = track.spotify_artist_id
-    results = get_spotify_artists(spotify_artist_id)
-    artist_list.append(results)
-
-#### Turn Artists Results into Objects ###
-
-list_artist_objects = create_artist_objects(artist_list)
-remove_duplicate_artists(list_artist_objects)
-for artist in list_artist_objects:
-    map_genres(artist)
-
-####INSERT INTO ARTISTS TABLE######
-
-insert_artists = '''
-    INSERT INTO artists
-    VALUES (?, ?, ?, ?)
-'''
+    Parameters
+    ----------
+    table: string
+        "artists" or "features"
+    id_column: string
+        The Spotify ID column of that table
+    ids: list
+    max_age: int
+        Seconds after which a row is stale (None: rows never go stale)
 
-for artist in list_artist_objects:
-    cur.execute(insert_artists, [artist.spotify_artist_id, artist.artist_name, artist.genre, artist.image_url])
-conn.commit()
+    Returns
+    -------
+    tuple
+        (list of new IDs, list of stale IDs)
+    '''
+    conn = get_connection()
+    cur = conn.cursor()
+    cur.execute('CREATE TEMP TABLE IF NOT EXISTS "wanted_ids" ("Id" TEXT PRIMARY KEY)')
+    cur.execute('DELETE FROM wanted_ids')
+    cur.executemany('INSERT OR IGNORE INTO wanted_ids VALUES (?)', [(spotify_id,) for spotify_id in ids])
+    query = f'''
+        SELECT wanted_ids.Id, {table}.FetchedAt FROM wanted_ids
+        LEFT JOIN {table}
+        ON {table}.{id_column} = wanted_ids.Id
+        WHERE {table}.{id_column} IS NULL OR {table}.FetchedAt IS NULL OR {table}.FetchedAt < ?
+    '''
+    cutoff = -1 if max_age is None else int(time.time()) - max_age
+    new_ids = []
+    stale_ids = []
+    for spotify_id, fetched_at in cur.execute(query, (cutoff,)).fetchall():
+        if fetched_at is None:
+            new_ids.append(spotify_id)
+        else:
+            stale_ids.append(spotify_id)
+    cur.execute('DELETE FROM wanted_ids')
+    conn.commit()
+    return new_ids, stale_ids
+
+def save_artists(list_artist_objects, full_rebuild=False):
+    fetched_at = int(time.time())
+    rows = ([artist.spotify_artist_id, artist.artist_name, artist.genre, artist.image_url, fetched_at] for artist in list_artist_objects)
+    bulk_insert(get_connection(), insert_artists if full_rebuild else upsert_artists, rows, sort_key=lambda row: row[0])
+    save_artist_genres(list_artist_objects, full_rebuild)
+
+def save_artist_genres(list_artist_objects, full_rebuild=False):
+    '''Replaces the artist_genres rows of the given artists with their
+    Spotify genres and their mapped genre bucket, in one transaction.'''
+    rows = []
+    for artist in list_artist_objects:
+        for spotify_genre in artist.spotify_genres:
+            rows.append(["spotify", spotify_genre, artist.spotify_artist_id])
+        if isinstance(artist.genre, str):
+            rows.append(["bucket", artist.genre, artist.spotify_artist_id])
+    rows.sort()
+    conn = get_connection()
+    with conn:
+        if not full_rebuild:
+            conn.executemany(delete_artist_genres, [[artist.spotify_artist_id] for artist in list_artist_objects])
+        conn.executemany(insert_artist_genres, rows)
+
+def save_features(audio_features_objects, full_rebuild=False):
+    fetched_at = int(time.time())
+    rows = ([feature.spotify_track_id, feature.acousticness, feature.danceability, feature.tempo, fetched_at] for feature in audio_features_objects)
+    bulk_insert(get_connection(), insert_features if full_rebuild else upsert_features, rows, sort_key=lambda row: row[0])
+
+
+############## PIPELINE ##############
+
+def fetch(genres=None, max_tracks_per_query=None):
+    '''Fills the API cache with the search results, artists and audio
+    features of every harvested track, without touching music.sqlite.
 
+    Parameters
+    ----------
+    genres: list
+        Keys of GENRE_QUERIES (default: all of them)
+    max_tracks_per_query: int
 
+    Returns
+    -------
+    None
+    '''
+    track_ids = {}
+    artist_ids = {}
+    # search results change as Spotify adds tracks, so they are always fetched again
+    for page in harvest_all_genre_tracks(genres, max_tracks_per_query, use_cache=False):
+        for track in page:
+            track_ids[track.spotify_track_id] = None
+            artist_ids[track.spotify_artist_id] = None
+    print(f"Tracks: {len(track_ids)}")
+    print(f"Artists: {len(get_spotify_artists_batch(list(artist_ids)))}")
+    print(f"Features: {len(get_track_audio_features_batch(list(track_ids)))}")
+
+def sync(full_rebuild=False, genres=None, max_tracks_per_query=None):
+    '''Harvests tracks, artists and audio features and loads them into
+    music.sqlite. An incremental sync (the default) upserts rows and only
+    fetches artists and features that are new or stale; a full rebuild
+    drops and reloads every Spotify table.
 
-#### GET FEATURES #####
+    Parameters
+    ----------
+    full_rebuild: bool
+    genres: list
+        Keys of GENRE_QUERIES (default: all of them)
+    max_tracks_per_query: int
 
-# features_list = []
-# for track in full_track_list:
-#     spotify_track_id= track.spotify_track_id
-#     results = get_track_audio_features(spotify_track_id)
-#     features_list.append(results)
+    Returns
+    -------
+    None
+    '''
+    conn = get_connection()
+    apply_load_pragmas(conn)
+    create_tables(conn, full_rebuild=full_rebuild)
+
+    ###POPULATE TRACKS TABLE###
+    ## Genres are harvested concurrently and loaded page by page ##
+    ## search results change as Spotify adds tracks, so only load reuses cached pages ##
+    track_pages = harvest_all_genre_tracks(genres, max_tracks_per_query, use_cache=OFFLINE)
+    track_id_list, artist_id_list = save_tracks(track_pages, full_rebuild=full_rebuild)
+
+    ## Get Artists ######
+    ## only artists that are new, or were fetched more than ARTIST_MAX_AGE ago ##
+    new_artist_ids, stale_artist_ids = find_ids_to_fetch("artists", "SpotifyArtistId", artist_id_list, ARTIST_MAX_AGE)
+    print(f"Artists: {len(new_artist_ids)} new, {len(stale_artist_ids)} stale, {len(artist_id_list) - len(new_artist_ids) - len(stale_artist_ids)} up to date")
+    # offline, stale rows can only be refreshed from the cache
+    artist_list = get_spotify_artists_batch(new_artist_ids) + get_spotify_artists_batch(stale_artist_ids, use_cache=OFFLINE)
+
+    #### Turn Artists Results into Objects ###
+    list_artist_objects = create_artist_objects(artist_list)
+    remove_duplicate_artists(list_artist_objects)
+    for artist in list_artist_objects:
+        map_genres(artist)
+
+    ####LOAD INTO ARTISTS TABLE######
+    save_artists(list_artist_objects, full_rebuild=full_rebuild)
+
+    #### GET FEATURES #####
+    new_track_ids, stale_track_ids = find_ids_to_fetch("features", "SpotifyTrackId", track_id_list, FEATURES_MAX_AGE)
+    print(f"Features: {len(new_track_ids)} new, {len(stale_track_ids)} stale, {len(track_id_list) - len(new_track_ids) - len(stale_track_ids)} up to date")
+    features_list = get_track_audio_features_batch(new_track_ids) + get_track_audio_features_batch(stale_track_ids, use_cache=OFFLINE)
+
+    #### FEATURES TO OBJECTS#####
+    audio_features_objects = create_track_features_objects(features_list)
+
+    ######LOAD INTO FEATURES TABLE #####
+    save_features(audio_features_objects, full_rebuild=full_rebuild)
+
+    ## a full rebuild loads without indexes and builds them at the end ##
+    if full_rebuild:
+        create_indexes(conn)
+
+    ## rewrite the /results leaderboards that changed, in one transaction ##
+    print(f"Leaderboards: {refresh_leaderboards(conn)} rewritten")
+
+    ## new version stamp, so the web app stops serving pages cached from the old data ##
+    print(f"Database version: {bump_database_version(conn)}")
+
+def load(full_rebuild=False, genres=None, max_tracks_per_query=None):
+    '''Runs sync from the API cache alone: nothing is fetched, and
+    anything missing from the cache is skipped.'''
+    global OFFLINE
+    OFFLINE = True
+    try:
+        sync(full_rebuild, genres, max_tracks_per_query)
+    finally:
+        OFFLINE = False
+
+# command -> (function, help)
+COMMANDS = {
+    "sync": (sync, "fetch new and stale data from Spotify and load it (the default)"),
+    "fetch": (fetch, "only fill the API cache"),
+    "load": (load, "load music.sqlite from the API cache, without the network"),
+}
 
-#### FEATURES TO OBJECTS#####
+def main(argv=None):
+    '''Parses the command line and runs one of COMMANDS.
 
-# audio_features_objects = create_track_features_objects(features_list)
-# print(audio_features_objects[0].info())
+    Parameters
+    ----------
+    argv: list
+        the arguments (default: sys.argv[1:])
 
-######INSERT INTO FEATURES TABLE #####
-insert_features = '''
-    INSERT INTO features
-    VALUES (?, ?, ?, ?)
-'''
-# for feature in audio_features_objects:
-#     cur.execute(insert_features, [feature.spotify_track_id, feature.acousticness, feature.danceability, feature.tempo])
-# conn.commit()
+    Returns
+    -------
+    None
+    '''
+    argv = sys.argv[1:] if argv is None else list(argv)
+    if len(argv) == 0 or (argv[0].startswith("-") and argv[0] not in ("-h", "--help")):
+        argv = ["sync"] + argv # "requests_database.py --full" still means sync
+    parser = argparse.ArgumentParser(prog="python3 -m requests_database", description="Build music.sqlite from the Spotify API")
+    commands = parser.add_subparsers(dest="command", required=True)
+    for name, (_, help_text) in COMMANDS.items():
+        command = commands.add_parser(name, help=help_text)
+        command.add_argument("--genres", nargs="+", choices=list(GENRE_QUERIES), help="genres to harvest (default: all)")
+        command.add_argument("--max-tracks-per-query", type=int, help="stop paging a search query after this many tracks")
+        if name != "fetch":
+            command.add_argument("--full", action="store_true", help="drop and rebuild every Spotify table")
+    args = parser.parse_args(argv)
+    options = {"genres": args.genres, "max_tracks_per_query": args.max_tracks_per_query}
+    if args.command != "fetch":
+        options["full_rebuild"] = args.full
+    function, _ = COMMANDS[args.command]
+    function(**options)
+    if _connection is not None:
+        _connection.close()
 
 
 
@@ -586,3 +742,5 @@ insert_features = '''
 # print(result)
 
 
+if __name__ == "__main__":
+    main()